@@ -0,0 +1,379 @@
+# throughput of the preprocessing, inference and postprocessing hot paths
+# runs without the webui and without network, on a tiny generated onnx model
+#
+#   python benchmarks/benchmark.py --images 64 --output result.json
+#
+# requires the onnx package to generate the model
+
+import os
+import sys
+import csv
+import json
+import time
+import asyncio
+import base64
+import platform
+import tempfile
+
+from typing import Callable, Dict, List
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from tagger import headless  # noqa: E402
+
+
+def build_model(path: Path, size: int, tags: int) -> None:
+    # (N, H, W, 3) -> conv -> relu -> pool -> (N, tags) -> sigmoid
+    # biased like the real models, only a few tags are above the threshold
+    # small enough to not hide the cost of the code around the model
+    from onnx import helper, numpy_helper, TensorProto, save
+
+    rng = np.random.RandomState(0)
+    initializers = [
+        numpy_helper.from_array(
+            rng.randn(16, 3, 4, 4).astype(np.float32) / 256,
+            'conv_weight'
+        ),
+        numpy_helper.from_array(
+            (rng.randn(16, tags) * 0.1).astype(np.float32),
+            'weight'
+        ),
+        numpy_helper.from_array(
+            (rng.randn(tags) * 1.5 - 5).astype(np.float32),
+            'bias'
+        )
+    ]
+
+    nodes = [
+        helper.make_node('Transpose', ['input'], ['nchw'], perm=[0, 3, 1, 2]),
+        helper.make_node('Conv', ['nchw', 'conv_weight'], ['conv'], strides=[4, 4]),
+        helper.make_node('Relu', ['conv'], ['relu']),
+        helper.make_node('GlobalAveragePool', ['relu'], ['pool']),
+        helper.make_node('Flatten', ['pool'], ['features']),
+        helper.make_node('MatMul', ['features', 'weight'], ['product']),
+        helper.make_node('Add', ['product', 'bias'], ['logits']),
+        helper.make_node('Sigmoid', ['logits'], ['output'])
+    ]
+
+    graph = helper.make_graph(
+        nodes,
+        'tagger-benchmark',
+        [helper.make_tensor_value_info('input', TensorProto.FLOAT, ['N', size, size, 3])],
+        [helper.make_tensor_value_info('output', TensorProto.FLOAT, ['N', tags])],
+        initializers
+    )
+
+    model = helper.make_model(
+        graph,
+        opset_imports=[helper.make_opsetid('', 13)]
+    )
+    model.ir_version = 7
+
+    save(model, str(path))
+
+
+def build_tags(path: Path, tags: int) -> None:
+    rng = np.random.RandomState(0)
+
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(['tag_id', 'name', 'category', 'count'])
+
+        for i, name in enumerate(['general', 'sensitive', 'questionable', 'explicit']):
+            writer.writerow([i, f'rating:{name}', 9, 0])
+
+        for i in range(tags - 4):
+            # some names need to be escaped or keep their underscores
+            name = f'tag_{i}' if i % 5 else f'name_(series_{i})'
+            writer.writerow([i + 4, name, 4 if i % 7 == 0 else 0, rng.randint(1000)])
+
+
+def build_images(directory: Path, count: int, min_size: int, max_size: int) -> List[Path]:
+    from PIL import Image
+
+    rng = np.random.RandomState(0)
+    paths = []
+
+    for i in range(count):
+        width, height = rng.randint(min_size, max_size + 1, 2)
+
+        # smooth gradients with a transparent corner, noise would only measure zlib
+        x = np.linspace(0, 255, width, dtype=np.float32)
+        y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+        image = np.empty((height, width, 4), np.uint8)
+        image[..., 0] = x
+        image[..., 1] = y
+        image[..., 2] = (x + y) / 2
+        image[..., 3] = 255
+        image[:height // 4, :width // 4, 3] = 0
+
+        path = directory.joinpath(f'{i:05}.png')
+        Image.fromarray(image, 'RGBA').save(path)
+        paths.append(path)
+
+    return paths
+
+
+def summarize(latencies: List[float], images: int) -> Dict[str, float]:
+    # latencies in seconds, one for each run of the stage
+    milliseconds = np.array(latencies) * 1000
+
+    return {
+        'runs': len(latencies),
+        'images': images,
+        'images_per_sec': images / max(sum(latencies), 1e-9),
+        'mean_ms': float(milliseconds.mean()),
+        'p50_ms': float(np.percentile(milliseconds, 50)),
+        'p90_ms': float(np.percentile(milliseconds, 90)),
+        'p99_ms': float(np.percentile(milliseconds, 99)),
+        'min_ms': float(milliseconds.min()),
+        'max_ms': float(milliseconds.max())
+    }
+
+
+def measure(runs: List[Callable[[], object]], images_per_run: int) -> Dict[str, float]:
+    latencies = []
+
+    for run in runs:
+        start = time.perf_counter()
+        run()
+        latencies.append(time.perf_counter() - start)
+
+    return summarize(latencies, images_per_run * len(runs))
+
+
+def install_ui_modules() -> None:
+    # ui is only imported for its batch loop, none of these are used by it
+    for name, attributes in [
+        ('gradio', {}),
+        ('webui', {'wrap_gradio_gpu_call': lambda f, **_: f}),
+        ('modules.ui', {}),
+        ('modules.generation_parameters_copypaste', {})
+    ]:
+        if name not in sys.modules:
+            headless.module(name, **attributes)
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument('--images', type=int, default=64, help='number of generated images')
+    parser.add_argument('--min-size', type=int, default=256, help='smallest generated image side')
+    parser.add_argument('--max-size', type=int, default=1024, help='largest generated image side')
+    parser.add_argument('--input-size', type=int, default=448, help='input size of the model')
+    parser.add_argument('--tags', type=int, default=9083, help='number of labels of the model')
+    parser.add_argument('--batch-size', type=int, default=8, help='batch size of the model')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of the batch loop and the api')
+    parser.add_argument('--output', type=str, default=None, help='json file, stdout by default')
+    args = parser.parse_args()
+
+    headless.install(['--use-cpu', 'all'])
+    install_ui_modules()
+
+    from PIL import Image
+
+    from tagger import dbimutils, preprocess, utils, ui
+    from tagger import api_models as models
+    from tagger.api import Api
+    from tagger.interrogator import Interrogator, WaifuDiffusionInterrogator
+
+    with tempfile.TemporaryDirectory() as temp:
+        temp = Path(temp)
+        model_path = temp.joinpath('model.onnx')
+        tags_path = temp.joinpath('selected_tags.csv')
+        input_dir = temp.joinpath('input')
+        output_dir = temp.joinpath('output')
+        input_dir.mkdir()
+
+        build_model(model_path, args.input_size, args.tags)
+        build_tags(tags_path, args.tags)
+        paths = build_images(input_dir, args.images, args.min_size, args.max_size)
+
+        class LocalInterrogator(WaifuDiffusionInterrogator):
+            def download(self):
+                return model_path, tags_path
+
+        interrogator = LocalInterrogator('benchmark', repo_id='local')
+        utils.interrogators = {'benchmark': interrogator}
+
+        images = [Image.open(p).convert('RGBA') for p in paths]
+        stages = {}
+
+        # everything the code under test prints goes to stderr
+        with redirect_stdout(sys.stderr):
+            interrogator.warm_up()
+            size = interrogator.input_size
+
+            stages['fill_transparent'] = measure(
+                [lambda i=i: preprocess.fill_transparent(i) for i in images],
+                1
+            )
+
+            bgr_images = [
+                np.asarray(preprocess.fill_transparent(i))[:, :, ::-1]
+                for i in images
+            ]
+
+            stages['make_square'] = measure(
+                [lambda i=i: dbimutils.make_square(i, size) for i in bgr_images],
+                1
+            )
+
+            squares = [dbimutils.make_square(i, size) for i in bgr_images]
+
+            stages['smart_resize'] = measure(
+                [lambda i=i: dbimutils.smart_resize(i, size) for i in squares],
+                1
+            )
+
+            # the three stages above in one pass, into a preallocated buffer
+            tensor = np.empty((size, size, 3), dtype=np.float32)
+            stages['wd14_preprocess'] = measure(
+                [lambda i=i: dbimutils.wd14_preprocess(i, size, tensor) for i in images],
+                1
+            )
+
+            stages['preprocess'] = measure(
+                [lambda i=i: interrogator.preprocess(i) for i in images],
+                1
+            )
+
+            tensors = [interrogator.preprocess(i) for i in images]
+
+            for batch_size in sorted({1, args.batch_size}):
+                batches = [
+                    tensors[offset:offset + batch_size]
+                    for offset in range(0, len(tensors), batch_size)
+                ]
+
+                latencies = []
+                for batch in batches:
+                    start = time.perf_counter()
+                    interrogator.evaluate(batch, batch_size, raw=True)
+                    latencies.append(time.perf_counter() - start)
+
+                stages[f'inference_batch_{batch_size}'] = summarize(
+                    latencies,
+                    len(tensors)
+                )
+
+            results = interrogator.evaluate(tensors, args.batch_size)
+            postprocess_opts = (0.35, [], [], False, False, True, ['0_0', '^_^'], True)
+
+            stages['postprocess_tags'] = measure(
+                [
+                    lambda t=t: Interrogator.postprocess_tags(dict(t), *postprocess_opts)
+                    for _, t in results
+                ],
+                1
+            )
+
+            confidents = [
+                interrogator.split(c)[1]
+                for c in interrogator.evaluate(tensors, args.batch_size, raw=True)
+            ]
+
+            stages['postprocess'] = measure(
+                [lambda c=c: interrogator.postprocess(c, *postprocess_opts) for c in confidents],
+                1
+            )
+
+            def batch_loop():
+                ui.on_interrogate(
+                    None,
+                    str(input_dir), False, '', '', str(output_dir),
+                    '[name].[output_extension]', 'copy', False, False, False,
+                    args.batch_size, 2, 1, 32, 0,
+                    'benchmark', *postprocess_opts[:1], '', '', False, False,
+                    True, '0_0, ^_^', True,
+                    False, False
+                )
+
+            stages['ui_batch_loop'] = measure(
+                [batch_loop] * args.repeat,
+                len(paths)
+            )
+
+            from fastapi import FastAPI
+            from threading import Lock
+
+            api = Api(FastAPI(), Lock(), '/tagger/v1')
+            encoded = []
+            for path in paths:
+                encoded.append(base64.b64encode(path.read_bytes()).decode())
+
+            def request(image: str):
+                return api.endpoint_interrogate(models.TaggerInterrogateRequest(
+                    image=image,
+                    model='benchmark',
+                    replace_underscore=True,
+                    escape_tag=True
+                ))
+
+            async def sequential():
+                latencies = []
+                for image in encoded:
+                    start = time.perf_counter()
+                    await request(image)
+                    latencies.append(time.perf_counter() - start)
+                return latencies
+
+            async def concurrent():
+                # requests are coalesced into batches by the scheduler
+                async def timed(image):
+                    start = time.perf_counter()
+                    await request(image)
+                    return time.perf_counter() - start
+
+                start = time.perf_counter()
+                latencies = await asyncio.gather(*[timed(i) for i in encoded])
+                return latencies, time.perf_counter() - start
+
+            latencies = []
+            for _ in range(args.repeat):
+                latencies += asyncio.run(sequential())
+            stages['api_interrogate'] = summarize(latencies, len(latencies))
+
+            latencies = []
+            elapsed = 0.0
+            for _ in range(args.repeat):
+                run_latencies, run_elapsed = asyncio.run(concurrent())
+                latencies += run_latencies
+                elapsed += run_elapsed
+
+            stages['api_interrogate_concurrent'] = {
+                **summarize(latencies, len(latencies)),
+                # requests overlap, throughput comes from the wall time
+                'images_per_sec': len(latencies) / elapsed
+            }
+
+            for scheduler in api.schedulers.values():
+                scheduler.close()
+
+    import onnxruntime
+
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'numpy': np.__version__,
+            'onnxruntime': onnxruntime.__version__
+        },
+        'config': vars(args),
+        'stages': stages
+    }
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
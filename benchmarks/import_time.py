@@ -0,0 +1,99 @@
+# time spent by the webui importing the tagger on start
+# every run is a fresh interpreter, the packages the webui always imports
+# (fastapi, pydantic, PIL) are imported before the measurement
+#
+#   python benchmarks/import_time.py --runs 5 --output result.json
+
+import sys
+import json
+import subprocess
+import statistics
+
+from argparse import ArgumentParser
+from pathlib import Path
+
+extension_dir = str(Path(__file__).parent.parent)
+
+# packages that should only be imported when a model is used
+heavy_modules = ['cv2', 'pandas', 'huggingface_hub', 'onnxruntime', 'tensorflow']
+
+measure = '''
+import sys
+import json
+import time
+import tempfile
+
+sys.path.insert(0, {extension_dir!r})
+
+from tagger import headless
+headless.install(['--deepdanbooru-projects-path', tempfile.mkdtemp()])
+
+# ui is imported for the tab, none of these are used while importing
+headless.module('gradio')
+headless.module('webui', wrap_gradio_gpu_call=lambda f, **_: f)
+headless.module('modules.ui')
+headless.module('modules.generation_parameters_copypaste')
+
+import fastapi, pydantic, PIL.Image
+
+start = time.perf_counter()
+import tagger.ui
+import tagger.api
+imported = time.perf_counter()
+
+from tagger import utils
+utils.refresh_interrogators()
+refreshed = time.perf_counter()
+
+utils.refresh_interrogators()
+refreshed_again = time.perf_counter()
+
+print(json.dumps({{
+    'import_seconds': imported - start,
+    'refresh_seconds': refreshed - imported,
+    'refresh_again_seconds': refreshed_again - refreshed,
+    'heavy_modules': [m for m in {heavy_modules!r} if m in sys.modules]
+}}))
+'''
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5, help='number of fresh interpreters')
+    parser.add_argument('--output', type=str, default=None, help='json file, stdout by default')
+    args = parser.parse_args()
+
+    code = measure.format(extension_dir=extension_dir, heavy_modules=heavy_modules)
+    runs = []
+
+    for _ in range(args.runs):
+        output = subprocess.run(
+            [sys.executable, '-c', code],
+            check=True,
+            capture_output=True,
+            text=True
+        ).stdout
+
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    report = {
+        'runs': args.runs,
+        **{
+            key: {
+                'median': statistics.median(r[key] for r in runs),
+                'min': min(r[key] for r in runs),
+                'max': max(r[key] for r in runs)
+            }
+            for key in ['import_seconds', 'refresh_seconds', 'refresh_again_seconds']
+        },
+        'heavy_modules': sorted({m for r in runs for m in r['heavy_modules']})
+    }
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
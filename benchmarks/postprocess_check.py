@@ -0,0 +1,96 @@
+# checks the vectorized post-processing gives exactly the same tags, in the
+# same order and with the same confidents, as the dict implementation
+# over randomized names, confidents and options, exits with 1 on a mismatch
+#
+#   python benchmarks/postprocess_check.py --cases 3000
+
+import sys
+import random
+
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from tagger import headless  # noqa: E402
+
+# parts of generated names, with the characters the options replace or escape
+parts = ['a', 'b', 'cat', 'girl', 'o', '_', '(', ')', '\\', ':', '1', '>', '<', '^']
+
+
+def random_name(rng: random.Random) -> str:
+    return ''.join(rng.choice(parts) for _ in range(rng.randint(1, 5)))
+
+
+def random_case(rng: random.Random):
+    names = list(dict.fromkeys(random_name(rng) for _ in range(rng.randint(0, 60))))
+
+    # few distinct values, so that ties in the sort are common
+    levels = rng.choice([None, 4, 10])
+    confidents = np.array([
+        rng.randint(0, levels) / levels if levels else rng.random()
+        for _ in names
+    ], dtype=np.float64)
+
+    def some(candidates):
+        return [rng.choice(candidates) for _ in range(rng.randint(0, 4))] if candidates else []
+
+    # known and unknown names, repeated names too
+    unknown = [random_name(rng) + '_x' for _ in range(3)]
+    options = dict(
+        threshold=rng.choice([0.0, 0.35, 0.5, 1.0, 1.1, rng.random()]),
+        additional_tags=some(names + unknown),
+        exclude_tags=some(names + unknown),
+        sort_by_alphabetical_order=rng.random() < 0.5,
+        add_confident_as_weight=rng.random() < 0.5,
+        replace_underscore=rng.random() < 0.5,
+        replace_underscore_excludes=some(names + unknown),
+        escape_tag=rng.random() < 0.5
+    )
+
+    return names, confidents, options
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument('--cases', type=int, default=3000, help='number of randomized cases')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    headless.install()
+
+    from tagger.interrogator import Interrogator, TagNames
+
+    rng = random.Random(args.seed)
+    mismatches = 0
+
+    for case in range(args.cases):
+        names, confidents, options = random_case(rng)
+
+        expected = Interrogator.postprocess_tags(
+            dict(zip(names, confidents.tolist())),
+            **options
+        )
+        actual = Interrogator.postprocess_confidents(
+            confidents,
+            TagNames(names),
+            **options
+        )
+
+        # dicts compare equal in any order, the order is part of the output
+        if list(expected.items()) != list(actual.items()):
+            mismatches += 1
+
+            if mismatches <= 5:
+                print(f'case {case} differs: {names} {confidents.tolist()} {options}')
+                print(f'  expected {expected}')
+                print(f'  actual   {actual}')
+
+    print(f'{mismatches} mismatch(es) in {args.cases} case(s)')
+    sys.exit(1 if mismatches > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
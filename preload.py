@@ -17,3 +17,126 @@ def preload(parser: ArgumentParser):
         help='Path to directory with DeepDanbooru project(s).',
         default=default_ddp_path
     )
+
+    parser.add_argument(
+        '--tagger-cache-size',
+        type=int,
+        help='Maximum size of the tagger result cache in megabytes.',
+        default=1024
+    )
+
+    parser.add_argument(
+        '--tagger-max-batch',
+        type=int,
+        help='Maximum number of concurrent API requests evaluated by the tagger at once.',
+        default=8
+    )
+
+    parser.add_argument(
+        '--tagger-batch-wait',
+        type=float,
+        help='Milliseconds the tagger waits for more API requests to fill a batch.',
+        default=0
+    )
+
+    parser.add_argument(
+        '--tagger-api-lock',
+        type=str,
+        choices=['webui', 'tagger'],
+        help='Lock held by the tagger API while running a model. '
+        '"webui" waits for image generation, "tagger" only serializes the tagger.',
+        default='webui'
+    )
+
+    parser.add_argument(
+        '--tagger-memory-budget',
+        type=int,
+        help='Approximate memory in megabytes the loaded tagger models may use. '
+        'Least recently used models are unloaded to stay within it, 0 for no limit.',
+        default=0
+    )
+
+    parser.add_argument(
+        '--tagger-preload',
+        type=str,
+        help='Comma separated interrogators to load and warm up in the background on start, '
+        'they are never unloaded to stay within the memory budget.',
+        default=''
+    )
+
+    parser.add_argument(
+        '--tagger-deepdanbooru-subprocess',
+        action='store_true',
+        help='Run DeepDanbooru models on a worker process, so they can be unloaded.',
+        default=False
+    )
+
+    parser.add_argument(
+        '--tagger-intra-op-threads',
+        type=int,
+        help='Threads onnxruntime uses to run a single operator, 0 to let onnxruntime decide.',
+        default=0
+    )
+
+    parser.add_argument(
+        '--tagger-inter-op-threads',
+        type=int,
+        help='Threads onnxruntime uses to run independent operators in parallel execution mode, '
+        '0 to let onnxruntime decide.',
+        default=0
+    )
+
+    parser.add_argument(
+        '--tagger-execution-mode',
+        type=str,
+        choices=['sequential', 'parallel'],
+        help='Whether onnxruntime runs independent operators one by one or in parallel.',
+        default='sequential'
+    )
+
+    parser.add_argument(
+        '--tagger-optimization-level',
+        type=str,
+        choices=['disable', 'basic', 'extended', 'all'],
+        help='Graph optimizations onnxruntime applies when loading a model.',
+        default='all'
+    )
+
+    parser.add_argument(
+        '--tagger-cache-optimized-model',
+        action='store_true',
+        help='Save the optimized onnx model next to the downloaded one and load it on the next start, '
+             'optimizations made for the cpu of the host are applied on every start.',
+        default=False
+    )
+
+    parser.add_argument(
+        '--tagger-quantize',
+        type=str,
+        help='Comma separated quantizations (int8, fp16) registered as variants of every Waifu Diffusion model, '
+        'like wd14-vit-v2-int8. Quantized models are generated from the downloaded ones.',
+        default=''
+    )
+
+    parser.add_argument(
+        '--tagger-mmap-models',
+        action='store_true',
+        help='Memory map the weights of the onnx models instead of copying them, so webui processes '
+        'on the same host running on the cpu share one copy. Weights are exported next to the model once.',
+        default=False
+    )
+
+    parser.add_argument(
+        '--tagger-registry',
+        type=str,
+        help='JSON or YAML file which defines the tagger interrogators and where their model files are, '
+        'interrogators.json next to the presets by default.',
+        default=None
+    )
+
+    parser.add_argument(
+        '--tagger-offline',
+        action='store_true',
+        help='Never download tagger models, only use local files and the huggingface cache.',
+        default=False
+    )
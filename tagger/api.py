@@ -1,15 +1,172 @@
-from typing import Callable
-from threading import Lock
+import json
+import time
+import asyncio
+
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from io import BytesIO
+from queue import Queue, Empty
+from threading import Lock, Thread
+from collections import Counter
+from concurrent.futures import Future
 from secrets import compare_digest
 
 from modules import shared
 from modules.api.api import decode_base64_to_image
 from modules.call_queue import queue_lock
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
+from starlette.concurrency import run_in_threadpool
+from pydantic import ValidationError
+from PIL import Image
+
+import numpy as np
 
 from tagger import utils
 from tagger import api_models as models
+from tagger.cache import hash_image
+from tagger.metrics import metrics
+from tagger.interrogator import Interrogator, manager
+from tagger.utils import split_str
+
+# options of the batch request which can be repeated in a multipart form
+list_options = [
+    'additional_tags',
+    'exclude_tags',
+    'replace_underscore_excludes'
+]
+
+
+def load_image(decode: Callable[[], Image.Image], name: str) -> Image.Image:
+    # images are decoded lazily, a truncated or corrupt upload would only
+    # fail in the middle of the batch, so the pixels are read up front
+    try:
+        image = decode()
+        image.load()
+        return image
+    except (HTTPException, OSError, ValueError, Image.DecompressionBombError) as error:
+        # webui raises its own error for invalid base64
+        detail = error.detail if isinstance(error, HTTPException) else error
+        raise HTTPException(400, f'Invalid image {name}: {detail}')
+
+
+# coalesces concurrent requests for the same model into a single model run
+# a batch starts with the oldest waiting request and collects more requests
+# until it is full or the wait window is over
+class Scheduler:
+    def __init__(
+        self,
+        interrogator: Interrogator,
+        queue_lock: Lock,
+        max_batch: int,
+        max_wait: float
+    ) -> None:
+        self.interrogator = interrogator
+        self.queue_lock = queue_lock
+        self.max_batch = max(max_batch, 1)
+        self.max_wait = max(max_wait, 0)
+
+        self.requests: Queue = Queue()
+
+        self.max_queue_depth = 0
+        self.batches = 0
+        self.images = 0
+        self.batch_sizes = Counter()
+
+        Thread(target=self.run, daemon=True).start()
+
+    def prepare(self, image: Image.Image) -> np.ndarray:
+        # preprocessed on the request thread, only the model call is batched
+        return self.interrogator.preprocess(image)
+
+    def submit(self, tensor: np.ndarray) -> Future:
+        future = Future()
+        self.requests.put((tensor, future))
+        self.max_queue_depth = max(self.max_queue_depth, self.requests.qsize())
+
+        return future
+
+    def interrogate(self, image: Image.Image) -> np.ndarray:
+        return self.submit(self.prepare(image)).result()
+
+    def run(self) -> None:
+        while True:
+            item = self.requests.get()
+
+            # closed by the api
+            if item is None:
+                break
+
+            items = []
+            self.take(item, items)
+            deadline = time.monotonic() + self.max_wait
+
+            while len(items) < self.max_batch:
+                try:
+                    timeout = deadline - time.monotonic()
+                    if timeout > 0:
+                        item = self.requests.get(timeout=timeout)
+                    else:
+                        item = self.requests.get_nowait()
+                except Empty:
+                    break
+
+                # finish the current batch before closing
+                if item is None:
+                    self.requests.put(None)
+                    break
+
+                self.take(item, items)
+
+            if len(items) < 1:
+                continue
+
+            # one failing batch must not stop the thread, or every later
+            # request of the model would wait forever
+            try:
+                self.evaluate(items)
+            except Exception as error:
+                print(f'Failed to run a batch of {self.interrogator.name}: {error}')
+
+    @staticmethod
+    def take(item: Tuple[np.ndarray, Future], items: List[Tuple[np.ndarray, Future]]) -> None:
+        # requests whose client has gone away are cancelled while queued
+        _, future = item
+        if future.set_running_or_notify_cancel():
+            items.append(item)
+
+    def evaluate(self, items: List[Tuple[np.ndarray, Future]]) -> None:
+        try:
+            with self.queue_lock:
+                outputs = self.interrogator.evaluate(
+                    [tensor for tensor, _ in items],
+                    len(items),
+                    raw=True
+                )
+
+            for (_, future), output in zip(items, outputs):
+                if not future.done():
+                    future.set_result(output)
+        except Exception as error:
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(error)
+
+        self.batches += 1
+        self.images += len(items)
+        self.batch_sizes[len(items)] += 1
+
+    def close(self) -> None:
+        self.requests.put(None)
+
+    def status(self) -> models.SchedulerStatus:
+        return models.SchedulerStatus(
+            queue_depth=self.requests.qsize(),
+            max_queue_depth=self.max_queue_depth,
+            batches=self.batches,
+            images=self.images,
+            batch_sizes=dict(self.batch_sizes)
+        )
 
 
 class Api:
@@ -24,6 +181,12 @@ class Api:
         self.queue_lock = queue_lock
         self.prefix = prefix
 
+        self.schedulers: Dict[str, Scheduler] = {}
+        self.schedulers_lock = Lock()
+
+        # state of the models preloaded on start
+        self.readiness: Dict[str, str] = {}
+
         self.add_api_route(
             'interrogate',
             self.endpoint_interrogate,
@@ -31,6 +194,25 @@ class Api:
             response_model=models.TaggerInterrogateResponse
         )
 
+        self.add_api_route(
+            'interrogate/batch',
+            self.endpoint_interrogate_batch,
+            methods=['POST'],
+            response_model=models.TaggerInterrogateBatchResponse,
+            openapi_extra={
+                'requestBody': {
+                    'content': {
+                        'application/json': {
+                            'schema': models.TaggerInterrogateBatchRequest.schema()
+                        },
+                        'multipart/form-data': {
+                            'schema': models.TaggerInterrogateBatchRequest.schema()
+                        }
+                    }
+                }
+            }
+        )
+
         self.add_api_route(
             'interrogators',
             self.endpoint_interrogators,
@@ -38,6 +220,34 @@ class Api:
             response_model=models.InterrogatorsResponse
         )
 
+        self.add_api_route(
+            'models',
+            self.endpoint_models,
+            methods=['GET'],
+            response_model=models.ModelsResponse
+        )
+
+        self.add_api_route(
+            'health',
+            self.endpoint_health,
+            methods=['GET'],
+            response_model=models.HealthResponse
+        )
+
+        self.add_api_route(
+            'scheduler',
+            self.endpoint_scheduler,
+            methods=['GET'],
+            response_model=models.SchedulerResponse
+        )
+
+        self.add_api_route(
+            'metrics',
+            self.endpoint_metrics,
+            methods=['GET'],
+            response_class=PlainTextResponse
+        )
+
     def auth(self, creds: HTTPBasicCredentials = Depends(HTTPBasic())):
         if creds.username in self.credentials:
             if compare_digest(creds.password, self.credentials[creds.username]):
@@ -58,33 +268,327 @@ class Api:
             return self.app.add_api_route(path, endpoint, dependencies=[Depends(self.auth)], **kwargs)
         return self.app.add_api_route(path, endpoint, **kwargs)
 
-    def endpoint_interrogate(self, req: models.TaggerInterrogateRequest):
+    def preload(self, names: List[str]) -> None:
+        # models are loaded one by one so that the start is not slowed down more
+        # and are kept loaded, health would fail once one has been evicted
+        for name in names:
+            self.readiness[name] = 'pending'
+            manager.pin(name)
+
+        def run():
+            for name in names:
+                if name not in utils.interrogators:
+                    self.readiness[name] = 'failed: not found'
+                    continue
+
+                self.readiness[name] = 'loading'
+
+                try:
+                    utils.interrogators[name].warm_up()
+                    self.readiness[name] = 'ready'
+                except Exception as error:
+                    self.readiness[name] = f'failed: {error}'
+                    print(f'Failed to preload {name}: {error}')
+
+        Thread(target=run, daemon=True).start()
+
+    def scheduler(self, model: str) -> Scheduler:
+        with self.schedulers_lock:
+            scheduler = self.schedulers.get(model)
+
+            # interrogators are recreated when the list is refreshed
+            if scheduler is not None and scheduler.interrogator is not utils.interrogators[model]:
+                scheduler.close()
+                scheduler = None
+
+            if scheduler is None:
+                self.schedulers[model] = Scheduler(
+                    utils.interrogators[model],
+                    self.queue_lock,
+                    getattr(shared.cmd_opts, 'tagger_max_batch', 8),
+                    getattr(shared.cmd_opts, 'tagger_batch_wait', 0) / 1000
+                )
+
+            return self.schedulers[model]
+
+    async def endpoint_interrogate(self, req: models.TaggerInterrogateRequest):
         if req.image is None:
             raise HTTPException(404, 'Image not found')
 
         if req.model not in utils.interrogators.keys():
             raise HTTPException(404, 'Model not found')
 
-        image = decode_base64_to_image(req.image)
         interrogator = utils.interrogators[req.model]
+        scheduler = self.scheduler(req.model)
+
+        # decoding, hashing and preprocessing run on the thread pool
+        # without holding the lock, only the model call is serialized
+        def prepare():
+            image = load_image(lambda: decode_base64_to_image(req.image), 'image')
+            digest = hash_image(image) if req.cache else None
+
+            if digest is not None:
+                cached = utils.cache.get(digest, interrogator.cache_key)
+                if cached is not None:
+                    return digest, cached, None
+
+            return digest, None, scheduler.prepare(image)
+
+        digest, cached, tensor = await run_in_threadpool(prepare)
+
+        if tensor is not None:
+            output = await asyncio.wrap_future(scheduler.submit(tensor))
+
+        def finish():
+            if cached is not None:
+                ratings, tags = cached
+            elif digest is not None:
+                ratings, tags = interrogator.to_dicts(output)
+                utils.cache.put(digest, interrogator.cache_key, ratings, tags)
+            else:
+                # raw output skips building the dictionary of every tag
+                ratings, tags = interrogator.split(output)
+
+            return models.TaggerInterrogateResponse(
+                caption={
+                    **ratings,
+                    **interrogator.postprocess(
+                        tags,
+                        **req.postprocess_options()
+                    )
+                })
+
+        return await run_in_threadpool(finish)
+
+    def interrogate_images(
+        self,
+        interrogator: Interrogator,
+        images: List[Image.Image],
+        req: models.TaggerInterrogateBatchRequest
+    ) -> Iterator[Tuple[int, Optional[Dict[str, float]], Optional[str]]]:
+        # yields (index, caption, error) as soon as each batch finishes,
+        # an image which cannot be prepared has the error instead of a caption
+        for offset in range(0, len(images), req.batch_size):
+            indices = range(offset, min(offset + req.batch_size, len(images)))
+            results = {}
+            errors = {}
+            digests = {}
+            tensors = {}
+
+            for index in indices:
+                try:
+                    if req.cache:
+                        digests[index] = hash_image(images[index])
+                        cached = utils.cache.get(
+                            digests[index],
+                            interrogator.cache_key
+                        )
 
-        with self.queue_lock:
-            ratings, tags = interrogator.interrogate(image)
+                        if cached is not None:
+                            results[index] = cached
+                            continue
 
-        return models.TaggerInterrogateResponse(
-            caption={
-                **ratings,
-                **interrogator.postprocess_tags(
-                    tags,
-                    req.threshold
+                    # only run the model for images which are not cached
+                    tensors[index] = self.scheduler(req.model).prepare(images[index])
+                except Exception as error:
+                    errors[index] = str(error)
+
+            misses = list(tensors.keys())
+
+            if len(misses) > 0:
+                # lock is held only for the model call
+                with self.queue_lock:
+                    outputs = interrogator.evaluate(
+                        list(tensors.values()),
+                        req.batch_size,
+                        raw=not req.cache
+                    )
+
+                for index, output in zip(misses, outputs):
+                    if not req.cache:
+                        results[index] = interrogator.split(output)
+                        continue
+
+                    results[index] = output
+                    utils.cache.put(
+                        digests[index],
+                        interrogator.cache_key,
+                        *output
+                    )
+
+            for index in indices:
+                if index in errors:
+                    yield index, None, errors[index]
+                    continue
+
+                ratings, tags = results[index]
+                yield index, {
+                    **ratings,
+                    **interrogator.postprocess(
+                        tags,
+                        **req.postprocess_options()
+                    )
+                }, None
+
+    async def endpoint_interrogate_batch(self, request: Request):
+        # accepts a json body with base64 images or multipart/form-data uploads
+        if request.headers.get('content-type', '').startswith('multipart/form-data'):
+            form = await request.form()
+            fields = {}
+
+            for key in form.keys():
+                if key == 'images':
+                    continue
+
+                # list options are sent as comma separated values
+                if key in list_options:
+                    fields[key] = [
+                        tag
+                        for value in form.getlist(key)
+                        for tag in split_str(value)
+                    ]
+                else:
+                    fields[key] = form[key]
+
+            try:
+                req = models.TaggerInterrogateBatchRequest.parse_obj(fields)
+            except ValidationError as error:
+                raise HTTPException(422, str(error))
+
+            images = []
+            for index, upload in enumerate(form.getlist('images')):
+                # base64 encoded images are allowed in the form as well
+                if isinstance(upload, str):
+                    images.append(await run_in_threadpool(
+                        load_image,
+                        lambda: decode_base64_to_image(upload),
+                        f'images[{index}]'
+                    ))
+                    continue
+
+                data = await upload.read()
+                images.append(await run_in_threadpool(
+                    load_image,
+                    lambda: Image.open(BytesIO(data)),
+                    f'images[{index}] ({upload.filename})'
+                ))
+        else:
+            try:
+                req = models.TaggerInterrogateBatchRequest.parse_obj(
+                    await request.json()
                 )
-            })
+            except (ValidationError, ValueError) as error:
+                # body which is not json raises JSONDecodeError
+                raise HTTPException(422, str(error))
+
+            images = await run_in_threadpool(
+                lambda: [
+                    load_image(lambda: decode_base64_to_image(image), f'images[{index}]')
+                    for index, image in enumerate(req.images)
+                ]
+            )
+
+        if len(images) < 1:
+            raise HTTPException(404, 'Image not found')
+
+        if req.model not in utils.interrogators.keys():
+            raise HTTPException(404, 'Model not found')
+
+        interrogator = utils.interrogators[req.model]
+        results = self.interrogate_images(interrogator, images, req)
+
+        if req.stream:
+            # sync generator is iterated on the thread pool by starlette
+            return StreamingResponse(
+                (
+                    models.TaggerInterrogateBatchItem(
+                        index=index,
+                        caption=caption,
+                        error=error
+                    ).json(exclude_none=True) + '\n'
+                    for index, caption, error in results
+                ),
+                media_type='application/x-ndjson'
+            )
+
+        captions = {}
+        for index, caption, error in await run_in_threadpool(lambda: list(results)):
+            if error is not None:
+                raise HTTPException(400, f'Invalid image images[{index}]: {error}')
+
+            captions[index] = caption
+
+        return models.TaggerInterrogateBatchResponse(
+            captions=[captions[index] for index in range(len(images))]
+        )
 
     def endpoint_interrogators(self):
         return models.InterrogatorsResponse(
             models=list(utils.interrogators.keys())
         )
 
+    def endpoint_models(self):
+        status = manager.status()
+
+        return models.ModelsResponse(
+            budget=manager.budget,
+            size=manager.total_size(),
+            shared=manager.shared_size(),
+            models=[
+                models.ModelStatus(**state)
+                for state in status
+            ]
+        )
+
+    def endpoint_health(self):
+        readiness = dict(self.readiness)
+
+        # models may have been unloaded since they have been warmed up
+        for name, state in readiness.items():
+            interrogator = utils.interrogators.get(name)
+
+            if state == 'ready' and (interrogator is None or not manager.is_loaded(interrogator)):
+                readiness[name] = 'unloaded'
+
+        response = models.HealthResponse(
+            ready=all(state == 'ready' for state in readiness.values()),
+            models=readiness
+        )
+
+        # load balancers only look at the status code
+        return JSONResponse(
+            json.loads(response.json()),
+            status_code=200 if response.ready else 503
+        )
+
+    def endpoint_scheduler(self):
+        return models.SchedulerResponse(
+            models={
+                model: scheduler.status()
+                for model, scheduler in self.schedulers.items()
+            }
+        )
+
+    def endpoint_metrics(self):
+        # prometheus text exposition format
+        return PlainTextResponse(
+            metrics.render(),
+            media_type='text/plain; version=0.0.4'
+        )
+
 
 def on_app_started(_, app: FastAPI):
-    Api(app, queue_lock, '/tagger/v1')
+    # tagger only deployments do not have to wait for image generation
+    if getattr(shared.cmd_opts, 'tagger_api_lock', 'webui') == 'tagger':
+        api = Api(app, Lock(), '/tagger/v1')
+    else:
+        api = Api(app, queue_lock, '/tagger/v1')
+
+    preload = split_str(getattr(shared.cmd_opts, 'tagger_preload', ''))
+
+    if len(preload) > 0:
+        # interrogators are listed by the ui, which does not exist with --nowebui
+        if len(utils.interrogators) < 1:
+            utils.refresh_interrogators()
+
+        api.preload(preload)
@@ -1,15 +1,10 @@
-from typing import List, Dict
+from typing import List, Dict, Optional
 
 from modules.api import models as sd_models
 from pydantic import BaseModel, Field
 
 
-class TaggerInterrogateRequest(sd_models.InterrogateRequest):
-    model: str = Field(
-        title='Model',
-        description='The interrogate model used.'
-    )
-
+class TaggerPostprocessOptions(BaseModel):
     threshold: float = Field(
         default=0.35,
         title='Threshold',
@@ -18,6 +13,105 @@ class TaggerInterrogateRequest(sd_models.InterrogateRequest):
         le=1
     )
 
+    additional_tags: List[str] = Field(
+        default=[],
+        title='Additional tags',
+        description='Tags added to every result.'
+    )
+
+    exclude_tags: List[str] = Field(
+        default=[],
+        title='Exclude tags',
+        description='Tags removed from every result.'
+    )
+
+    sort_by_alphabetical_order: bool = Field(
+        default=False,
+        title='Sort by alphabetical order',
+        description='Sort tags by name instead of confident.'
+    )
+
+    add_confident_as_weight: bool = Field(
+        default=False,
+        title='Add confident as weight',
+        description='Wrap tags with their confident, like (tag:0.5).'
+    )
+
+    replace_underscore: bool = Field(
+        default=False,
+        title='Replace underscore',
+        description='Use spaces instead of underscore.'
+    )
+
+    replace_underscore_excludes: List[str] = Field(
+        default=[],
+        title='Replace underscore excludes',
+        description='Tags which keep their underscores.'
+    )
+
+    escape_tag: bool = Field(
+        default=False,
+        title='Escape tag',
+        description='Escape brackets in tags.'
+    )
+
+    cache: bool = Field(
+        default=False,
+        title='Cache',
+        description='Reuse and store the model output in the result cache.'
+    )
+
+    def postprocess_options(self) -> Dict[str, object]:
+        return self.dict(
+            include={
+                'threshold',
+                'additional_tags',
+                'exclude_tags',
+                'sort_by_alphabetical_order',
+                'add_confident_as_weight',
+                'replace_underscore',
+                'replace_underscore_excludes',
+                'escape_tag'
+            }
+        )
+
+
+class TaggerInterrogateRequest(
+    sd_models.InterrogateRequest,
+    TaggerPostprocessOptions
+):
+    model: str = Field(
+        title='Model',
+        description='The interrogate model used.'
+    )
+
+
+class TaggerInterrogateBatchRequest(TaggerPostprocessOptions):
+    images: List[str] = Field(
+        default=[],
+        title='Images',
+        description='List of base64 encoded images to interrogate, '
+        'or image files uploaded as multipart/form-data fields.'
+    )
+
+    model: str = Field(
+        title='Model',
+        description='The interrogate model used.'
+    )
+
+    batch_size: int = Field(
+        default=8,
+        title='Batch size',
+        description='Number of images evaluated by the model at once.',
+        ge=1
+    )
+
+    stream: bool = Field(
+        default=False,
+        title='Stream',
+        description='Respond with newline delimited JSON lines as soon as each batch finishes.'
+    )
+
 
 class TaggerInterrogateResponse(BaseModel):
     caption: Dict[str, float] = Field(
@@ -26,8 +120,155 @@ class TaggerInterrogateResponse(BaseModel):
     )
 
 
+class TaggerInterrogateBatchItem(TaggerInterrogateResponse):
+    index: int = Field(
+        title='Index',
+        description='Position of the image in the request.'
+    )
+
+    caption: Optional[Dict[str, float]] = Field(
+        default=None,
+        title='Caption',
+        description='The generated caption for the image, missing when it failed.'
+    )
+
+    error: Optional[str] = Field(
+        default=None,
+        title='Error',
+        description='Why the image could not be interrogated.'
+    )
+
+
+class TaggerInterrogateBatchResponse(BaseModel):
+    captions: List[Dict[str, float]] = Field(
+        title='Captions',
+        description='The generated captions in the same order as the images.'
+    )
+
+
 class InterrogatorsResponse(BaseModel):
     models: List[str] = Field(
         title='Models',
         description=''
     )
+
+
+class SchedulerStatus(BaseModel):
+    queue_depth: int = Field(
+        title='Queue depth',
+        description='Number of requests waiting for the model.'
+    )
+
+    max_queue_depth: int = Field(
+        title='Max queue depth',
+        description='Highest number of waiting requests observed.'
+    )
+
+    batches: int = Field(
+        title='Batches',
+        description='Number of model runs.'
+    )
+
+    images: int = Field(
+        title='Images',
+        description='Number of images evaluated.'
+    )
+
+    batch_sizes: Dict[int, int] = Field(
+        title='Batch sizes',
+        description='Number of model runs for each batch size.'
+    )
+
+
+class SchedulerResponse(BaseModel):
+    models: Dict[str, SchedulerStatus] = Field(
+        title='Models',
+        description='Request scheduler status of each model used by the API.'
+    )
+
+
+class ModelStatus(BaseModel):
+    name: str = Field(
+        title='Name',
+        description='Name of the interrogator.'
+    )
+
+    loaded: bool = Field(
+        title='Loaded',
+        description='Whether the model is in memory.'
+    )
+
+    size: int = Field(
+        title='Size',
+        description='Approximate memory used by the model in bytes.'
+    )
+
+    hits: int = Field(
+        title='Hits',
+        description='Number of uses while the model was already loaded.'
+    )
+
+    loads: int = Field(
+        title='Loads',
+        description='Number of times the model has been loaded.'
+    )
+
+    evictions: int = Field(
+        title='Evictions',
+        description='Number of times the model has been unloaded to stay within the memory budget.'
+    )
+
+    last_used: float = Field(
+        title='Last used',
+        description='Unix time of the last use.'
+    )
+
+    mapped: int = Field(
+        title='Mapped',
+        description='Bytes of the model weights memory mapped from a file, 0 unless --tagger-mmap-models is set.'
+    )
+
+    resident: int = Field(
+        title='Resident',
+        description='Bytes of the mapped weights which are in the memory of this process.'
+    )
+
+    shared: int = Field(
+        title='Shared',
+        description='Bytes of the resident mapped weights accounted to the other processes sharing them, '
+        'the memory this process saves compared to a private copy.'
+    )
+
+
+class ModelsResponse(BaseModel):
+    budget: int = Field(
+        title='Budget',
+        description='Memory budget of the loaded models in bytes, 0 for no limit.'
+    )
+
+    size: int = Field(
+        title='Size',
+        description='Approximate memory used by the loaded models in bytes.'
+    )
+
+    shared: int = Field(
+        title='Shared',
+        description='Resident bytes of the loaded models shared with other processes.'
+    )
+
+    models: List[ModelStatus] = Field(
+        title='Models',
+        description='Models which have been used, most recently used first.'
+    )
+
+
+class HealthResponse(BaseModel):
+    ready: bool = Field(
+        title='Ready',
+        description='Whether every preloaded model is loaded and warmed up.'
+    )
+
+    models: Dict[str, str] = Field(
+        title='Models',
+        description='State of each preloaded model: pending, loading, ready, unloaded or failed.'
+    )
@@ -0,0 +1,395 @@
+import os
+import json
+import time
+
+from typing import List, NamedTuple, Optional, Tuple
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+from PIL import Image
+
+from tagger import format, shard as sharding
+from tagger.cache import ResultCache
+from tagger.interrogator import Interrogator
+from tagger.pipeline import Pipeline
+from tagger.metrics import metrics
+from tagger.manifest import Manifest, options_hash, filename as manifest_filename
+from tagger.discovery import Walker
+
+# batched runs the stages one after another on a single thread,
+# pipelined overlaps decoding and writing with the inference
+modes = ['batched', 'pipelined']
+
+
+class Result(NamedTuple):
+    processed: int
+    skipped: int
+    failed: int
+    discovered: int
+    elapsed: float
+    summary: str
+
+
+def input_paths(
+    input_glob: str,
+    recursive=False,
+    include: List[str] = [],
+    exclude: List[str] = []
+) -> Tuple[str, Walker]:
+    input_glob = input_glob.strip()
+
+    # if there is no glob pattern, insert it automatically
+    if not input_glob.endswith('*'):
+        if not input_glob.endswith(os.sep):
+            input_glob += os.sep
+        input_glob += '*'
+
+    # get root directory of input glob pattern
+    base_dir = input_glob.replace('?', '*')
+    base_dir = base_dir.split(os.sep + '*').pop(0)
+
+    # check the input directory path
+    if not os.path.isdir(base_dir):
+        raise ValueError('input path is not a directory')
+
+    # files are discovered while the batch is running
+    return base_dir, Walker(
+        base_dir,
+        input_glob[len(base_dir) + 1:],
+        recursive,
+        include=include,
+        exclude=exclude
+    )
+
+
+def interrogate_directory(
+    interrogator: Interrogator,
+    postprocess_opts: Tuple,
+
+    input_glob: str,
+    recursive=False,
+    include: List[str] = [],
+    exclude: List[str] = [],
+    output_dir='',
+    output_filename_format='[name].[output_extension]',
+    action_on_conflict='ignore',
+    remove_duplicated_tag=False,
+    save_json=False,
+    use_manifest=False,
+
+    batch_size=1,
+    decode_workers=2,
+    write_workers=1,
+    queue_depth=32,
+    preprocess_processes=0,
+    mode='pipelined',
+
+    cache: Optional[ResultCache] = None,
+    shard: Optional[Tuple[int, int]] = None
+) -> Result:
+    # tags every image matching the glob pattern into a text file
+    # with a shard (index, count), only the images of that shard are tagged
+    # raises ValueError with a message for the user on invalid options
+    if mode not in modes:
+        raise ValueError(f'unknown mode {mode}, use one of {modes}')
+
+    if shard is not None and not 0 <= shard[0] < shard[1]:
+        raise ValueError(f'shard {shard[0]} is not between 0 and {shard[1] - 1}')
+
+    output_dir = output_dir.strip()
+    output_filename_format = output_filename_format.strip()
+
+    base_dir, paths = input_paths(input_glob, recursive, include, exclude)
+    manifest_dir = Path(output_dir) if output_dir else Path(base_dir)
+
+    progress_lock = Lock()
+    progress_time = time.perf_counter()
+    processed = 0
+    unreadable = 0
+
+    # skips the images tagged by a previous run with the same settings
+    manifest = None
+    manifest_options = None
+    skipped = 0
+
+    # shards record what they have done, so the merge can check it
+    if use_manifest or shard is not None:
+        manifest = Manifest(
+            manifest_dir,
+            base_dir,
+            name=manifest_filename if shard is None else sharding.manifest_name(*shard)
+        )
+        manifest_options = options_hash(
+            postprocess_opts,
+            output_filename_format,
+            action_on_conflict,
+            remove_duplicated_tag,
+            save_json
+        )
+
+    pipeline = Pipeline(
+        interrogator,
+        batch_size,
+        decode_workers,
+        write_workers,
+        queue_depth,
+        preprocess_processes if mode == 'pipelined' else 0,
+        cache
+    )
+
+    def file_hash(path, stat):
+        # files hashed by a previous run are not read again
+        if manifest is not None:
+            return manifest.digest(
+                path,
+                stat,
+                lambda: format.hash(format.Info(path, 'txt'))
+            )
+
+        return format.hash(format.Info(path, 'txt'))
+
+    def jobs():
+        nonlocal error_message, skipped
+
+        for path in paths:
+            stat = None
+
+            if shard is not None:
+                relative = path.relative_to(base_dir).as_posix()
+
+                if sharding.shard_of(relative, shard[1]) != shard[0]:
+                    continue
+
+            if manifest is not None:
+                stat = path.stat()
+
+                if manifest.unchanged(
+                    path,
+                    stat,
+                    interrogator.cache_key,
+                    manifest_options,
+                    lambda: format.hash(format.Info(path, 'txt'))
+                ):
+                    skipped += 1
+                    continue
+
+            # guess the output path
+            base_dir_last = Path(base_dir).parts[-1]
+            base_dir_last_idx = path.parts.index(base_dir_last)
+            output_parent = Path(output_dir) if output_dir else Path(base_dir)
+            output_parent = output_parent.joinpath(
+                *path.parts[base_dir_last_idx + 1:]).parent
+
+            output_parent.mkdir(0o777, True, True)
+
+            # format output filename
+            format_info = format.Info(path, 'txt')
+
+            try:
+                formatted_output_filename = format.pattern.sub(
+                    lambda m: format.format(m, format_info),
+                    output_filename_format
+                )
+            except (TypeError, ValueError) as error:
+                error_message = str(error)
+                return
+
+            output_path = output_parent.joinpath(
+                formatted_output_filename
+            )
+
+            output = []
+
+            if output_path.is_file():
+                output.append(
+                    output_path.read_text(errors='ignore').strip()
+                )
+
+                if action_on_conflict == 'ignore':
+                    print(f'skipping {path}')
+
+                    # existing caption is what this setting asks for
+                    if manifest is not None:
+                        manifest.record(
+                            path,
+                            stat,
+                            file_hash(path, stat),
+                            interrogator.cache_key,
+                            manifest_options,
+                            output_path
+                        )
+
+                    continue
+
+            yield path, output_path, output, stat
+
+    def digest(job):
+        path, _, _, stat = job
+        return file_hash(path, stat)
+
+    def decode(job):
+        path, _, _, _ = job
+
+        # the file is opened by the preprocessing process
+        if pipeline.processes > 0:
+            return path
+
+        try:
+            # decode now, so the time is not counted as preprocessing
+            image = Image.open(path)
+            image.load()
+            return image
+        except OSError:
+            # just in case, user has mysterious or broken file...
+            print(f'{path} is not supported image type')
+
+    def failed(job):
+        nonlocal unreadable
+        path, _, _, stat = job
+
+        with progress_lock:
+            unreadable += 1
+
+        # shards are merged only when every image has been seen
+        if manifest is not None:
+            manifest.failed(
+                path,
+                stat,
+                interrogator.cache_key,
+                manifest_options
+            )
+
+    def write(job, ratings, tags):
+        nonlocal processed, progress_time
+        path, output_path, output, stat = job
+
+        processed_tags = interrogator.postprocess(
+            tags,
+            *postprocess_opts
+        )
+
+        # TODO: switch for less print
+        print(
+            f'found {len(processed_tags)} tags out of {len(tags)} from {path}'
+        )
+
+        plain_tags = ', '.join(processed_tags)
+
+        with metrics.timer('write', interrogator.name):
+            if action_on_conflict == 'copy':
+                output = [plain_tags]
+            elif action_on_conflict == 'prepend':
+                output.insert(0, plain_tags)
+            else:
+                output.append(plain_tags)
+
+            if remove_duplicated_tag:
+                output_path.write_text(
+                    ', '.join(
+                        OrderedDict.fromkeys(
+                            map(str.strip, ','.join(output).split(','))
+                        )
+                    ),
+                    encoding='utf-8'
+                )
+            else:
+                output_path.write_text(
+                    ', '.join(output),
+                    encoding='utf-8'
+                )
+
+            if save_json:
+                output_path.with_suffix('.json').write_text(
+                    json.dumps([ratings, tags])
+                )
+
+        if manifest is not None:
+            manifest.record(
+                path,
+                stat,
+                digest(job),
+                interrogator.cache_key,
+                manifest_options,
+                output_path
+            )
+
+        with progress_lock:
+            processed += 1
+
+            if time.perf_counter() - progress_time > 10:
+                progress_time = time.perf_counter()
+                print(f'processed {processed} of {paths.discovered} discovered image(s)')
+
+    error_message = None
+
+    totals = metrics.totals(interrogator.name)
+    start = time.perf_counter()
+
+    try:
+        if mode == 'batched':
+            pipeline.run_batched(jobs(), decode, write, digest, failed)
+        else:
+            pipeline.run(jobs(), decode, write, digest, failed)
+    finally:
+        if manifest is not None:
+            manifest.close()
+
+        if cache is not None:
+            cache.commit()
+
+    elapsed = time.perf_counter() - start
+
+    if error_message is not None:
+        raise ValueError(error_message)
+
+    # stage times are summed over the worker threads
+    print(f'found {paths.discovered} image(s)')
+
+    summary = (
+        f'{processed} image(s) in {elapsed:.2f}s '
+        f'({processed / max(elapsed, 1e-9):.1f} images/s)'
+    )
+
+    stages = metrics.summary(totals, metrics.totals(interrogator.name))
+    if stages:
+        summary += f': {stages}'
+
+    if skipped > 0:
+        summary += f', skipped {skipped} unchanged image(s)'
+
+    if unreadable > 0:
+        summary += f', {unreadable} image(s) could not be read'
+
+    if shard is not None:
+        sharding.write_summary(
+            manifest_dir,
+            *shard,
+            interrogator.cache_key,
+            manifest_options,
+            processed,
+            skipped,
+            paths.discovered,
+            elapsed
+        )
+
+        summary = f'shard {shard[0]} of {shard[1]}: {summary}'
+
+    print(summary)
+    print('all done :)')
+
+    return Result(processed, skipped, unreadable, paths.discovered, elapsed, summary)
+
+
+def merge_shards(
+    input_glob: str,
+    count: int,
+    recursive=False,
+    include: List[str] = [],
+    exclude: List[str] = [],
+    output_dir=''
+) -> sharding.MergeResult:
+    # same images as the shards have been given
+    base_dir, paths = input_paths(input_glob, recursive, include, exclude)
+    manifest_dir = Path(output_dir.strip()) if output_dir.strip() else Path(base_dir)
+
+    return sharding.merge(paths, base_dir, manifest_dir, count)
@@ -0,0 +1,278 @@
+import json
+import time
+import sqlite3
+import hashlib
+
+import numpy as np
+
+from typing import Dict, Optional, Tuple
+from pathlib import Path
+from threading import Lock
+from PIL import Image
+
+
+def hash_image(image: Image.Image, algo='sha1') -> str:
+    # for images without a source file (single process, api)
+    hash = hashlib.new(algo)
+    hash.update(f'{image.mode}:{image.size}'.encode())
+    hash.update(image.tobytes())
+
+    return hash.hexdigest()
+
+
+# stores raw rating and tag confidents keyed by
+# (content hash, interrogator), so changing post-processing options
+# does not require to run the model again
+class ResultCache:
+    path: Path
+    max_size: int
+
+    def __init__(
+        self,
+        path: Path,
+        max_size: int,
+        commit_interval=256,
+        commit_seconds=5.0
+    ) -> None:
+        self.path = Path(path)
+        self.max_size = max_size
+        self.lock = Lock()
+        self.connection: Optional[sqlite3.Connection] = None
+
+        # label names are stored once for each interrogator
+        # and their hash is compared instead of the names on every result
+        self.labels: Dict[str, Tuple[list, list]] = {}
+        self.label_hashes: Dict[str, int] = {}
+        self.size = 0
+
+        # every decoder thread goes through the lock, so changes are
+        # committed together instead of syncing the disk for each image
+        self.commit_interval = commit_interval
+        self.commit_seconds = commit_seconds
+        self.pending = 0
+        self.committed = time.time()
+
+        # (hash, interrogator) -> time of the last hit, written on commit
+        self.accessed: Dict[Tuple[str, str], float] = {}
+
+    def connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            self.path.parent.mkdir(0o777, True, True)
+
+            self.connection = sqlite3.connect(
+                self.path,
+                check_same_thread=False
+            )
+            self.connection.executescript('''
+                PRAGMA journal_mode = WAL;
+                PRAGMA synchronous = NORMAL;
+                CREATE TABLE IF NOT EXISTS labels (
+                    interrogator TEXT PRIMARY KEY,
+                    ratings TEXT NOT NULL,
+                    tags TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS results (
+                    hash TEXT NOT NULL,
+                    interrogator TEXT NOT NULL,
+                    ratings BLOB NOT NULL,
+                    tags BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    accessed REAL NOT NULL,
+                    PRIMARY KEY (hash, interrogator)
+                );
+                CREATE INDEX IF NOT EXISTS results_accessed
+                    ON results (accessed);
+            ''')
+
+            for interrogator, ratings, tags in self.connection.execute(
+                'SELECT interrogator, ratings, tags FROM labels'
+            ):
+                self.labels[interrogator] = (
+                    json.loads(ratings),
+                    json.loads(tags)
+                )
+
+            self.size = self.connection.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM results'
+            ).fetchone()[0]
+
+        return self.connection
+
+    def get(
+        self,
+        digest: str,
+        interrogator: str
+    ) -> Optional[Tuple[Dict[str, float], Dict[str, float]]]:
+        with self.lock:
+            connection = self.connect()
+
+            if interrogator not in self.labels:
+                return None
+
+            row = connection.execute(
+                'SELECT ratings, tags FROM results '
+                'WHERE hash = ? AND interrogator = ?',
+                (digest, interrogator)
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            self.accessed[(digest, interrogator)] = time.time()
+            self.changed()
+
+        rating_names, tag_names = self.labels[interrogator]
+
+        return (
+            dict(zip(rating_names, np.frombuffer(row[0], np.float32).tolist())),
+            dict(zip(tag_names, np.frombuffer(row[1], np.float32).tolist()))
+        )
+
+    def put(
+        self,
+        digest: str,
+        interrogator: str,
+        ratings: Dict[str, float],
+        tags: Dict[str, float]
+    ) -> None:
+        label_hash = hash((tuple(ratings), tuple(tags)))
+        rating_blob = np.fromiter(ratings.values(), np.float32, len(ratings)).tobytes()
+        tag_blob = np.fromiter(tags.values(), np.float32, len(tags)).tobytes()
+        size = len(rating_blob) + len(tag_blob)
+
+        if size > self.max_size:
+            return
+
+        with self.lock:
+            connection = self.connect()
+
+            if self.label_hashes.get(interrogator) != label_hash:
+                labels = (list(ratings), list(tags))
+
+                # model has been changed, previous results are not usable anymore
+                if self.labels.get(interrogator) != labels:
+                    self.remove(interrogator)
+                    connection.execute(
+                        'REPLACE INTO labels VALUES (?, ?, ?)',
+                        (interrogator, json.dumps(labels[0]), json.dumps(labels[1]))
+                    )
+                    self.labels[interrogator] = labels
+
+                self.label_hashes[interrogator] = label_hash
+
+            previous = connection.execute(
+                'SELECT size FROM results WHERE hash = ? AND interrogator = ?',
+                (digest, interrogator)
+            ).fetchone()
+
+            connection.execute(
+                'REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                (digest, interrogator, rating_blob, tag_blob, size, time.time())
+            )
+            self.size += size - (previous[0] if previous else 0)
+
+            self.evict()
+            self.changed()
+
+    def changed(self) -> None:
+        # called with the lock held
+        self.pending += 1
+
+        if (
+            self.pending >= self.commit_interval
+            or time.time() - self.committed >= self.commit_seconds
+        ):
+            self.flush()
+
+    def flush(self) -> None:
+        # called with the lock held
+        if self.connection is None:
+            return
+
+        self.write_accessed()
+        self.connection.commit()
+        self.pending = 0
+        self.committed = time.time()
+
+    def commit(self) -> None:
+        # at the end of a batch and when the process exits
+        with self.lock:
+            self.flush()
+
+    def write_accessed(self) -> None:
+        if len(self.accessed) > 0:
+            self.connection.executemany(
+                'UPDATE results SET accessed = ? '
+                'WHERE hash = ? AND interrogator = ?',
+                [(accessed, *key) for key, accessed in self.accessed.items()]
+            )
+            self.accessed.clear()
+
+    def remove(self, interrogator: str) -> None:
+        self.connection.execute(
+            'DELETE FROM results WHERE interrogator = ?',
+            (interrogator,)
+        )
+        self.size = self.connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM results'
+        ).fetchone()[0]
+
+    def evict(self) -> None:
+        # remove least recently used results until the cache fits
+        if self.size > self.max_size:
+            self.write_accessed()
+
+        while self.size > self.max_size:
+            rows = self.connection.execute(
+                'SELECT hash, interrogator, size FROM results '
+                'ORDER BY accessed LIMIT 64'
+            ).fetchall()
+
+            if len(rows) < 1:
+                self.size = 0
+                break
+
+            for digest, interrogator, size in rows:
+                self.connection.execute(
+                    'DELETE FROM results WHERE hash = ? AND interrogator = ?',
+                    (digest, interrogator)
+                )
+                self.size -= size
+
+                if self.size <= self.max_size:
+                    break
+
+    def interrogate(
+        self,
+        interrogator,
+        image: Image.Image
+    ) -> Tuple[Dict[str, float], Dict[str, float]]:
+        digest = hash_image(image)
+        cached = self.get(digest, interrogator.cache_key)
+
+        if cached is None:
+            cached = interrogator.interrogate(image)
+            self.put(digest, interrogator.cache_key, *cached)
+
+        return cached
+
+    def clear(self) -> int:
+        with self.lock:
+            connection = self.connect()
+
+            count = connection.execute(
+                'SELECT COUNT(*) FROM results'
+            ).fetchone()[0]
+
+            connection.execute('DELETE FROM results')
+            connection.execute('DELETE FROM labels')
+            connection.commit()
+            connection.execute('VACUUM')
+
+            self.labels.clear()
+            self.label_hashes.clear()
+            self.accessed.clear()
+            self.pending = 0
+            self.size = 0
+
+        return count
@@ -0,0 +1,390 @@
+# tags a directory of images from the command line, without the webui
+#
+#   python -m tagger.cli /path/to/images --interrogator wd14-vit-v2 --batch-size 8
+#   python -m tagger.cli '/path/to/images/**/*.png' --recursive --preset default.json
+#
+# large batches can be split between processes or hosts sharing the files,
+# every image belongs to one of the shards by the hash of its path
+#
+#   python -m tagger.cli /path/to/images --shards 4              # 4 local processes
+#   python -m tagger.cli /path/to/images --shards 4 --shard 0    # one shard, on each host
+#   python -m tagger.cli /path/to/images --shards 4 --merge      # check and merge the shards
+#
+# --preprocess-processes decodes the images on spawned worker processes, they
+# import the tagger only and never the __main__ module of the caller, so a
+# script calling tagger.batch does not need an if __name__ == '__main__' guard
+#
+# a quantized variant is compared with its model over sample images,
+# without writing anything
+#
+#   python -m tagger.cli /path/to/images -m wd14-vit-v2 --compare wd14-vit-v2-int8 --limit 100
+#
+# options given on the command line override the preset, which overrides
+# the defaults of the tagger tab; the tagger options of the webui can be
+# given too, like --use-cpu all or --tagger-offline
+
+import os
+import sys
+import json
+import time
+import subprocess
+
+from typing import Dict, Iterator, List, Optional, TYPE_CHECKING
+from itertools import islice
+from argparse import ArgumentParser, BooleanOptionalAction, Namespace
+from contextlib import redirect_stdout
+from pathlib import Path
+
+from tagger import headless
+
+if TYPE_CHECKING:
+    from PIL import Image
+    from tagger.shard import MergeResult
+
+# option -> path of the component in the presets and default value in the tab
+options = {
+    'recursive': ('Batch from directory/Use recursive with glob pattern', False),
+    'include': ('Batch from directory/Include patterns', ''),
+    'exclude': ('Batch from directory/Exclude patterns', ''),
+    'output_dir': ('Batch from directory/Output directory', ''),
+    'output_filename_format': ('Batch from directory/Output filename format', '[name].[output_extension]'),
+    'action_on_conflict': ('Batch from directory/Action on existing caption', 'ignore'),
+    'remove_duplicated_tag': ('Batch from directory/Remove duplicated tag', False),
+    'use_manifest': ('Batch from directory/Skip images tagged by a previous run with the same settings', False),
+    'save_json': ('Batch from directory/Save with JSON', False),
+    'batch_size': ('Batch from directory/Batch size', 1),
+    'decode_workers': ('Batch from directory/Pipeline/Decode workers', 2),
+    'write_workers': ('Batch from directory/Pipeline/Write workers', 1),
+    'queue_depth': ('Batch from directory/Pipeline/Queue depth', 32),
+    'preprocess_processes': ('Batch from directory/Pipeline/Preprocess processes (0 to use threads)', 0),
+    'interrogator': ('Interrogator', None),
+    'use_cache': ('Use result cache', False),
+    'threshold': ('Threshold', 0.35),
+    'additional_tags': ('Additional tags (split by comma)', ''),
+    'exclude_tags': ('Exclude tags (split by comma)', ''),
+    'sort_by_alphabetical_order': ('Sort by alphabetical order', False),
+    'add_confident_as_weight': ('Include confident of tags matches in results', False),
+    'replace_underscore': ('Use spaces instead of underscore', True),
+    'replace_underscore_excludes': (
+        'Excudes (split by comma)',
+        '0_0, (o)_(o), +_+, +_-, ._., <o>_<o>, <|>_<|>, =_=, >_<, 3_3, 6_9, >_o, @_@, ^_^, o_o, u_u, x_x, |_|, ||_||'
+    ),
+    'escape_tag': ('Escape brackets', False)
+}
+
+
+def preset_value(values: Dict[str, Dict[str, object]], path: str, default: object) -> object:
+    config = values.get(path)
+
+    # components may be nested differently in other gradio versions
+    if config is None:
+        label = path.split('/')[-1]
+        config = next(
+            (c for p, c in values.items() if p.split('/')[-1] == label),
+            {}
+        )
+
+    return config.get('value', default)
+
+
+def parse_args(argv: List[str]) -> Namespace:
+    # models path is needed by the webui stand-ins, which add their options
+    pre_parser = ArgumentParser(add_help=False)
+    pre_parser.add_argument('--models-path', type=str)
+    models_path = pre_parser.parse_known_args(argv)[0].models_path
+
+    parser = ArgumentParser(
+        prog='python -m tagger.cli',
+        description='Tag a directory of images without the webui.'
+    )
+
+    parser.add_argument('input', nargs='?', help='directory or glob pattern of the images')
+    parser.add_argument('--list', action='store_true', help='list the interrogators and exit')
+    parser.add_argument('--preset', type=str, help='preset name in the presets directory or path to a preset file')
+    parser.add_argument('--models-path', type=str, help='webui models directory, for the DeepDanbooru projects')
+    parser.add_argument('--quiet', action='store_true', help='only print the summary')
+
+    parser.add_argument('--interrogator', '-m', type=str)
+    parser.add_argument('--recursive', action=BooleanOptionalAction)
+    parser.add_argument('--include', type=str, help='comma separated patterns of the images to tag')
+    parser.add_argument('--exclude', type=str, help='comma separated patterns of the images and directories to skip')
+    parser.add_argument('--output-dir', type=str, help='same directory as the images by default')
+    parser.add_argument('--output-filename-format', type=str)
+    parser.add_argument('--action-on-conflict', choices=['ignore', 'copy', 'append', 'prepend'])
+    parser.add_argument('--remove-duplicated-tag', action=BooleanOptionalAction)
+    parser.add_argument('--save-json', action=BooleanOptionalAction)
+    parser.add_argument('--use-manifest', action=BooleanOptionalAction,
+                        help='skip the images tagged by a previous run with the same settings')
+    parser.add_argument('--use-cache', action=BooleanOptionalAction)
+
+    parser.add_argument('--mode', choices=['batched', 'pipelined'], default='pipelined',
+                        help='batched runs every stage on one thread, pipelined overlaps them')
+    parser.add_argument('--batch-size', type=int)
+    parser.add_argument('--decode-workers', type=int)
+    parser.add_argument('--write-workers', type=int)
+    parser.add_argument('--queue-depth', type=int)
+    parser.add_argument('--preprocess-processes', type=int)
+
+    parser.add_argument('--shards', type=int, help='number of shards the images are split into')
+    parser.add_argument('--shard', type=int,
+                        help='shard to tag, every shard is tagged on its own process without it')
+    parser.add_argument('--merge', action='store_true',
+                        help='check every shard has finished and merge their manifests')
+
+    parser.add_argument('--compare', type=str, metavar='VARIANT',
+                        help='compare the interrogator with a variant over the images instead of tagging them')
+    parser.add_argument('--limit', type=int, default=100, help='maximum number of images compared')
+
+    parser.add_argument('--threshold', type=float)
+    parser.add_argument('--additional-tags', type=str)
+    parser.add_argument('--exclude-tags', type=str)
+    parser.add_argument('--sort-by-alphabetical-order', action=BooleanOptionalAction)
+    parser.add_argument('--add-confident-as-weight', action=BooleanOptionalAction)
+    parser.add_argument('--replace-underscore', action=BooleanOptionalAction)
+    parser.add_argument('--replace-underscore-excludes', type=str)
+    parser.add_argument('--escape-tag', action=BooleanOptionalAction)
+
+    args = headless.install(argv, models_path, parser)
+
+    if not args.list and args.input is None:
+        parser.error('the input directory is required')
+
+    return args
+
+
+def run_shards(argv: List[str], count: int) -> int:
+    # this command once for every shard, returns the number of failed ones
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        p for p in [headless.extension_dir, env.get('PYTHONPATH')] if p
+    )
+
+    workers = [
+        subprocess.Popen(
+            [sys.executable, '-m', 'tagger.cli', *argv, '--shard', str(index)],
+            env=env
+        )
+        for index in range(count)
+    ]
+
+    return sum(1 for worker in workers if worker.wait() != 0)
+
+
+def merge_shards(args: Namespace) -> 'MergeResult':
+    from tagger import batch
+    from tagger.utils import split_str
+
+    result = batch.merge_shards(
+        args.input,
+        args.shards,
+        bool(args.recursive),
+        split_str(args.include),
+        split_str(args.exclude),
+        args.output_dir
+    )
+
+    for problem in result.problems:
+        print(problem, file=sys.stderr)
+
+    for path in result.failed:
+        print(f'{path} could not be read', file=sys.stderr)
+
+    print(
+        f'{result.merged} of {result.images} image(s) tagged by {args.shards} shard(s)'
+        + (f', {len(result.failed)} could not be read' if result.failed else '')
+        + ('' if result.complete else ', not merged')
+    )
+
+    return result
+
+
+def compare_images(args: Namespace) -> Dict[str, object]:
+    from PIL import Image
+    from tagger import batch, utils
+    from tagger.quantize import compare
+    from tagger.utils import split_str
+
+    _, paths = batch.input_paths(
+        args.input,
+        bool(args.recursive),
+        split_str(args.include),
+        split_str(args.exclude)
+    )
+
+    def images() -> Iterator['Image.Image']:
+        # opened while comparing, only one batch is kept in memory
+        for path in islice(paths, args.limit):
+            try:
+                image = Image.open(path)
+                image.load()
+                yield image
+            except OSError:
+                print(f'{path} is not supported image type', file=sys.stderr)
+
+    return compare(
+        utils.interrogators[args.interrogator],
+        utils.interrogators[args.compare],
+        images(),
+        float(args.threshold),
+        batch_size=int(args.batch_size)
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_args(argv)
+
+    # webui modules are replaced from here on
+    from tagger import batch, utils
+    from tagger.preset import Preset
+    from tagger.utils import split_str
+
+    names = utils.refresh_interrogators()
+
+    if args.list:
+        print('\n'.join(names))
+        return 0
+
+    values = {}
+    if args.preset is not None:
+        if os.path.isfile(args.preset):
+            path = Path(args.preset)
+            values = Preset(path.parent).load(path.name)[1]
+        else:
+            path, values = utils.preset.load(args.preset)
+
+            if not path.is_file():
+                print(f'preset {path} does not exist', file=sys.stderr)
+                return 1
+
+    for option, (path, default) in options.items():
+        if getattr(args, option) is None:
+            setattr(args, option, preset_value(values, path, default))
+
+    if args.interrogator not in utils.interrogators:
+        print(
+            f"'{args.interrogator}' is not a valid interrogator, use one of {', '.join(names)}",
+            file=sys.stderr
+        )
+        return 1
+
+    if args.compare is not None:
+        if args.compare not in utils.interrogators:
+            print(
+                f"'{args.compare}' is not a valid interrogator, use one of {', '.join(names)}",
+                file=sys.stderr
+            )
+            return 1
+
+        if args.limit < 1:
+            print('--limit must be at least 1', file=sys.stderr)
+            return 1
+
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull if args.quiet else sys.stderr):
+            try:
+                report = compare_images(args)
+            except ValueError as error:
+                print(error, file=sys.stderr)
+                return 1
+            finally:
+                for name in (args.interrogator, args.compare):
+                    utils.interrogators[name].unload()
+
+        print(json.dumps(report, indent=2))
+        return 0
+
+    if args.shard is not None and args.shards is None:
+        print('--shard needs the number of --shards', file=sys.stderr)
+        return 1
+
+    try:
+        if args.merge:
+            if args.shards is None:
+                print('--merge needs the number of --shards', file=sys.stderr)
+                return 1
+
+            return 0 if merge_shards(args).complete else 1
+
+        if args.shards is not None and args.shard is None:
+            # workers share the cpu, set --tagger-intra-op-threads to split it evenly
+            start = time.perf_counter()
+            failed = run_shards(argv, args.shards)
+            elapsed = time.perf_counter() - start
+
+            if failed > 0:
+                print(f'{failed} shard(s) failed', file=sys.stderr)
+
+            result = merge_shards(args)
+
+            print(
+                f'{result.processed} image(s) tagged by {args.shards} process(es) in {elapsed:.2f}s '
+                f'({result.processed / max(elapsed, 1e-9):.2f} images/s)'
+            )
+
+            return 0 if failed < 1 and result.complete else 1
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        return 1
+
+    interrogator = utils.interrogators[args.interrogator]
+
+    if args.mode == 'batched' and int(args.preprocess_processes) > 0:
+        print('preprocess processes are only used by the pipelined mode', file=sys.stderr)
+
+    postprocess_opts = (
+        float(args.threshold),
+        split_str(args.additional_tags),
+        split_str(args.exclude_tags),
+        bool(args.sort_by_alphabetical_order),
+        bool(args.add_confident_as_weight),
+        bool(args.replace_underscore),
+        split_str(args.replace_underscore_excludes),
+        bool(args.escape_tag)
+    )
+
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull if args.quiet else sys.stdout):
+        try:
+            result = batch.interrogate_directory(
+                interrogator,
+                postprocess_opts,
+
+                args.input,
+                bool(args.recursive),
+                split_str(args.include),
+                split_str(args.exclude),
+                args.output_dir,
+                args.output_filename_format,
+                args.action_on_conflict,
+                bool(args.remove_duplicated_tag),
+                bool(args.save_json),
+                bool(args.use_manifest),
+
+                int(args.batch_size),
+                int(args.decode_workers),
+                int(args.write_workers),
+                int(args.queue_depth),
+                int(args.preprocess_processes),
+                args.mode,
+
+                utils.cache if args.use_cache else None,
+                None if args.shards is None else (args.shard, args.shards)
+            )
+        except ValueError as error:
+            print(error, file=sys.stderr)
+            return 1
+        finally:
+            # stops the deepdanbooru worker process
+            interrogator.unload()
+
+    print(
+        f'{result.processed} image(s) tagged, {result.skipped} skipped, '
+        + (f'{result.failed} could not be read, ' if result.failed > 0 else '')
+        + f'{result.discovered} found in {result.elapsed:.2f}s '
+        f'({result.processed / max(result.elapsed, 1e-9):.2f} images/s)'
+    )
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,6 +2,7 @@
 
 import cv2
 import numpy as np
+from typing import Optional
 from PIL import Image
 
 
@@ -52,3 +53,76 @@ def smart_resize(img, size):
     elif img.shape[0] < size:
         img = cv2.resize(img, (size, size), interpolation=cv2.INTER_CUBIC)
     return img
+
+
+def wd14_preprocess(img, size, out: Optional[np.ndarray] = None):
+    # same as filling the transparent pixels with white, make_square and
+    # smart_resize of the BGR image, without copies of the full size image
+    # writes into out, a (size, size, 3) float32 array, and returns it
+    if out is None:
+        out = np.empty((size, size, 3), dtype=np.float32)
+
+    alpha = False
+    if img.mode == "RGB":
+        source = np.asarray(img)
+    else:
+        rgba = np.asarray(img if img.mode == "RGBA" else img.convert("RGBA"))
+        alpha = rgba[:, :, 3].min() < 255
+
+        if alpha:
+            # colors premultiplied by alpha are averaged by the resize and the
+            # image is composited onto white after it, on the small image
+            source = cv2.cvtColor(rgba, cv2.COLOR_RGBA2mRGBA)
+        else:
+            source = cv2.cvtColor(rgba, cv2.COLOR_RGBA2RGB)
+
+    # white is opaque in the premultiplied image too
+    color = [255] * source.shape[2]
+
+    height, width = source.shape[:2]
+    desired_size = max(height, width, size)
+    top = (desired_size - height) // 2
+    left = (desired_size - width) // 2
+    scale = desired_size // size
+
+    if desired_size == size:
+        resized = source
+    elif (
+        desired_size % size == 0
+        and top % scale == 0 and left % scale == 0
+        and height % scale == 0 and width % scale == 0
+    ):
+        # every pixel of the output averages pixels of either the image or
+        # the border, resizing the image alone gives the same pixels
+        resized = cv2.resize(
+            source, (width // scale, height // scale), interpolation=cv2.INTER_AREA
+        )
+        top, left = top // scale, left // scale
+    else:
+        padded = cv2.copyMakeBorder(
+            source,
+            top,
+            desired_size - height - top,
+            left,
+            desired_size - width - left,
+            cv2.BORDER_CONSTANT,
+            value=color,
+        )
+        resized = cv2.resize(padded, (size, size), interpolation=cv2.INTER_AREA)
+        top, left = 0, 0
+
+    if resized.shape[:2] != (size, size):
+        out.fill(255)
+
+    region = out[top:top + resized.shape[0], left:left + resized.shape[1]]
+
+    if alpha:
+        # color * alpha + white * (1 - alpha)
+        region[...] = resized[:, :, 2::-1]
+        region += 255
+        region -= resized[:, :, 3:]
+    else:
+        # RGB to BGR
+        region[...] = resized[:, :, ::-1]
+
+    return out
@@ -0,0 +1,130 @@
+# runs a DeepDanbooru project on a child process
+# tensorflow can not release a loaded keras model, terminating the process can
+# https://github.com/keras-team/keras/issues/2102
+
+import os
+import sys
+import pickle
+import subprocess
+
+import numpy as np
+
+from typing import Tuple
+from threading import Lock
+from pathlib import Path
+
+# directory which contains the tagger package
+extension_dir = str(Path(__file__).parent.parent)
+
+
+class DeepDanbooruWorker:
+    def __init__(self, project_path: os.PathLike, device_name: str) -> None:
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            p for p in [extension_dir, env.get('PYTHONPATH')] if p
+        )
+
+        self.lock = Lock()
+        self.process = subprocess.Popen(
+            [
+                sys.executable, '-m', 'tagger.deepdanbooru_worker',
+                os.fspath(project_path), device_name
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=env
+        )
+
+        try:
+            self.tags, self.input_shape = self.receive()
+        except BaseException:
+            self.close()
+            raise
+
+    def send(self, message: Tuple[str, object]) -> None:
+        pickle.dump(message, self.process.stdin, pickle.HIGHEST_PROTOCOL)
+        self.process.stdin.flush()
+
+    def receive(self) -> object:
+        try:
+            kind, payload = pickle.load(self.process.stdout)
+        except EOFError:
+            raise RuntimeError(
+                f'DeepDanbooru worker exited with {self.process.wait()}'
+            )
+
+        if kind == 'error':
+            raise RuntimeError(f'DeepDanbooru worker failed: {payload}')
+
+        return payload
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        # all images of the batch are evaluated with a single request
+        with self.lock:
+            self.send(('predict', batch))
+            return self.receive()
+
+    def close(self) -> None:
+        with self.lock:
+            try:
+                self.send(('exit', None))
+                self.process.wait(timeout=10)
+            except (OSError, ValueError, subprocess.TimeoutExpired):
+                self.process.kill()
+                self.process.wait()
+
+
+def main(project_path: str, device_name: str) -> None:
+    # keep the pipe clean from the prints of the other packages
+    output = sys.stdout.buffer
+    sys.stdout = sys.stderr
+
+    def send(message: Tuple[str, object]) -> None:
+        pickle.dump(message, output, pickle.HIGHEST_PROTOCOL)
+        output.flush()
+
+    try:
+        import tensorflow as tf
+
+        # tensorflow maps nearly all vram by default, so we limit this
+        # https://www.tensorflow.org/guide/gpu#limiting_gpu_memory_growth
+        for device in tf.config.experimental.list_physical_devices('GPU'):
+            tf.config.experimental.set_memory_growth(device, True)
+
+        import deepdanbooru.project as ddp
+
+        with tf.device(device_name):
+            model = ddp.load_model_from_project(
+                project_path=project_path,
+                compile_model=False
+            )
+
+        tags = ddp.load_tags_from_project(project_path=project_path)
+    except Exception as error:
+        send(('error', repr(error)))
+        return
+
+    send(('ready', (tags, tuple(model.input_shape))))
+
+    while True:
+        try:
+            kind, payload = pickle.load(sys.stdin.buffer)
+        except EOFError:
+            break
+
+        if kind == 'exit':
+            break
+
+        try:
+            # images are preprocessed by the parent process
+            with tf.device(device_name):
+                send((
+                    'result',
+                    model.predict(payload, batch_size=len(payload), verbose=0)
+                ))
+        except Exception as error:
+            send(('error', repr(error)))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:3])
@@ -0,0 +1,142 @@
+import os
+import re
+
+from typing import Iterator, List, Optional, Pattern, Set
+from fnmatch import fnmatch
+from pathlib import Path
+
+
+def image_extensions() -> Set[str]:
+    # PIL.Image.registered_extensions() returns only PNG if you call too early,
+    # so this is called right before walking
+    from PIL import Image
+
+    return {
+        e
+        for e, f in Image.registered_extensions().items()
+        if f in Image.OPEN
+    }
+
+
+def translate_segment(segment: str) -> str:
+    expression = ''
+    i = 0
+
+    while i < len(segment):
+        c = segment[i]
+
+        if c == '*':
+            expression += '[^/]*'
+        elif c == '?':
+            expression += '[^/]'
+        elif c == '[' and ']' in segment[i + 1:]:
+            end = segment.index(']', i + 1)
+            characters = segment[i + 1:end].replace('\\', '\\\\')
+            if characters.startswith('!'):
+                characters = '^' + characters[1:]
+            expression += '[' + characters + ']'
+            i = end
+        else:
+            expression += re.escape(c)
+
+        i += 1
+
+    return expression
+
+
+def translate(pattern: str, recursive: bool) -> Pattern:
+    # glob pattern relative to the base directory into a regular expression,
+    # wildcards do not match the separator except for ** on recursive walks
+    segments = re.split(r'[\\/]', pattern)
+    expression = ''
+
+    for index, segment in enumerate(segments):
+        last = index == len(segments) - 1
+
+        if segment == '**' and recursive:
+            expression += '(?:[^/]+/)*' + ('[^/]+' if last else '')
+        else:
+            expression += translate_segment(segment) + ('' if last else '/')
+
+    return re.compile(expression + r'\Z')
+
+
+def matches(relative: str, name: str, patterns: List[str]) -> bool:
+    return any(fnmatch(relative, p) or fnmatch(name, p) for p in patterns)
+
+
+# streams the files matching a glob pattern while the directories are read,
+# so the batch starts right away and the paths are never held in memory
+class Walker:
+    def __init__(
+        self,
+        base_dir: os.PathLike,
+        pattern='*',
+        recursive=False,
+        extensions: Optional[Set[str]] = None,
+        include: List[str] = [],
+        exclude: List[str] = []
+    ) -> None:
+        self.base_dir = Path(base_dir)
+        self.expression = translate(pattern, recursive)
+        self.extensions = extensions if extensions is not None else image_extensions()
+        self.include = include
+        self.exclude = exclude
+
+        # directories deeper than the pattern are never read
+        segments = re.split(r'[\\/]', pattern)
+        self.max_depth = None if recursive and '**' in segments else len(segments) - 1
+
+        self.discovered = 0
+
+    def __iter__(self) -> Iterator[Path]:
+        yield from self.walk(self.base_dir, '', 0)
+
+    def walk(self, directory: Path, prefix: str, depth: int) -> Iterator[Path]:
+        try:
+            entries = os.scandir(directory)
+        except OSError as error:
+            print(f'failed to read {directory}: {error}')
+            return
+
+        directories = []
+
+        with entries:
+            for entry in entries:
+                # hidden files are skipped like glob does
+                if entry.name.startswith('.'):
+                    continue
+
+                relative = prefix + entry.name
+
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    continue
+
+                if is_dir:
+                    if (
+                        (self.max_depth is None or depth < self.max_depth)
+                        and not matches(relative, entry.name, self.exclude)
+                    ):
+                        directories.append((entry.path, relative))
+                    continue
+
+                if os.path.splitext(entry.name)[1].lower() not in self.extensions:
+                    continue
+
+                if not self.expression.match(relative):
+                    continue
+
+                if len(self.include) > 0 and not matches(relative, entry.name, self.include):
+                    continue
+
+                if matches(relative, entry.name, self.exclude):
+                    continue
+
+                self.discovered += 1
+                yield Path(entry.path)
+
+        # subdirectories after the files, so the scandir handle is closed
+        for path, relative in directories:
+            yield from self.walk(Path(path), relative + '/', depth + 1)
@@ -1,8 +1,10 @@
+import os
 import re
 import hashlib
 
-from typing import Dict, Callable, NamedTuple
+from typing import Dict, Callable, List, NamedTuple
 from pathlib import Path
+from functools import lru_cache
 
 
 class Info(NamedTuple):
@@ -10,19 +12,61 @@ class Info(NamedTuple):
     output_ext: str
 
 
-def hash(i: Info, algo='sha1') -> str:
+# fast non-cryptographic algorithms from the optional packages
+xxhash_algorithms = ['xxh32', 'xxh64', 'xxh3_64', 'xxh3_128', 'xxh128']
+
+# size of the chunk read at once while hashing, large images are never read whole
+chunk_size = 1024 * 1024
+
+
+def new_hash(algo: str):
+    if algo in xxhash_algorithms:
+        import xxhash
+        return getattr(xxhash, algo)()
+
+    if algo == 'blake3':
+        from blake3 import blake3
+        return blake3()
+
+    return hashlib.new(algo)
+
+
+def available_algorithms() -> List[str]:
+    algorithms = sorted(hashlib.algorithms_available)
+
+    for package, names in [('xxhash', xxhash_algorithms), ('blake3', ['blake3'])]:
+        try:
+            __import__(package)
+            algorithms += names
+        except ImportError:
+            pass
+
+    return algorithms
+
+
+@lru_cache(maxsize=1 << 17)
+def file_digest(path: str, size: int, mtime: int, algo: str) -> str:
+    # size and mtime are part of the memo key, changed files are hashed again
     try:
-        hash = hashlib.new(algo)
-    except ImportError:
+        hash = new_hash(algo)
+    except (ImportError, ValueError):
         raise ValueError(f"'{algo}' is invalid hash algorithm")
 
-    # TODO: is okay to hash large image?
-    with open(i.path, 'rb') as file:
-        hash.update(file.read())
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+
+    with open(path, 'rb', buffering=0) as file:
+        while read := file.readinto(buffer):
+            hash.update(view[:read])
 
     return hash.hexdigest()
 
 
+def hash(i: Info, algo='sha1') -> str:
+    stat = os.stat(i.path)
+    return file_digest(os.fspath(i.path), stat.st_size, stat.st_mtime_ns, algo)
+
+
 pattern = re.compile(r'\[([\w:]+)\]')
 
 # all function must returns string or raise TypeError or ValueError
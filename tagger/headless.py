@@ -0,0 +1,109 @@
+# minimal stand-ins for the webui modules the tagger imports,
+# so the tagger can run without the webui (benchmarks, command line)
+
+import os
+import re
+import sys
+import base64
+import importlib.util
+import subprocess
+
+from types import ModuleType
+from typing import List, Optional
+from argparse import ArgumentParser, Namespace
+from io import BytesIO
+from threading import Lock
+from pathlib import Path
+
+# directory which contains the tagger package and preload.py
+extension_dir = str(Path(__file__).parent.parent)
+
+
+def module(name: str, **attributes) -> ModuleType:
+    m = ModuleType(name)
+    m.__dict__.update(attributes)
+    sys.modules[name] = m
+
+    # make the module reachable from its parent package
+    parent, _, child = name.rpartition('.')
+    if parent:
+        setattr(sys.modules[parent], child, m)
+
+    return m
+
+
+def is_installed(package: str) -> bool:
+    return importlib.util.find_spec(package) is not None
+
+
+def run_pip(args: str, desc: Optional[str] = None) -> None:
+    print(f'Installing {desc}')
+    subprocess.run([sys.executable, '-m', 'pip', *args.split()], check=True)
+
+
+def decode_base64_to_image(encoding: str):
+    from PIL import Image
+
+    if encoding.startswith('data:image/'):
+        encoding = encoding.split(';')[1].split(',')[1]
+
+    return Image.open(BytesIO(base64.b64decode(encoding)))
+
+
+def install(
+    argv: List[str] = [],
+    models_path: Optional[str] = None,
+    parser: Optional[ArgumentParser] = None
+) -> Namespace:
+    # registers the stand-ins and parses the tagger command line options,
+    # which are added to the given parser to parse them along its own
+    if 'modules.shared' in sys.modules:
+        return sys.modules['modules.shared'].cmd_opts
+
+    if extension_dir not in sys.path:
+        sys.path.insert(0, extension_dir)
+
+    from pydantic import BaseModel, Field
+
+    class InterrogateRequest(BaseModel):
+        image: str = Field(
+            default='',
+            title='Image',
+            description='Image to work on, must be a Base64 string containing the image\'s data.'
+        )
+
+        model: str = Field(
+            default='clip',
+            title='Model',
+            description='The interrogate model used.'
+        )
+
+    module('modules', __path__=[])
+    shared = module(
+        'modules.shared',
+        models_path=models_path or os.environ.get(
+            'TAGGER_MODELS_PATH',
+            str(Path(extension_dir, 'models'))
+        )
+    )
+    module('modules.deepbooru', re_special=re.compile(r'([\\()])'))
+    module('modules.scripts', basedir=lambda: extension_dir)
+    module('modules.images', sanitize_filename_part=lambda text, **_: text)
+    module('modules.call_queue', queue_lock=Lock())
+    module('modules.api', __path__=[])
+    module('modules.api.models', InterrogateRequest=InterrogateRequest)
+    module('modules.api.api', decode_base64_to_image=decode_base64_to_image)
+    module('launch', is_installed=is_installed, run_pip=run_pip)
+
+    from preload import preload
+
+    # options of the webui the tagger reads
+    parser = parser or ArgumentParser()
+    parser.add_argument('--use-cpu', nargs='+', default=[])
+    parser.add_argument('--device-id', type=str, default=None)
+    parser.add_argument('--api-auth', type=str, default=None)
+    preload(parser)
+
+    shared.cmd_opts = parser.parse_args(argv)
+
+    return shared.cmd_opts
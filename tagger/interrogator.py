@@ -1,20 +1,25 @@
 import os
 import gc
-import pandas as pd
+import csv
 import numpy as np
 
-from typing import Tuple, List, Dict
-from io import BytesIO
+from typing import Tuple, List, Dict, Iterator, Optional, Union
+from threading import Lock
+from contextlib import contextmanager
 from PIL import Image
 
 from pathlib import Path
-from huggingface_hub import hf_hub_download
 
-from modules import shared
+from modules import shared, scripts
 from modules.deepbooru import re_special as tag_escape_pattern
 
-# i'm not sure if it's okay to add this file to the repository
-from . import dbimutils
+from .manager import ModelManager
+from .deepdanbooru_worker import DeepDanbooruWorker
+from .session import check_options, create_session
+from .weights import MappedWeights
+from .quantize import quantize
+from .metrics import metrics
+from .registry import Registry
 
 # select a device to process
 use_cpu = ('all' in shared.cmd_opts.use_cpu) or (
@@ -31,8 +36,141 @@ else:
         except ValueError:
             print('--device-id is not a integer')
 
+# unloads the least recently used models when the loaded models exceed the budget
+manager = ModelManager(
+    getattr(shared.cmd_opts, 'tagger_memory_budget', 0) * 1024 * 1024
+)
+
+# where the model files are, resolved files are remembered until the registry changes
+registry = Registry(
+    scripts.basedir(),
+    getattr(shared.cmd_opts, 'tagger_registry', None),
+    getattr(shared.cmd_opts, 'tagger_offline', False)
+)
+
+
+def escape(tag: str) -> str:
+    return tag_escape_pattern.sub(r'\\\1', tag)
+
+
+class TagNames:
+    # name tables for the vectorized post-processing
+    # replaced and escaped names are computed once and reused for every image
+    def __init__(self, names: List[str]) -> None:
+        self.list = list(names)
+        self.names = np.array(names, dtype=object)
+        self.indices = {name: index for index, name in enumerate(names)}
+
+        self._spaced: Optional[List[str]] = None
+        self._escaped: Optional[List[str]] = None
+        self._spaced_escaped: Optional[List[str]] = None
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @property
+    def spaced(self) -> List[str]:
+        if self._spaced is None:
+            self._spaced = [n.replace('_', ' ') for n in self.names]
+        return self._spaced
+
+    @property
+    def escaped(self) -> List[str]:
+        if self._escaped is None:
+            self._escaped = [escape(n) for n in self.names]
+        return self._escaped
+
+    @property
+    def spaced_escaped(self) -> List[str]:
+        if self._spaced_escaped is None:
+            self._spaced_escaped = [escape(n) for n in self.spaced]
+        return self._spaced_escaped
+
 
 class Interrogator:
+    @staticmethod
+    def postprocess_confidents(
+        confidents: np.ndarray,
+        names: TagNames,
+
+        threshold=0.35,
+        additional_tags: List[str] = [],
+        exclude_tags: List[str] = [],
+        sort_by_alphabetical_order=False,
+        add_confident_as_weight=False,
+        replace_underscore=False,
+        replace_underscore_excludes: List[str] = [],
+        escape_tag=False
+    ) -> Dict[str, float]:
+        # same result as postprocess_tags, but only the tags above the threshold
+        # are sorted and converted, which are a few dozens out of thousands
+
+        # compare in double precision like python floats do
+        confidents = np.array(confidents, dtype=np.float64)
+
+        extra_names = []
+        for t in dict.fromkeys(additional_tags):
+            if t in names.indices:
+                confidents[names.indices[t]] = 1.0
+
+            # tags unknown to the model are placed after the model tags
+            elif 1.0 >= threshold and t not in exclude_tags:
+                extra_names.append(t)
+
+        mask = confidents >= threshold
+
+        for t in exclude_tags:
+            if t in names.indices:
+                mask[names.indices[t]] = False
+
+        indices = np.flatnonzero(mask)
+        survivors = confidents[indices]
+
+        # negative index marks the tags which are not in the name table
+        indices = np.concatenate([indices, -1 - np.arange(len(extra_names))])
+        survivors = np.concatenate([survivors, np.ones(len(extra_names))])
+
+        if sort_by_alphabetical_order:
+            order = np.argsort(
+                np.concatenate([
+                    names.names[indices[:len(indices) - len(extra_names)]],
+                    np.array(extra_names, dtype=object)
+                ]),
+                kind='stable'
+            )
+        else:
+            order = np.argsort(-survivors, kind='stable')
+
+        underscore_excludes = set(replace_underscore_excludes)
+        new_tags = []
+
+        for index, confident in zip(indices[order].tolist(), survivors[order].tolist()):
+            if index < 0:
+                tag = extra_names[-1 - index]
+                new_tag = tag
+
+                if replace_underscore and tag not in underscore_excludes:
+                    new_tag = new_tag.replace('_', ' ')
+
+                if escape_tag:
+                    new_tag = escape(new_tag)
+            elif replace_underscore and names.names[index] not in underscore_excludes:
+                if escape_tag:
+                    new_tag = names.spaced_escaped[index]
+                else:
+                    new_tag = names.spaced[index]
+            elif escape_tag:
+                new_tag = names.escaped[index]
+            else:
+                new_tag = names.names[index]
+
+            if add_confident_as_weight:
+                new_tag = f'({new_tag}:{confident})'
+
+            new_tags.append((new_tag, confident))
+
+        return dict(new_tags)
+
     @staticmethod
     def postprocess_tags(
         tags: Dict[str, float],
@@ -75,7 +213,7 @@ class Interrogator:
                 new_tag = new_tag.replace('_', ' ')
 
             if escape_tag:
-                new_tag = tag_escape_pattern.sub(r'\\\1', new_tag)
+                new_tag = escape(new_tag)
 
             if add_confident_as_weight:
                 new_tag = f'({new_tag}:{tags[tag]})'
@@ -87,6 +225,131 @@ class Interrogator:
 
     def __init__(self, name: str) -> None:
         self.name = name
+        self.rating_names: List[str] = []
+        self.tag_names: Optional[TagNames] = None
+
+        # names of the last dict result which did not match the loaded names,
+        # never used for the raw results of the model
+        self.dict_tag_names: Optional[TagNames] = None
+
+        self.load_lock = Lock()
+        self.users = 0
+
+    @contextmanager
+    def using(self) -> Iterator[None]:
+        # loads the model on the first use and keeps it loaded while in use
+        loaded = False
+
+        with self.load_lock:
+            if getattr(self, 'model', None) is None:
+                self.load()
+                loaded = True
+
+            self.users += 1
+
+        if loaded:
+            manager.loaded(self, self.model_size())
+        else:
+            manager.used(self)
+
+        try:
+            yield
+        finally:
+            with self.load_lock:
+                self.users -= 1
+
+    def model_size(self) -> int:
+        # approximate memory used by the loaded model in bytes
+        return 0
+
+    def mapped_memory(self) -> Tuple[int, int, int]:
+        # bytes of the model mapped from a file, resident in this process
+        # and shared with other processes
+        return 0, 0, 0
+
+    def try_unload(self) -> bool:
+        # unloads the model unless it is being used on the other thread
+        if not self.load_lock.acquire(blocking=False):
+            return False
+
+        try:
+            return self.users < 1 and self.unload()
+        finally:
+            self.load_lock.release()
+
+    def split(
+        self,
+        confidents: np.ndarray
+    ) -> Tuple[Dict[str, float], np.ndarray]:
+        # splits a raw output into rating confidents and tag confidents
+        ratings = len(self.rating_names)
+        return (
+            dict(zip(self.rating_names, confidents[:ratings].tolist())),
+            confidents[ratings:]
+        )
+
+    def to_dicts(
+        self,
+        confidents: np.ndarray
+    ) -> Tuple[
+        Dict[str, float],  # rating confidents
+        Dict[str, float]  # tag confidents
+    ]:
+        ratings, tags = self.split(confidents)
+        return ratings, dict(zip(self.tag_names.names, tags.tolist()))
+
+    def postprocess(
+        self,
+        tags: Union[Dict[str, float], np.ndarray],
+        *args,
+        **kwargs
+    ) -> Dict[str, float]:
+        with metrics.timer('postprocess', self.name):
+            # raw tag confidents are in the same order as the loaded name table
+            if isinstance(tags, np.ndarray):
+                return Interrogator.postprocess_confidents(
+                    tags,
+                    self.tag_names,
+                    *args,
+                    **kwargs
+                )
+
+            processed_tags = Interrogator.postprocess_confidents(
+                np.fromiter(tags.values(), np.float64, len(tags)),
+                self.names_of(tags),
+                *args,
+                **kwargs
+            )
+
+            # keep additional tags in the confidents like postprocess_tags does
+            additional_tags = kwargs.get(
+                'additional_tags',
+                args[1] if len(args) > 1 else []
+            )
+            for t in additional_tags:
+                tags[t] = 1.0
+
+            return processed_tags
+
+    def names_of(self, tags: Dict[str, float]) -> TagNames:
+        # results of the same interrogator have the same tags in the same order,
+        # so the name tables are reused, but cached results may have been
+        # stored by another version of the model
+        names = list(tags)
+
+        for table in [self.tag_names, self.dict_tag_names]:
+            if table is not None and table.list == names:
+                return table
+
+        table = TagNames(names)
+        self.dict_tag_names = table
+
+        return table
+
+    @property
+    def cache_key(self) -> str:
+        # identifies the model that produced cached results
+        return self.name
 
     def load(self):
         raise NotImplementedError()
@@ -97,6 +360,7 @@ class Interrogator:
         if hasattr(self, 'model') and self.model is not None:
             del self.model
             unloaded = True
+            manager.unloaded(self)
             print(f'Unloaded {self.name}')
 
         if hasattr(self, 'tags'):
@@ -106,19 +370,89 @@ class Interrogator:
 
     def interrogate(
         self,
-        image: Image
-    ) -> Tuple[
-        Dict[str, float],  # rating confidents
-        Dict[str, float]  # tag confidents
+        image: Image,
+        raw=False
+    ) -> Union[
+        Tuple[
+            Dict[str, float],  # rating confidents
+            Dict[str, float]  # tag confidents
+        ],
+        np.ndarray  # raw confidents, when raw is set
     ]:
         raise NotImplementedError()
 
+    def preprocess(self, image: Image.Image) -> object:
+        # converts an image to the model input, may run on the other threads
+        return image
+
+    def evaluate(
+        self,
+        inputs: List[object],
+        batch_size=1,
+        raw=False
+    ) -> List[Union[
+        Tuple[
+            Dict[str, float],  # rating confidents
+            Dict[str, float]  # tag confidents
+        ],
+        np.ndarray  # raw confidents, when raw is set
+    ]]:
+        # fallback for interrogators that can only evaluate one image at once
+        return [self.interrogate(image, raw) for image in inputs]
+
+    def interrogate_batch(
+        self,
+        images: List[Image.Image],
+        batch_size=1,
+        raw=False
+    ) -> List[Union[
+        Tuple[
+            Dict[str, float],  # rating confidents
+            Dict[str, float]  # tag confidents
+        ],
+        np.ndarray  # raw confidents, when raw is set
+    ]]:
+        return self.evaluate(
+            [self.preprocess(image) for image in images],
+            batch_size,
+            raw
+        )
+
+    def warm_up(self) -> None:
+        # first inference is much slower than the others, run it on a dummy image
+        self.interrogate(Image.new('RGB', (64, 64), 'WHITE'), raw=True)
+
 
 class DeepDanbooruInterrogator(Interrogator):
-    def __init__(self, name: str, project_path: os.PathLike) -> None:
+    def __init__(
+        self,
+        name: str,
+        project_path: os.PathLike,
+        subprocess: Optional[bool] = None
+    ) -> None:
         super().__init__(name)
         self.project_path = project_path
 
+        # runs tensorflow on a child process, so the model can be unloaded
+        if subprocess is None:
+            subprocess = getattr(
+                shared.cmd_opts,
+                'tagger_deepdanbooru_subprocess',
+                False
+            )
+
+        self.subprocess = subprocess
+
+    @property
+    def cache_key(self) -> str:
+        return f'{self.name}:{os.fspath(self.project_path)}'
+
+    def model_size(self) -> int:
+        return sum(
+            p.stat().st_size
+            for p in Path(self.project_path).glob('*.h5')
+        )
+
     def load(self) -> None:
         print(f'Loading {self.name} from {str(self.project_path)}')
 
@@ -134,6 +468,14 @@ class DeepDanbooruInterrogator(Interrogator):
             run_pip(
                 f'install {package} tensorflow tensorflow-io', 'deepdanbooru')
 
+        if self.subprocess:
+            self.model = DeepDanbooruWorker(self.project_path, tf_device_name)
+            self.tags = self.model.tags
+            self.tag_names = TagNames(self.tags)
+
+            print(f'Loaded {self.name} model on a worker process')
+            return
+
         import tensorflow as tf
 
         # tensorflow maps nearly all vram by default, so we limit this
@@ -156,7 +498,15 @@ class DeepDanbooruInterrogator(Interrogator):
                 project_path=self.project_path
             )
 
+            self.tag_names = TagNames(self.tags)
+
     def unload(self) -> bool:
+        # terminating the worker process releases everything tensorflow holds
+        model = getattr(self, 'model', None)
+        if isinstance(model, DeepDanbooruWorker):
+            model.close()
+            return super().unload()
+
         # unloaded = super().unload()
 
         # if unloaded:
@@ -170,46 +520,74 @@ class DeepDanbooruInterrogator(Interrogator):
 
         # There is a bug in Keras where it is not possible to release a model that has been loaded into memory.
         # Downgrading to keras==2.1.6 may solve the issue, but it may cause compatibility issues with other packages.
-        # Using subprocess to create a new process may also solve the problem, but it can be too complex (like Automatic1111 did).
+        # Use --tagger-deepdanbooru-subprocess to load the model on a worker process that can be terminated instead.
         # It seems that for now, the best option is to keep the model in memory, as most users use the Waifu Diffusion model with onnx.
 
         return False
 
+    def preprocess(self, image: Image.Image) -> np.ndarray:
+        with self.using():
+            _, height, width, _ = self.model.input_shape
+
+        # opencv is only imported when the first image is converted
+        from .preprocess import deepdanbooru_tensor
+
+        with metrics.timer('preprocess', self.name):
+            return deepdanbooru_tensor(image, width, height)
+
+    def predict(self, inputs: List[np.ndarray]) -> np.ndarray:
+        # stack images into a single (N, H, W, 3) tensor
+        batch = np.stack(inputs)
+
+        # worker evaluates the whole batch with a single request
+        if isinstance(self.model, DeepDanbooruWorker):
+            return self.model.predict(batch)
+
+        import tensorflow as tf
+
+        with tf.device(tf_device_name):
+            return self.model.predict(batch, batch_size=len(batch), verbose=0)
+
     def interrogate(
         self,
-        image: Image
-    ) -> Tuple[
-        Dict[str, float],  # rating confidents
-        Dict[str, float]  # tag confidents
+        image: Image,
+        raw=False
+    ) -> Union[
+        Tuple[
+            Dict[str, float],  # rating confidents
+            Dict[str, float]  # tag confidents
+        ],
+        np.ndarray  # raw confidents, when raw is set
     ]:
-        # init model
-        if not hasattr(self, 'model') or self.model is None:
-            self.load()
-
-        import deepdanbooru.data as ddd
-
-        # convert an image to fit the model
-        image_bufs = BytesIO()
-        image.save(image_bufs, format='PNG')
-        image = ddd.load_image_for_evaluate(
-            image_bufs,
-            self.model.input_shape[2],
-            self.model.input_shape[1]
-        )
+        return self.interrogate_batch([image], raw=raw)[0]
 
-        image = image.reshape((1, *image.shape[0:3]))
+    def evaluate(
+        self,
+        inputs: List[np.ndarray],
+        batch_size=1,
+        raw=False
+    ) -> List[Union[
+        Tuple[
+            Dict[str, float],  # rating confidents
+            Dict[str, float]  # tag confidents
+        ],
+        np.ndarray  # raw confidents, when raw is set
+    ]]:
+        # model is not evicted until the batch is finished
+        with self.using():
+            batch_size = max(int(batch_size), 1)
+            results = []
 
-        # evaluate model
-        result = self.model.predict(image)
+            for offset in range(0, len(inputs), batch_size):
+                batch = inputs[offset:offset + batch_size]
 
-        confidents = result[0].tolist()
-        ratings = {}
-        tags = {}
+                with metrics.timer('infer', self.name, len(batch)):
+                    confidents = self.predict(batch)
 
-        for i, tag in enumerate(self.tags):
-            tags[tag] = confidents[i]
+                for confident in confidents:
+                    results.append(confident if raw else self.to_dicts(confident))
 
-        return ratings, tags
+            return results
 
 
 class WaifuDiffusionInterrogator(Interrogator):
@@ -218,20 +596,53 @@ class WaifuDiffusionInterrogator(Interrogator):
         name: str,
         model_path='model.onnx',
         tags_path='selected_tags.csv',
+        session_options: Optional[Dict[str, object]] = None,
+        quantization: Optional[str] = None,
         **kwargs
     ) -> None:
         super().__init__(name)
         self.model_path = model_path
         self.tags_path = tags_path
+
+        # overrides the onnxruntime options given on the command line
+        self.session_options = session_options or {}
+        check_options(self.session_options)
+
+        # int8 or fp16 model generated from the downloaded one
+        self.quantization = quantization
         self.kwargs = kwargs
 
-    def download(self) -> Tuple[os.PathLike, os.PathLike]:
-        print(f"Loading {self.name} model file from {self.kwargs['repo_id']}")
+        # initializers mapped from the model file, see weights.py
+        self.weights: Optional[MappedWeights] = None
+
+    @property
+    def cache_key(self) -> str:
+        if 'repo_id' in self.kwargs:
+            revision = self.kwargs.get('revision', 'main')
+            key = f"{self.name}:{self.kwargs['repo_id']}@{revision}"
+        else:
+            key = f'{self.name}:{self.model_path}'
+
+        if self.quantization is not None:
+            key += f':{self.quantization}'
+
+        return key
+
+    def quantized(self, name: str, quantization: str) -> 'WaifuDiffusionInterrogator':
+        return WaifuDiffusionInterrogator(
+            name,
+            self.model_path,
+            self.tags_path,
+            self.session_options,
+            quantization,
+            **self.kwargs
+        )
 
-        model_path = Path(hf_hub_download(
-            **self.kwargs, filename=self.model_path))
-        tags_path = Path(hf_hub_download(
-            **self.kwargs, filename=self.tags_path))
+    def download(self) -> Tuple[os.PathLike, os.PathLike]:
+        # local files or the huggingface cache, the hub is only asked
+        # for files that are not there yet
+        model_path = registry.resolve(self.model_path, **self.kwargs)
+        tags_path = registry.resolve(self.tags_path, **self.kwargs)
         return model_path, tags_path
 
     def load(self) -> None:
@@ -249,7 +660,8 @@ class WaifuDiffusionInterrogator(Interrogator):
 
             run_pip(f'install {package}', 'onnxruntime')
 
-        from onnxruntime import InferenceSession
+        if self.quantization is not None:
+            model_path = quantize(model_path, self.quantization)
 
         # https://onnxruntime.ai/docs/execution-providers/
         # https://github.com/toriato/stable-diffusion-webui-wd14-tagger/commit/e4ec460122cf674bbf984df30cdb10b4370c1224#r92654958
@@ -257,57 +669,126 @@ class WaifuDiffusionInterrogator(Interrogator):
         if use_cpu:
             providers.pop(0)
 
-        self.model = InferenceSession(str(model_path), providers=providers)
+        self.model, self.model_file, self.weights = create_session(
+            model_path,
+            providers,
+            self.session_options
+        )
 
-        print(f'Loaded {self.name} model from {model_path}')
+        print(f'Loaded {self.name} model from {self.model_file}')
 
-        self.tags = pd.read_csv(tags_path)
+        self.load_tags(tags_path)
 
-    def interrogate(
-        self,
-        image: Image
-    ) -> Tuple[
-        Dict[str, float],  # rating confidents
-        Dict[str, float]  # tag confidents
-    ]:
-        # init model
-        if not hasattr(self, 'model') or self.model is None:
-            self.load()
+    def load_tags(self, tags_path: os.PathLike) -> None:
+        # parse the tag table once, results are built from these arrays
+        with open(tags_path, newline='', encoding='utf-8') as file:
+            rows = list(csv.DictReader(file))
 
-        # code for converting the image and running the model is taken from the link below
-        # thanks, SmilingWolf!
-        # https://huggingface.co/spaces/SmilingWolf/wd-v1-4-tags/blob/main/app.py
+        names = [row['name'] for row in rows]
+        self.tag_categories = np.array(
+            [int(row['category']) for row in rows],
+            dtype=np.int16
+        )
 
-        # convert an image to fit the model
-        _, height, _, _ = self.model.get_inputs()[0].shape
+        # first items are for rating (general, sensitive, questionable, explicit)
+        ratings = int(np.count_nonzero(self.tag_categories == 9)) or 4
 
-        # alpha to white
-        image = image.convert('RGBA')
-        new_image = Image.new('RGBA', image.size, 'WHITE')
-        new_image.paste(image, mask=image)
-        image = new_image.convert('RGB')
-        image = np.asarray(image)
+        # rest are regular tags
+        self.rating_names = names[:ratings]
+        self.tag_names = TagNames(names[ratings:])
 
-        # PIL RGB to OpenCV BGR
-        image = image[:, :, ::-1]
+    def unload(self) -> bool:
+        unloaded = super().unload()
 
-        image = dbimutils.make_square(image, height)
-        image = dbimutils.smart_resize(image, height)
-        image = image.astype(np.float32)
-        image = np.expand_dims(image, 0)
+        # the file is unmapped once the session is gone
+        self.weights = None
 
-        # evaluate model
-        input_name = self.model.get_inputs()[0].name
-        label_name = self.model.get_outputs()[0].name
-        confidents = self.model.run([label_name], {input_name: image})[0]
+        return unloaded
 
-        tags = self.tags[:][['name']]
-        tags['confidents'] = confidents[0]
+    def model_size(self) -> int:
+        # weights of the onnx model are loaded into memory as they are
+        size = os.path.getsize(self.model_file)
 
-        # first 4 items are for rating (general, sensitive, questionable, explicit)
-        ratings = dict(tags[:4].values)
+        if self.weights is not None:
+            size += self.weights.size
 
-        # rest are regular tags
-        tags = dict(tags[4:].values)
+        return size
+
+    def mapped_memory(self) -> Tuple[int, int, int]:
+        # may be unloaded on the other thread
+        weights = self.weights
+
+        if weights is None:
+            return 0, 0, 0
+
+        return weights.memory()
+
+    @property
+    def input_size(self) -> int:
+        _, height, _, _ = self.model.get_inputs()[0].shape
+        return height
+
+    def preprocess(self, image: Image.Image) -> np.ndarray:
+        with self.using():
+            size = self.input_size
 
-        return ratings, tags
+        # opencv is only imported when the first image is converted
+        from .preprocess import wd14_tensor
+
+        with metrics.timer('preprocess', self.name):
+            return wd14_tensor(image, size)
+
+    def interrogate(
+        self,
+        image: Image,
+        raw=False
+    ) -> Union[
+        Tuple[
+            Dict[str, float],  # rating confidents
+            Dict[str, float]  # tag confidents
+        ],
+        np.ndarray  # raw confidents, when raw is set
+    ]:
+        return self.interrogate_batch([image], raw=raw)[0]
+
+    def warm_up(self) -> None:
+        with self.using():
+            size = self.input_size
+            self.evaluate([np.full((size, size, 3), 255, np.float32)], raw=True)
+
+    def evaluate(
+        self,
+        inputs: List[np.ndarray],
+        batch_size=1,
+        raw=False
+    ) -> List[Union[
+        Tuple[
+            Dict[str, float],  # rating confidents
+            Dict[str, float]  # tag confidents
+        ],
+        np.ndarray  # raw confidents, when raw is set
+    ]]:
+        # model is not evicted until the batch is finished
+        with self.using():
+            input = self.model.get_inputs()[0]
+            label_name = self.model.get_outputs()[0].name
+
+            # some exported models have a fixed batch dimension
+            if isinstance(input.shape[0], int):
+                batch_size = min(batch_size, input.shape[0])
+
+            batch_size = max(int(batch_size), 1)
+            results = []
+
+            for offset in range(0, len(inputs), batch_size):
+                # stack images into a single (N, H, W, 3) tensor
+                batch = np.stack(inputs[offset:offset + batch_size])
+
+                # evaluate model
+                with metrics.timer('infer', self.name, len(batch)):
+                    confidents = self.model.run([label_name], {input.name: batch})[0]
+
+                for confident in confidents:
+                    results.append(confident if raw else self.to_dicts(confident))
+
+            return results
@@ -0,0 +1,121 @@
+import time
+
+from typing import Dict, List, Set
+from threading import RLock
+from collections import OrderedDict
+
+
+class ModelState:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.loaded = False
+        self.size = 0
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+        self.last_used = 0.0
+
+        # memory mapped models, see weights.py
+        self.mapped = 0
+        self.resident = 0
+        self.shared = 0
+
+    def dict(self) -> Dict[str, object]:
+        return dict(self.__dict__)
+
+
+# keeps track of the loaded interrogators and unloads the least recently used
+# ones when the approximate memory of the loaded models exceeds the budget
+class ModelManager:
+    budget: int
+
+    def __init__(self, budget=0) -> None:
+        # budget in bytes, zero means no limit
+        self.budget = budget
+        self.lock = RLock()
+        self.models: 'OrderedDict[object, ModelState]' = OrderedDict()
+
+        # names of the models which are never evicted, like the preloaded ones
+        self.pinned: Set[str] = set()
+
+    def state(self, interrogator) -> ModelState:
+        if interrogator not in self.models:
+            self.models[interrogator] = ModelState(interrogator.name)
+
+        return self.models[interrogator]
+
+    def used(self, interrogator) -> None:
+        with self.lock:
+            state = self.state(interrogator)
+            state.hits += 1
+            state.last_used = time.time()
+            self.models.move_to_end(interrogator)
+
+    def loaded(self, interrogator, size: int) -> None:
+        with self.lock:
+            state = self.state(interrogator)
+            state.loaded = True
+            state.size = size
+            state.loads += 1
+            state.last_used = time.time()
+            self.models.move_to_end(interrogator)
+
+        self.evict(interrogator)
+
+    def pin(self, name: str) -> None:
+        with self.lock:
+            self.pinned.add(name)
+
+    def is_loaded(self, interrogator) -> bool:
+        with self.lock:
+            return interrogator in self.models and self.models[interrogator].loaded
+
+    def unloaded(self, interrogator) -> None:
+        with self.lock:
+            if interrogator in self.models:
+                self.models[interrogator].loaded = False
+
+    def total_size(self) -> int:
+        return sum(s.size for s in self.models.values() if s.loaded)
+
+    def evict(self, keep) -> None:
+        if self.budget <= 0:
+            return
+
+        with self.lock:
+            # oldest first, the model that has just been used is never evicted
+            for interrogator, state in list(self.models.items()):
+                if self.total_size() <= self.budget:
+                    break
+
+                if interrogator is keep or not state.loaded or state.name in self.pinned:
+                    continue
+
+                # models in use are skipped, they are evicted on the next load
+                if not interrogator.try_unload():
+                    continue
+
+                state.evictions += 1
+                print(f'Evicted {state.name} to stay within the memory budget')
+
+    def forget(self, interrogators: List[object]) -> None:
+        # interrogators which are not in the list anymore
+        with self.lock:
+            for interrogator in list(self.models):
+                if interrogator not in interrogators and not self.models[interrogator].loaded:
+                    del self.models[interrogator]
+
+    def status(self) -> List[Dict[str, object]]:
+        with self.lock:
+            for interrogator, state in self.models.items():
+                # pages are mapped in and out while the model runs
+                if state.loaded:
+                    state.mapped, state.resident, state.shared = interrogator.mapped_memory()
+                else:
+                    state.mapped, state.resident, state.shared = 0, 0, 0
+
+            return [state.dict() for state in reversed(self.models.values())]
+
+    def shared_size(self) -> int:
+        # resident memory of this process shared with other processes
+        return sum(s.shared for s in self.models.values() if s.loaded)
@@ -0,0 +1,247 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+from typing import Callable, Dict, NamedTuple
+from pathlib import Path
+from threading import Lock
+
+# stored in the root of the output directory
+filename = '.tagger-manifest.db'
+
+
+class Entry(NamedTuple):
+    size: int
+    mtime: int
+    hash: str
+    interrogator: str
+    options: str
+    output: str
+
+    # tagged, or failed when the image could not be read
+    status: str = 'tagged'
+
+
+def options_hash(*options) -> str:
+    # settings that change the content of the output files
+    return hashlib.sha1(
+        json.dumps(options, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+insert = (
+    'REPLACE INTO entries '
+    '(source, size, mtime, hash, interrogator, options, output, status, updated) '
+    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+)
+
+
+# remembers which source files have been tagged into which output file,
+# with which model and settings, so the next batch run can skip them
+# without opening the images
+#
+# sources are stored relative to the input directory and outputs relative
+# to the directory of the manifest, so hosts which mount the files at other
+# paths share the entries
+class Manifest:
+    path: Path
+
+    def __init__(
+        self,
+        output_dir: os.PathLike,
+        source_dir: os.PathLike,
+        commit_interval=256,
+        name=filename
+    ) -> None:
+        self.path = Path(output_dir, name)
+        self.path.parent.mkdir(0o777, True, True)
+        self.source_dir = os.path.abspath(source_dir)
+        self.commit_interval = commit_interval
+        self.lock = Lock()
+        self.pending = 0
+
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.executescript('''
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS entries (
+                source TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                hash TEXT NOT NULL,
+                interrogator TEXT NOT NULL,
+                options TEXT NOT NULL,
+                output TEXT NOT NULL,
+                updated REAL NOT NULL,
+                status TEXT NOT NULL DEFAULT 'tagged'
+            );
+        ''')
+
+        # manifests written before images could fail
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(entries)')]
+        if 'status' not in columns:
+            self.connection.execute(
+                "ALTER TABLE entries ADD COLUMN status TEXT NOT NULL DEFAULT 'tagged'"
+            )
+            self.connection.commit()
+
+        if self.connection.execute('PRAGMA user_version').fetchone()[0] < 1:
+            self.relativize()
+
+        # looked up for every source file, so everything is read at once
+        self.entries: Dict[str, Entry] = {
+            row[0]: Entry(*row[1:])
+            for row in self.connection.execute(
+                'SELECT source, size, mtime, hash, interrogator, options, output, status '
+                'FROM entries'
+            )
+        }
+
+    def unchanged(
+        self,
+        source: os.PathLike,
+        stat: os.stat_result,
+        interrogator: str,
+        options: str,
+        digest: Callable[[], str]
+    ) -> bool:
+        entry = self.entries.get(self.source(source))
+
+        # images which could not be read are tried again
+        if entry is None or entry.status != 'tagged':
+            return False
+
+        if entry.interrogator != interrogator or entry.options != options:
+            return False
+
+        # output has been deleted or moved
+        if not self.output_path(entry).is_file():
+            return False
+
+        if entry.size == stat.st_size and entry.mtime == stat.st_mtime_ns:
+            return True
+
+        # touched or copied files are compared by their content
+        if entry.size == stat.st_size and entry.hash == digest():
+            self.record(source, stat, entry.hash, interrogator, options, self.output_path(entry))
+            return True
+
+        return False
+
+    def digest(
+        self,
+        source: os.PathLike,
+        stat: os.stat_result,
+        digest: Callable[[], str]
+    ) -> str:
+        # hash recorded by a previous run, while the file has not changed
+        entry = self.entries.get(self.source(source))
+
+        if (
+            entry is not None and entry.hash
+            and entry.size == stat.st_size and entry.mtime == stat.st_mtime_ns
+        ):
+            return entry.hash
+
+        return digest()
+
+    def record(
+        self,
+        source: os.PathLike,
+        stat: os.stat_result,
+        digest: str,
+        interrogator: str,
+        options: str,
+        output: os.PathLike
+    ) -> None:
+        self.put(self.source(source), Entry(
+            stat.st_size,
+            stat.st_mtime_ns,
+            digest,
+            interrogator,
+            options,
+            self.output(output)
+        ))
+
+    def failed(
+        self,
+        source: os.PathLike,
+        stat: os.stat_result,
+        interrogator: str,
+        options: str
+    ) -> None:
+        # unreadable images are recorded too, so the shards can be merged
+        self.put(self.source(source), Entry(
+            stat.st_size,
+            stat.st_mtime_ns,
+            '',
+            interrogator,
+            options,
+            '',
+            'failed'
+        ))
+
+    def source(self, source: os.PathLike) -> str:
+        # key of the source file
+        return Path(os.path.relpath(source, self.source_dir)).as_posix()
+
+    def output(self, output: os.PathLike) -> str:
+        return Path(os.path.relpath(output, self.path.parent)).as_posix()
+
+    def output_path(self, entry: Entry) -> Path:
+        return Path(self.path.parent, entry.output)
+
+    def relativize(self) -> None:
+        # manifests written before the paths were relative
+        rows = self.connection.execute(
+            'SELECT source, output FROM entries'
+        ).fetchall()
+
+        with self.connection:
+            for source, output in rows:
+                if not os.path.isabs(source):
+                    continue
+
+                # sources of other input directories never match again
+                if os.path.commonpath([source, self.source_dir]) != self.source_dir:
+                    self.connection.execute('DELETE FROM entries WHERE source = ?', (source,))
+                    continue
+
+                self.connection.execute(
+                    'UPDATE OR REPLACE entries SET source = ?, output = ? WHERE source = ?',
+                    (
+                        self.source(source),
+                        self.output(output) if output else '',
+                        source
+                    )
+                )
+
+            self.connection.execute('PRAGMA user_version = 1')
+
+    def put(self, source: str, entry: Entry) -> None:
+        with self.lock:
+            self.entries[source] = entry
+            self.connection.execute(insert, (source, *entry, time.time()))
+
+            # an interrupted run keeps most of its progress
+            self.pending += 1
+            if self.pending >= self.commit_interval:
+                self.connection.commit()
+                self.pending = 0
+
+    def update(self, entries: Dict[str, Entry]) -> None:
+        # entries recorded by other manifests, like the ones of the shards
+        with self.lock:
+            self.entries.update(entries)
+            self.connection.executemany(
+                insert,
+                [(source, *entry, time.time()) for source, entry in entries.items()]
+            )
+            self.connection.commit()
+            self.pending = 0
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
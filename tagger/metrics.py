@@ -0,0 +1,144 @@
+import time
+
+from typing import Dict, Iterator, List, Tuple
+from threading import Lock
+from contextlib import contextmanager
+
+# upper bounds of the duration histogram buckets in seconds
+buckets = [
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+]
+
+# order of the stages in the summaries
+stages = ['decode', 'preprocess', 'infer', 'postprocess', 'write']
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.images = 0
+
+    def observe(self, seconds: float, images: int) -> None:
+        index = next(
+            (i for i, bound in enumerate(buckets) if seconds <= bound),
+            len(buckets)
+        )
+        self.counts[index] += 1
+        self.sum += seconds
+        self.count += 1
+        self.images += images
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# duration and image count of each stage for each interrogator
+# observations are cheap, the text exposition is only built when scraped
+class Metrics:
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.histograms: Dict[Tuple[str, str], Histogram] = {}
+        self.counters: Dict[Tuple[str, str], int] = {}
+
+    def observe(
+        self,
+        stage: str,
+        interrogator: str,
+        seconds: float,
+        images=1
+    ) -> None:
+        with self.lock:
+            key = (interrogator, stage)
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+
+            self.histograms[key].observe(seconds, images)
+
+    def count(self, name: str, interrogator: str, value=1) -> None:
+        with self.lock:
+            key = (interrogator, name)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, stage: str, interrogator: str, images=1) -> Iterator[None]:
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(stage, interrogator, time.perf_counter() - start, images)
+
+    def totals(self, interrogator: str) -> Dict[str, Tuple[float, int]]:
+        # seconds and images of each stage, to summarize a single run
+        with self.lock:
+            return {
+                stage: (histogram.sum, histogram.images)
+                for (name, stage), histogram in self.histograms.items()
+                if name == interrogator
+            }
+
+    def summary(
+        self,
+        before: Dict[str, Tuple[float, int]],
+        after: Dict[str, Tuple[float, int]]
+    ) -> str:
+        parts = []
+
+        for stage in sorted(after, key=lambda s: stages.index(s) if s in stages else len(stages)):
+            seconds = after[stage][0] - before.get(stage, (0.0, 0))[0]
+            images = after[stage][1] - before.get(stage, (0.0, 0))[1]
+
+            if images > 0:
+                parts.append(f'{stage} {seconds:.2f}s')
+
+        return ', '.join(parts)
+
+    def render(self) -> str:
+        # https://prometheus.io/docs/instrumenting/exposition_formats/
+        lines: List[str] = []
+
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+
+        lines.append('# HELP tagger_stage_duration_seconds Time spent in each stage, '
+                     'inference is observed once for each batch.')
+        lines.append('# TYPE tagger_stage_duration_seconds histogram')
+
+        for (interrogator, stage), histogram in histograms:
+            labels = f'interrogator="{escape(interrogator)}",stage="{escape(stage)}"'
+
+            cumulative = 0
+            for bound, count in zip([*buckets, '+Inf'], histogram.counts):
+                cumulative += count
+                lines.append(
+                    f'tagger_stage_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}'
+                )
+
+            lines.append(f'tagger_stage_duration_seconds_sum{{{labels}}} {histogram.sum}')
+            lines.append(f'tagger_stage_duration_seconds_count{{{labels}}} {histogram.count}')
+
+        lines.append('# HELP tagger_stage_images_total Images processed by each stage.')
+        lines.append('# TYPE tagger_stage_images_total counter')
+
+        for (interrogator, stage), histogram in histograms:
+            labels = f'interrogator="{escape(interrogator)}",stage="{escape(stage)}"'
+            lines.append(f'tagger_stage_images_total{{{labels}}} {histogram.images}')
+
+        for name in sorted({name for (_, name), _ in counters}):
+            lines.append(f'# TYPE tagger_{name}_total counter')
+
+            for (interrogator, counter), value in counters:
+                if counter == name:
+                    lines.append(
+                        f'tagger_{name}_total{{interrogator="{escape(interrogator)}"}} {value}'
+                    )
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
@@ -0,0 +1,356 @@
+from queue import Queue
+from threading import Thread, Event, Lock
+from typing import Callable, Dict, Iterable, List, Optional, TypeVar, TYPE_CHECKING
+
+from PIL import Image
+
+from tagger.cache import ResultCache
+from tagger.interrogator import Interrogator, WaifuDiffusionInterrogator
+from tagger.metrics import metrics
+
+if TYPE_CHECKING:
+    from tagger.preprocess import ProcessPreprocessor
+
+Job = TypeVar('Job')
+
+# marks the end of the stream for the next stage
+_done = object()
+
+
+# streams jobs through decode, inference and write stages
+# decoding and preprocessing run on a thread pool, the model runs on the
+# calling thread and writer threads drain the results, so disk I/O and
+# image decoding overlap with the inference
+class Pipeline:
+    def __init__(
+        self,
+        interrogator: Interrogator,
+        batch_size=1,
+        decode_workers=2,
+        write_workers=1,
+        queue_depth=32,
+        processes=0,
+        cache: Optional[ResultCache] = None
+    ) -> None:
+        self.interrogator = interrogator
+        self.batch_size = max(int(batch_size), 1)
+        self.decode_workers = max(int(decode_workers), 1)
+        self.write_workers = max(int(write_workers), 1)
+        self.queue_depth = max(int(queue_depth), 1)
+        self.processes = max(int(processes), 0)
+        self.preprocessor: Optional['ProcessPreprocessor'] = None
+        self.cache = cache
+        self.load_lock = Lock()
+
+        # only onnx models have a preprocessing that runs without the model
+        if (
+            self.processes > 0
+            and not isinstance(interrogator, WaifuDiffusionInterrogator)
+        ):
+            print(f'{interrogator.name} does not support preprocessing processes')
+            self.processes = 0
+
+        # each decoder thread waits for one process at a time
+        if self.processes > 0:
+            self.decode_workers = max(self.decode_workers, self.processes)
+
+        self.stop = Event()
+        self.errors: List[BaseException] = []
+
+    def fail(self, error: BaseException) -> None:
+        # remember the first error and let every stage drain its queue
+        self.errors.append(error)
+        self.stop.set()
+
+    def load(self, slots: int) -> None:
+        # processes are started by the first decoder that misses the cache
+        with self.load_lock:
+            if self.processes > 0 and self.preprocessor is None:
+                from tagger.preprocess import ProcessPreprocessor
+
+                with self.interrogator.using():
+                    size = self.interrogator.input_size
+
+                self.preprocessor = ProcessPreprocessor(
+                    size,
+                    self.processes,
+                    slots
+                )
+
+    def feed(self, jobs: Iterable[Job], inputs: Queue) -> None:
+        try:
+            for job in jobs:
+                if self.stop.is_set():
+                    break
+
+                inputs.put(job)
+        except Exception as error:
+            self.fail(error)
+        finally:
+            for _ in range(self.decode_workers):
+                inputs.put(_done)
+
+    def decode(
+        self,
+        decode: Callable[[Job], Optional[Image.Image]],
+        digest: Optional[Callable[[Job], str]],
+        failed: Optional[Callable[[Job], None]],
+        inputs: Queue,
+        decoded: Queue,
+        results: Queue
+    ) -> None:
+        # enough slots for every queued, batched and in-flight tensor
+        # so that decoders never wait for the inference stage
+        slots = decoded.maxsize + self.batch_size + self.decode_workers
+
+        while True:
+            job = inputs.get()
+
+            if job is _done:
+                decoded.put(_done)
+                break
+
+            if self.stop.is_set():
+                continue
+
+            try:
+                key = None
+
+                # cached results skip decoding and inference
+                if self.cache is not None and digest is not None:
+                    try:
+                        key = digest(job)
+                    except OSError as error:
+                        # removed or unreadable since it has been found
+                        print(f'{error}, could not read the image')
+
+                        if failed is not None:
+                            failed(job)
+                        continue
+
+                    cached = self.cache.get(key, self.interrogator.cache_key)
+
+                    if cached is not None:
+                        metrics.count('cache_hits', self.interrogator.name)
+                        results.put((job, *cached))
+                        continue
+
+                with metrics.timer('decode', self.interrogator.name):
+                    image = decode(job)
+
+                # decoder can skip the job by returning nothing
+                if image is None:
+                    if failed is not None:
+                        failed(job)
+                    continue
+
+                self.load(slots)
+
+                if self.preprocessor is None:
+                    decoded.put(
+                        (job, self.interrogator.preprocess(image), None, key)
+                    )
+                    continue
+
+                # with preprocessing processes, decoder returns the image path
+                # and the file is opened by the worker process
+                with metrics.timer('preprocess', self.interrogator.name):
+                    processed = self.preprocessor.preprocess(image)
+                if processed is None:
+                    print(f'{image} is not supported image type')
+
+                    if failed is not None:
+                        failed(job)
+                    continue
+
+                slot, tensor = processed
+                decoded.put((job, tensor, slot, key))
+            except Exception as error:
+                self.fail(error)
+
+    def write(
+        self,
+        write: Callable[[Job, Dict[str, float], Dict[str, float]], None],
+        results: Queue
+    ) -> None:
+        while True:
+            result = results.get()
+
+            if result is _done:
+                break
+
+            if self.stop.is_set():
+                continue
+
+            try:
+                write(*result)
+            except Exception as error:
+                self.fail(error)
+
+    def run(
+        self,
+        jobs: Iterable[Job],
+        decode: Callable[[Job], Optional[Image.Image]],
+        write: Callable[[Job, Dict[str, float], Dict[str, float]], None],
+        digest: Optional[Callable[[Job], str]] = None,
+        failed: Optional[Callable[[Job], None]] = None
+    ) -> None:
+        # failed is called with the jobs whose image could not be read
+        inputs = Queue(self.queue_depth)
+        decoded = Queue(max(self.queue_depth, self.batch_size))
+        results = Queue(self.queue_depth)
+
+        threads = [
+            Thread(target=self.feed, args=(jobs, inputs), daemon=True),
+            *[
+                Thread(
+                    target=self.decode,
+                    args=(decode, digest, failed, inputs, decoded, results),
+                    daemon=True
+                )
+                for _ in range(self.decode_workers)
+            ]
+        ]
+
+        writers = [
+            Thread(target=self.write, args=(write, results), daemon=True)
+            for _ in range(self.write_workers)
+        ]
+
+        for thread in [*threads, *writers]:
+            thread.start()
+
+        batch = []
+
+        def evaluate():
+            try:
+                outputs = self.interrogator.evaluate(
+                    [tensor for _, tensor, _, _ in batch],
+                    self.batch_size
+                )
+
+                for (job, _, _, key), (ratings, tags) in zip(batch, outputs):
+                    if key is not None:
+                        self.cache.put(
+                            key,
+                            self.interrogator.cache_key,
+                            ratings,
+                            tags
+                        )
+
+                    results.put((job, ratings, tags))
+            except Exception as error:
+                self.fail(error)
+
+            release(batch)
+
+        def release(items):
+            if self.preprocessor is not None:
+                for _, _, slot, _ in items:
+                    self.preprocessor.release(slot)
+
+            items.clear()
+
+        # inference stage, runs until every decoder has finished
+        running_decoders = self.decode_workers
+        while running_decoders > 0:
+            item = decoded.get()
+
+            if item is _done:
+                running_decoders -= 1
+                continue
+
+            if self.stop.is_set():
+                release([item])
+                continue
+
+            batch.append(item)
+
+            if len(batch) >= self.batch_size:
+                evaluate()
+
+        if len(batch) > 0 and not self.stop.is_set():
+            evaluate()
+
+        release(batch)
+
+        for _ in writers:
+            results.put(_done)
+
+        for thread in [*threads, *writers]:
+            thread.join()
+
+        if self.preprocessor is not None:
+            self.preprocessor.close()
+            self.preprocessor = None
+
+        if len(self.errors) > 0:
+            raise self.errors[0]
+
+    def run_batched(
+        self,
+        jobs: Iterable[Job],
+        decode: Callable[[Job], Optional[Image.Image]],
+        write: Callable[[Job, Dict[str, float], Dict[str, float]], None],
+        digest: Optional[Callable[[Job], str]] = None,
+        failed: Optional[Callable[[Job], None]] = None
+    ) -> None:
+        # same stages one after another on the calling thread, a batch is
+        # decoded, evaluated and written before the next one is read
+        # slower than run, but uses a single thread and the least memory
+        batch = []
+
+        def evaluate():
+            outputs = self.interrogator.evaluate(
+                [tensor for _, tensor, _ in batch],
+                self.batch_size
+            )
+
+            for (job, _, key), (ratings, tags) in zip(batch, outputs):
+                if key is not None:
+                    self.cache.put(
+                        key,
+                        self.interrogator.cache_key,
+                        ratings,
+                        tags
+                    )
+
+                write(job, ratings, tags)
+
+            batch.clear()
+
+        for job in jobs:
+            key = None
+
+            if self.cache is not None and digest is not None:
+                try:
+                    key = digest(job)
+                except OSError as error:
+                    print(f'{error}, could not read the image')
+
+                    if failed is not None:
+                        failed(job)
+                    continue
+
+                cached = self.cache.get(key, self.interrogator.cache_key)
+
+                if cached is not None:
+                    metrics.count('cache_hits', self.interrogator.name)
+                    write(job, *cached)
+                    continue
+
+            with metrics.timer('decode', self.interrogator.name):
+                image = decode(job)
+
+            if image is None:
+                if failed is not None:
+                    failed(job)
+                continue
+
+            batch.append((job, self.interrogator.preprocess(image), key))
+
+            if len(batch) >= self.batch_size:
+                evaluate()
+
+        if len(batch) > 0:
+            evaluate()
@@ -0,0 +1,211 @@
+import os
+import sys
+import site
+import multiprocessing
+
+import cv2
+import numpy as np
+
+from typing import Iterator, Optional, Tuple
+from types import ModuleType
+from pathlib import Path
+from queue import Queue
+from threading import Lock
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from PIL import Image, ImageFile
+
+# i'm not sure if it's okay to add this file to the repository
+from tagger import dbimutils
+
+# directory which contains the tagger package, worker processes may not have it on sys.path
+extension_dir = str(Path(__file__).parent.parent)
+
+
+def fill_transparent(image: Image.Image) -> Image.Image:
+    # alpha to white
+    image = image.convert('RGBA')
+    new_image = Image.new('RGBA', image.size, 'WHITE')
+    new_image.paste(image, mask=image)
+    return new_image.convert('RGB')
+
+
+def wd14_tensor(
+    image: Image.Image,
+    size: int,
+    out: Optional[np.ndarray] = None
+) -> np.ndarray:
+    # code for converting the image and running the model is taken from the link below
+    # thanks, SmilingWolf!
+    # https://huggingface.co/spaces/SmilingWolf/wd-v1-4-tags/blob/main/app.py
+    #
+    # fill_transparent, RGB to BGR, make_square and smart_resize in one pass,
+    # written into out when it is given, like a slot of the batch buffer
+    return dbimutils.wd14_preprocess(image, size, out)
+
+
+def pad_edge(image: np.ndarray, axis: int, size: int) -> np.ndarray:
+    # centers the image on the axis and repeats the edge pixels, like
+    # skimage.transform.warp with mode='edge' does with a centering translation
+    padding = size - image.shape[axis]
+    if padding < 1:
+        return image
+
+    widths = [(0, 0)] * image.ndim
+
+    # odd padding shifts the image by a half pixel, which is bilinear interpolated
+    if padding % 2:
+        widths[axis] = (padding // 2 + 1, padding // 2 + 1)
+        image = np.pad(image, widths, mode='edge')
+
+        head = [slice(None)] * image.ndim
+        tail = [slice(None)] * image.ndim
+        head[axis] = slice(None, -1)
+        tail[axis] = slice(1, None)
+        return (image[tuple(head)] + image[tuple(tail)]) * 0.5
+
+    widths[axis] = (padding // 2, padding // 2)
+    return np.pad(image, widths, mode='edge')
+
+
+def deepdanbooru_tensor(
+    image: Image.Image,
+    width: int,
+    height: int
+) -> np.ndarray:
+    # same conversion as deepdanbooru.data.load_image_for_evaluate,
+    # without encoding the image to png and decoding it with tensorflow again
+    image = np.asarray(image.convert('RGB'), dtype=np.float32)
+
+    # fit the image into the input while keeping the aspect ratio
+    scale = min(height / image.shape[0], width / image.shape[1])
+    new_width = max(int(round(image.shape[1] * scale)), 1)
+    new_height = max(int(round(image.shape[0] * scale)), 1)
+
+    if (new_width, new_height) != (image.shape[1], image.shape[0]):
+        image = cv2.resize(
+            image,
+            (new_width, new_height),
+            interpolation=cv2.INTER_AREA
+        )
+
+    image = pad_edge(image, 0, height)
+    image = pad_edge(image, 1, width)
+
+    return image / np.float32(255)
+
+
+# spawned processes import the __main__ module of the parent before they
+# run anything, which is the whole webui, or a script that starts the batch
+# again without a main guard. workers only need this module, so they are
+# started while __main__ is an empty module, the lock keeps threads which
+# start workers at the same time from restoring each other's stand-in
+_main_lock = Lock()
+
+
+@contextmanager
+def _without_main() -> Iterator[None]:
+    with _main_lock:
+        main = sys.modules['__main__']
+        sys.modules['__main__'] = ModuleType('__main__')
+
+        try:
+            yield
+        finally:
+            sys.modules['__main__'] = main
+
+
+# shared memory attached by the worker process
+_worker_memory: Optional[SharedMemory] = None
+
+
+def _worker_preprocess(
+    memory_name: str,
+    shape: Tuple[int, int, int, int],
+    slot: int,
+    path: os.PathLike
+) -> bool:
+    global _worker_memory
+
+    ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+    if _worker_memory is None or _worker_memory.name != memory_name:
+        _worker_memory = SharedMemory(memory_name)
+
+    buffer = np.ndarray(shape, dtype=np.float32, buffer=_worker_memory.buf)
+
+    # broken files raise while they are decoded, not only when opened
+    try:
+        wd14_tensor(Image.open(path), shape[1], buffer[slot])
+    except OSError:
+        return False
+
+    return True
+
+
+# decodes and preprocesses image files on worker processes
+# tensors are returned through a shared memory slot instead of being pickled
+class ProcessPreprocessor:
+    def __init__(self, size: int, workers: int, slots: int) -> None:
+        self.shape = (slots, size, size, 3)
+        self.memory = SharedMemory(
+            create=True,
+            size=int(np.prod(self.shape)) * np.dtype(np.float32).itemsize
+        )
+        self.buffer = np.ndarray(
+            self.shape,
+            dtype=np.float32,
+            buffer=self.memory.buf
+        )
+
+        self.free_slots = Queue()
+        for slot in range(slots):
+            self.free_slots.put(slot)
+
+        # the pool is started by a decoder thread while other threads run,
+        # forked workers could inherit locks held by them, like the ones of
+        # the thread pool of opencv, and hang
+        self.executor = ProcessPoolExecutor(
+            workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=site.addsitedir,
+            initargs=(extension_dir,)
+        )
+
+    def preprocess(self, path: os.PathLike) -> Optional[Tuple[int, np.ndarray]]:
+        # blocks until a slot is released by the consumer
+        slot = self.free_slots.get()
+
+        try:
+            # workers are started by the pool on demand, while submitting
+            with _without_main():
+                future = self.executor.submit(
+                    _worker_preprocess,
+                    self.memory.name,
+                    self.shape,
+                    slot,
+                    str(path)
+                )
+
+            loaded = future.result()
+        except BaseException:
+            self.release(slot)
+            raise
+
+        if not loaded:
+            self.release(slot)
+            return None
+
+        return slot, self.buffer[slot]
+
+    def release(self, slot: int) -> None:
+        self.free_slots.put(slot)
+
+    def close(self) -> None:
+        self.executor.shutdown()
+
+        # numpy view must be gone before closing the mapping
+        del self.buffer
+        self.memory.close()
+        self.memory.unlink()
@@ -0,0 +1,174 @@
+import os
+
+from typing import Dict, Iterable
+from itertools import islice
+from pathlib import Path
+from PIL import Image
+
+import numpy as np
+
+# int8 quantizes weights and computes activations on the fly, best on cpu
+# fp16 halves weights and activations, best on gpu
+quantizations = ['int8', 'fp16']
+
+
+def quantized_model_path(model_path: Path, quantization: str) -> Path:
+    return model_path.with_name(
+        f'{model_path.stem}.{quantization}{model_path.suffix}'
+    )
+
+
+def quantize(model_path: os.PathLike, quantization: str) -> Path:
+    # generates the quantized model next to the original once and reuses it
+    if quantization not in quantizations:
+        raise ValueError(f'unknown quantization {quantization}')
+
+    model_path = Path(model_path)
+    output_path = quantized_model_path(model_path, quantization)
+
+    if output_path.is_file() and output_path.stat().st_mtime >= model_path.stat().st_mtime:
+        return output_path
+
+    print(f'Quantizing {model_path} to {quantization}')
+
+    from launch import is_installed, run_pip
+    if not is_installed('onnx'):
+        run_pip('install onnx', 'onnx')
+
+    # write to a temporary file so other processes never read a partial model
+    temp_path = output_path.with_name(f'{output_path.name}.{os.getpid()}.tmp')
+
+    try:
+        if quantization == 'int8':
+            # https://onnxruntime.ai/docs/performance/model-optimizations/quantization.html#dynamic-quantization
+            from onnxruntime.quantization import quantize_dynamic
+            quantize_dynamic(model_path, temp_path)
+
+        elif quantization == 'fp16':
+            try:
+                from onnxconverter_common import float16
+            except ImportError:
+                run_pip('install onnxconverter-common', 'onnxconverter-common')
+                from onnxconverter_common import float16
+
+            import onnx
+
+            # inputs and outputs stay float32, so the preprocessing does not change
+            model = float16.convert_float_to_float16(
+                onnx.load(str(model_path)),
+                keep_io_types=True
+            )
+            onnx.save(model, str(temp_path))
+
+        os.replace(temp_path, output_path)
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
+
+    print(f'Saved {quantization} model to {output_path}')
+
+    return output_path
+
+
+def compare(
+    reference,
+    variant,
+    images: Iterable[Image.Image],
+    threshold=0.35,
+    k=10,
+    batch_size=8,
+    worst_tags=20
+) -> Dict[str, object]:
+    # runs both interrogators on the same images and measures how much the
+    # variant agrees with the reference at the threshold, images are taken
+    # one batch at a time, so a generator keeps only that batch in memory
+    images_count = 0
+    decisions = 0
+    agreed_decisions = 0
+    agreed_ratings = 0
+    top_k_overlap = 0.0
+    absolute_error = 0.0
+    max_absolute_error = 0.0
+    either = None
+    both = None
+
+    images = iter(images)
+
+    while True:
+        chunk = list(islice(images, batch_size))
+        if len(chunk) < 1:
+            break
+
+        expected = np.stack(reference.interrogate_batch(chunk, batch_size, raw=True))
+        actual = np.stack(variant.interrogate_batch(chunk, batch_size, raw=True))
+
+        if expected.shape != actual.shape:
+            raise ValueError(
+                f'{reference.name} and {variant.name} have different outputs'
+            )
+
+        ratings = len(reference.rating_names)
+
+        if ratings > 0:
+            agreed_ratings += int(np.count_nonzero(
+                expected[:, :ratings].argmax(axis=1)
+                == actual[:, :ratings].argmax(axis=1)
+            ))
+
+        expected = expected[:, ratings:].astype(np.float64)
+        actual = actual[:, ratings:].astype(np.float64)
+
+        expected_tags = expected >= threshold
+        actual_tags = actual >= threshold
+
+        if either is None:
+            either = np.zeros(expected.shape[1], np.int64)
+            both = np.zeros(expected.shape[1], np.int64)
+
+        either += np.count_nonzero(expected_tags | actual_tags, axis=0)
+        both += np.count_nonzero(expected_tags & actual_tags, axis=0)
+
+        decisions += expected_tags.size
+        agreed_decisions += int(np.count_nonzero(expected_tags == actual_tags))
+
+        top = min(k, expected.shape[1])
+        expected_top = np.argsort(-expected, axis=1, kind='stable')[:, :top]
+        actual_top = np.argsort(-actual, axis=1, kind='stable')[:, :top]
+
+        for e, a in zip(expected_top, actual_top):
+            top_k_overlap += len(np.intersect1d(e, a)) / top
+
+        error = np.abs(expected - actual)
+        absolute_error += float(error.sum())
+        max_absolute_error = max(max_absolute_error, float(error.max()))
+
+        images_count += len(chunk)
+
+    if images_count < 1:
+        raise ValueError('no images to compare')
+
+    # tags found by either model, agreement is the intersection over union
+    found = np.flatnonzero(either)
+    agreements = both[found] / either[found]
+    order = np.argsort(agreements, kind='stable')[:worst_tags]
+
+    names = reference.tag_names.names
+
+    return {
+        'images': images_count,
+        'threshold': threshold,
+        'k': k,
+        'tag_agreement': float(agreements.mean()) if len(found) > 0 else 1.0,
+        'decision_agreement': agreed_decisions / decisions,
+        'rating_agreement': (
+            agreed_ratings / images_count
+            if len(reference.rating_names) > 0 else 1.0
+        ),
+        'top_k_overlap': top_k_overlap / images_count,
+        'mean_absolute_error': absolute_error / decisions,
+        'max_absolute_error': max_absolute_error,
+        'worst_tags': {
+            names[found[i]]: float(agreements[i])
+            for i in order
+        }
+    }
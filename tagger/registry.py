@@ -0,0 +1,215 @@
+import os
+import json
+
+from typing import Dict, Optional, Tuple
+from pathlib import Path
+from threading import Lock
+
+# interrogator definitions read from a json or yaml file
+#
+# {
+#     "offline": true,
+#     "cache_dir": "/models/huggingface",
+#     "interrogators": {
+#         "wd14-vit-v2": {
+#             "model_path": "/models/wd14-vit-v2/model.onnx",
+#             "tags_path": "/models/wd14-vit-v2/selected_tags.csv"
+#         },
+#         "my-tagger": {
+#             "repo_id": "someone/my-tagger",
+#             "revision": "v1.0",
+#             "session_options": {"intra_op_threads": 4}
+#         },
+#         "my-deepdanbooru": {
+#             "type": "deepdanbooru",
+#             "project_path": "/models/my-deepdanbooru"
+#         }
+#     }
+# }
+#
+# relative paths are relative to the file, entries with the name of a
+# built-in interrogator replace it
+#
+# session_options override the onnxruntime options of the command line:
+# intra_op_threads, inter_op_threads, execution_mode, optimization_level,
+# cache_optimized_model and mmap
+Definitions = Dict[str, Dict[str, object]]
+
+filenames = ['interrogators.json', 'interrogators.yaml', 'interrogators.yml']
+
+
+class Registry:
+    path: Optional[Path]
+    offline: bool
+    cache_dir: Optional[str]
+    definitions: Definitions
+
+    def __init__(
+        self,
+        base_dir: os.PathLike,
+        path: Optional[os.PathLike] = None,
+        offline=False
+    ) -> None:
+        self.base_dir = Path(base_dir)
+        self.path = Path(path) if path else None
+
+        # the hub is never contacted when set on the command line
+        self.offline_option = offline
+        self.offline = offline
+        self.cache_dir = None
+        self.definitions = {}
+
+        # file and its mtime when it has been read
+        self.loaded: Optional[Tuple[str, int]] = None
+
+        # (filename, repo_id, revision, cache_dir) -> local file
+        # the hub is asked at most once for each file while the process runs
+        self.resolved: Dict[Tuple[str, Optional[str], Optional[str], Optional[str]], Path] = {}
+        self.lock = Lock()
+
+    def find(self) -> Optional[Path]:
+        if self.path is not None:
+            return self.path
+
+        for filename in filenames:
+            path = self.base_dir.joinpath(filename)
+            if path.is_file():
+                return path
+
+        return None
+
+    def load(self, force=False) -> Definitions:
+        path = self.find()
+
+        # files may have been added to or moved out of the cache
+        if force:
+            with self.lock:
+                self.resolved.clear()
+
+        if path is None or not path.is_file():
+            if path is not None:
+                print(f'Interrogator registry {path} does not exist')
+
+            self.loaded = None
+            self.offline = self.offline_option
+            self.cache_dir = None
+            self.definitions = {}
+            return self.definitions
+
+        loaded = (str(path), path.stat().st_mtime_ns)
+        if not force and loaded == self.loaded:
+            return self.definitions
+
+        text = path.read_text(encoding='utf-8')
+
+        if path.suffix.lower() in ['.yaml', '.yml']:
+            import yaml
+            config = yaml.safe_load(text) or {}
+        else:
+            config = json.loads(text)
+
+        self.offline = self.offline_option or bool(config.get('offline', False))
+        self.cache_dir = self.local_path(path, config.get('cache_dir'))
+
+        self.definitions = {}
+
+        for name, definition in config.get('interrogators', {}).items():
+            definition = dict(definition)
+
+            for key in ['model_path', 'tags_path', 'project_path', 'cache_dir']:
+                if key in definition and self.is_local(definition, key):
+                    definition[key] = self.local_path(path, definition[key])
+
+            if self.cache_dir is not None:
+                definition.setdefault('cache_dir', self.cache_dir)
+
+            self.definitions[name] = definition
+
+        self.loaded = loaded
+
+        # definitions may point to other files now
+        with self.lock:
+            self.resolved.clear()
+
+        return self.definitions
+
+    @staticmethod
+    def is_local(definition: Dict[str, object], key: str) -> bool:
+        # model and tags paths are file names in the repository
+        # unless there is no repository to download them from
+        if key in ['project_path', 'cache_dir']:
+            return True
+
+        return 'repo_id' not in definition or Path(definition[key]).is_absolute()
+
+    @staticmethod
+    def local_path(path: Path, value: Optional[str]) -> Optional[str]:
+        if value is None:
+            return None
+
+        return str(path.parent.joinpath(os.path.expanduser(value)))
+
+    def resolve(
+        self,
+        filename: str,
+        repo_id: Optional[str] = None,
+        revision: Optional[str] = None,
+        cache_dir: Optional[str] = None,
+        **kwargs
+    ) -> Path:
+        key = (filename, repo_id, revision, cache_dir)
+
+        with self.lock:
+            if key in self.resolved:
+                return self.resolved[key]
+
+        if repo_id is None or Path(filename).is_absolute():
+            path = Path(filename)
+
+            if not path.is_file():
+                raise FileNotFoundError(f'{path} does not exist')
+        else:
+            path = self.download(filename, repo_id, revision, cache_dir, **kwargs)
+
+        with self.lock:
+            self.resolved[key] = path
+
+        return path
+
+    def download(
+        self,
+        filename: str,
+        repo_id: str,
+        revision: Optional[str],
+        cache_dir: Optional[str],
+        **kwargs
+    ) -> Path:
+        from huggingface_hub import hf_hub_download
+
+        # files in the cache are used as they are, without asking the hub
+        # whether the revision has moved on
+        try:
+            return Path(hf_hub_download(
+                repo_id,
+                filename,
+                revision=revision,
+                cache_dir=cache_dir,
+                local_files_only=True,
+                **kwargs
+            ))
+        except (OSError, ValueError):
+            # older huggingface_hub raises ValueError for missing files
+            if self.offline:
+                raise FileNotFoundError(
+                    f'{filename} of {repo_id} is not in the cache and downloads are disabled'
+                )
+
+        print(f'Downloading {filename} from {repo_id}')
+
+        return Path(hf_hub_download(
+            repo_id,
+            filename,
+            revision=revision,
+            cache_dir=cache_dir,
+            **kwargs
+        ))
@@ -0,0 +1,241 @@
+import os
+
+from typing import Dict, List, Optional, Tuple
+from pathlib import Path
+
+from modules import shared
+
+from .weights import MappedWeights
+
+# https://onnxruntime.ai/docs/performance/tune-performance/threading.html
+execution_modes = {
+    'sequential': 'ORT_SEQUENTIAL',
+    'parallel': 'ORT_PARALLEL'
+}
+
+# https://onnxruntime.ai/docs/performance/model-optimizations/graph-optimizations.html
+optimization_levels = {
+    'disable': 'ORT_DISABLE_ALL',
+    'basic': 'ORT_ENABLE_BASIC',
+    'extended': 'ORT_ENABLE_EXTENDED',
+    'all': 'ORT_ENABLE_ALL'
+}
+
+
+def default_options() -> Dict[str, object]:
+    # every interrogator uses these unless it overrides them
+    return {
+        'intra_op_threads': getattr(shared.cmd_opts, 'tagger_intra_op_threads', 0),
+        'inter_op_threads': getattr(shared.cmd_opts, 'tagger_inter_op_threads', 0),
+        'execution_mode': getattr(shared.cmd_opts, 'tagger_execution_mode', 'sequential'),
+        'optimization_level': getattr(shared.cmd_opts, 'tagger_optimization_level', 'all'),
+        'cache_optimized_model': getattr(shared.cmd_opts, 'tagger_cache_optimized_model', False),
+        'mmap': getattr(shared.cmd_opts, 'tagger_mmap_models', False)
+    }
+
+
+def check_options(options: Dict[str, object]) -> None:
+    # options of the registry are typed by hand, a misspelled one would
+    # silently fall back to the command line value
+    unknown = [key for key in options if key not in default_options()]
+    if len(unknown) > 0:
+        raise ValueError(
+            f"unknown session options {', '.join(unknown)}, "
+            f"use {', '.join(default_options())}"
+        )
+
+    for key, values in [
+        ('execution_mode', execution_modes),
+        ('optimization_level', optimization_levels)
+    ]:
+        if key in options and options[key] not in values:
+            raise ValueError(
+                f"unknown {key} {options[key]}, use one of {', '.join(values)}"
+            )
+
+
+def saved_optimization_level(optimization_level: str) -> str:
+    # layout optimizations of all are made for the cpu that runs them and the
+    # cache may be shared by other hosts, they are applied when loading instead
+    # https://onnxruntime.ai/docs/performance/model-optimizations/graph-optimizations.html#onlineoffline-mode
+    return 'extended' if optimization_level == 'all' else optimization_level
+
+
+def optimized_model_path(
+    model_path: Path,
+    optimization_level: str,
+    provider: str
+) -> Path:
+    # optimized graph may contain nodes only the provider can run
+    optimization_level = saved_optimization_level(optimization_level)
+    return model_path.with_name(
+        f'{model_path.stem}.{optimization_level}.{provider}{model_path.suffix}'
+    )
+
+
+def create_session(
+    model_path: os.PathLike,
+    providers: List[str],
+    options: Optional[Dict[str, object]] = None
+) -> Tuple[object, Path, Optional[MappedWeights]]:
+    # returns the session, the model file it has been created from
+    # and the mapped weights the session runs on, which must outlive it
+    from onnxruntime import (
+        InferenceSession,
+        SessionOptions,
+        ExecutionMode,
+        GraphOptimizationLevel,
+        get_available_providers
+    )
+
+    check_options(options or {})
+    options = {**default_options(), **(options or {})}
+    model_path = Path(model_path)
+
+    session_options = SessionOptions()
+    session_options.intra_op_num_threads = int(options['intra_op_threads'])
+    session_options.inter_op_num_threads = int(options['inter_op_threads'])
+    session_options.execution_mode = getattr(
+        ExecutionMode,
+        execution_modes[options['execution_mode']]
+    )
+    session_options.graph_optimization_level = getattr(
+        GraphOptimizationLevel,
+        optimization_levels[options['optimization_level']]
+    )
+
+    if options['mmap']:
+        return create_mapped_session(model_path, providers, options, session_options)
+
+    if not options['cache_optimized_model'] or options['optimization_level'] == 'disable':
+        session = InferenceSession(
+            str(model_path),
+            sess_options=session_options,
+            providers=providers
+        )
+        return session, model_path, None
+
+    available = get_available_providers()
+    provider = next((p for p in providers if p in available), 'CPUExecutionProvider')
+    optimized_path = optimized_model_path(
+        model_path,
+        options['optimization_level'],
+        provider
+    )
+
+    # graph has been optimized on a previous run, skip optimizing it again
+    # except for the optimizations which are never saved
+    load_level = GraphOptimizationLevel.ORT_DISABLE_ALL
+    if options['optimization_level'] == 'all':
+        load_level = GraphOptimizationLevel.ORT_ENABLE_ALL
+
+    if optimized_path.is_file() and optimized_path.stat().st_mtime >= model_path.stat().st_mtime:
+        session_options.graph_optimization_level = load_level
+
+        try:
+            session = InferenceSession(
+                str(optimized_path),
+                sess_options=session_options,
+                providers=providers
+            )
+            return session, optimized_path, None
+        except Exception as e:
+            print(f'Failed to load optimized model {optimized_path}: {e}')
+
+    # onnxruntime saves the graph while creating the session,
+    # write to a temporary file so other processes never read a partial model
+    temp_path = optimized_path.with_name(f'{optimized_path.name}.{os.getpid()}.tmp')
+    session_options.optimized_model_filepath = str(temp_path)
+    session_options.graph_optimization_level = getattr(
+        GraphOptimizationLevel,
+        optimization_levels[saved_optimization_level(options['optimization_level'])]
+    )
+
+    try:
+        session = InferenceSession(
+            str(model_path),
+            sess_options=session_options,
+            providers=providers
+        )
+        os.replace(temp_path, optimized_path)
+        print(f'Saved optimized model to {optimized_path}')
+    except Exception as e:
+        # directory may be read only
+        print(f'Failed to save optimized model to {optimized_path}: {e}')
+
+        if temp_path.exists():
+            temp_path.unlink()
+
+        session_options.optimized_model_filepath = ''
+        session_options.graph_optimization_level = getattr(
+            GraphOptimizationLevel,
+            optimization_levels[options['optimization_level']]
+        )
+        session = InferenceSession(
+            str(model_path),
+            sess_options=session_options,
+            providers=providers
+        )
+
+        return session, model_path, None
+
+    # saved graph is missing the optimizations made on loading
+    if load_level != GraphOptimizationLevel.ORT_DISABLE_ALL:
+        session_options.optimized_model_filepath = ''
+        session_options.graph_optimization_level = load_level
+        session = InferenceSession(
+            str(optimized_path),
+            sess_options=session_options,
+            providers=providers
+        )
+        return session, optimized_path, None
+
+    return session, model_path, None
+
+
+def create_mapped_session(
+    model_path: Path,
+    providers: List[str],
+    options: Dict[str, object],
+    session_options
+) -> Tuple[object, Path, MappedWeights]:
+    from onnxruntime import InferenceSession, GraphOptimizationLevel, get_available_providers
+
+    # optimizations which transform weights make private copies of them,
+    # the cached optimized model has its weights transformed already
+    # layout optimizations of all are not cached, see saved_optimization_level,
+    # and not applied either, so that every weight stays mapped
+    if options['cache_optimized_model'] and options['optimization_level'] != 'disable':
+        available = get_available_providers()
+        provider = next((p for p in providers if p in available), 'CPUExecutionProvider')
+        optimized_path = optimized_model_path(
+            model_path,
+            options['optimization_level'],
+            provider
+        )
+
+        # optimizes and saves the model on the first load, that session is thrown away
+        if not optimized_path.is_file() or optimized_path.stat().st_mtime < model_path.stat().st_mtime:
+            create_session(model_path, providers, {
+                **options,
+                'mmap': False,
+                'optimization_level': saved_optimization_level(options['optimization_level'])
+            })
+
+        if optimized_path.is_file():
+            model_path = optimized_path
+            session_options.graph_optimization_level = GraphOptimizationLevel.ORT_DISABLE_ALL
+
+    weights = MappedWeights(model_path)
+    weights.add_to(session_options)
+
+    # prepacked weights would be private copies of the mapped ones
+    session_options.add_session_config_entry('session.disable_prepacking', '1')
+
+    session = InferenceSession(
+        str(weights.graph_path),
+        sess_options=session_options,
+        providers=providers
+    )
+
+    return session, weights.graph_path, weights
@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import hashlib
+
+from typing import Dict, Iterable, List, NamedTuple, Optional
+from pathlib import Path
+
+from tagger.manifest import Entry, Manifest
+
+# a batch is split between workers by the hash of the relative path of each
+# image, so every worker finds its own images without talking to the others
+#
+# workers keep a manifest of their own, since sqlite must not be written by
+# several hosts on a shared filesystem, and write a summary when they finish
+
+
+def shard_of(relative: str, count: int) -> int:
+    # same on every host and python version, unlike hash()
+    digest = hashlib.sha1(relative.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count
+
+
+def manifest_name(index: int, count: int) -> str:
+    return f'.tagger-manifest.{index}-of-{count}.db'
+
+
+def summary_path(manifest_dir: os.PathLike, index: int, count: int) -> Path:
+    return Path(manifest_dir, f'.tagger-shard.{index}-of-{count}.json')
+
+
+def write_summary(
+    manifest_dir: os.PathLike,
+    index: int,
+    count: int,
+    interrogator: str,
+    options: str,
+    processed: int,
+    skipped: int,
+    discovered: int,
+    elapsed: float
+) -> None:
+    path = summary_path(manifest_dir, index, count)
+    temp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    temp_path.write_text(json.dumps({
+        'index': index,
+        'count': count,
+        'interrogator': interrogator,
+        'options': options,
+        'processed': processed,
+        'skipped': skipped,
+        'discovered': discovered,
+        'elapsed': elapsed,
+        'finished': time.time()
+    }))
+    os.replace(temp_path, path)
+
+
+class MergeResult(NamedTuple):
+    complete: bool
+    images: int
+    merged: int
+    processed: int
+    missing: List[str]
+    failed: List[str]
+    problems: List[str]
+
+
+def merge(
+    paths: Iterable[Path],
+    base_dir: os.PathLike,
+    manifest_dir: os.PathLike,
+    count: int,
+    max_missing=20
+) -> MergeResult:
+    # checks every image of the batch has been tagged, or could not be read,
+    # by its shard with the same model and settings, then adds the shard
+    # manifests to the manifest of the output directory, so later runs
+    # without shards skip them too
+    problems = []
+    summaries: List[Optional[Dict[str, object]]] = []
+
+    for index in range(count):
+        path = summary_path(manifest_dir, index, count)
+
+        if not path.is_file():
+            problems.append(f'shard {index} of {count} has not finished')
+            summaries.append(None)
+            continue
+
+        summaries.append(json.loads(path.read_text()))
+
+    finished = [s for s in summaries if s is not None]
+    for key in ['interrogator', 'options']:
+        if len({s[key] for s in finished}) > 1:
+            problems.append(f'shards have been run with different {key}')
+
+    entries: List[Dict[str, Entry]] = []
+    for index in range(count):
+        if not Path(manifest_dir, manifest_name(index, count)).is_file():
+            entries.append({})
+            continue
+
+        manifest = Manifest(manifest_dir, base_dir, name=manifest_name(index, count))
+        entries.append(manifest.entries)
+        manifest.close()
+
+    images = 0
+    missing = []
+    failed = []
+    merged: Dict[str, Entry] = {}
+
+    for path in paths:
+        images += 1
+        # entries are looked up by the same relative path on every host
+        relative = path.relative_to(base_dir).as_posix()
+        index = shard_of(relative, count)
+        summary = summaries[index]
+        entry = entries[index].get(relative)
+        stat = path.stat()
+
+        if (
+            summary is None
+            or entry is None
+            or entry.interrogator != summary['interrogator']
+            or entry.options != summary['options']
+            or entry.size != stat.st_size
+            or entry.mtime != stat.st_mtime_ns
+            or (entry.status == 'tagged' and not Path(manifest_dir, entry.output).is_file())
+        ):
+            missing.append(str(path))
+            continue
+
+        # reported, but not tried again by the merge
+        if entry.status != 'tagged':
+            failed.append(str(path))
+
+        merged[relative] = entry
+
+    if len(missing) > 0:
+        problems.append(
+            f'{len(missing)} image(s) have not been tagged, like '
+            + ', '.join(missing[:max_missing])
+        )
+
+    complete = len(problems) < 1
+
+    if complete:
+        manifest = Manifest(manifest_dir, base_dir)
+        manifest.update(merged)
+        manifest.close()
+
+    return MergeResult(
+        complete,
+        images,
+        len(merged) - len(failed),
+        sum(s['processed'] for s in finished),
+        missing,
+        failed,
+        problems
+    )
@@ -1,17 +1,13 @@
 import os
-import json
 import gradio as gr
 
-from collections import OrderedDict
-from pathlib import Path
-from glob import glob
-from PIL import Image, UnidentifiedImageError
+from PIL import Image
 
 from webui import wrap_gradio_gpu_call
 from modules import ui
 from modules import generation_parameters_copypaste as parameters_copypaste
 
-from tagger import format, utils
+from tagger import batch, format, utils
 from tagger.utils import split_str
 from tagger.interrogator import Interrogator
 
@@ -26,15 +22,27 @@ def unload_interrogators():
     return [f'Successfully unload {unloaded_models} model(s)']
 
 
+def clear_cache():
+    return [f'Successfully removed {utils.cache.clear()} cached result(s)']
+
+
 def on_interrogate(
     image: Image,
     batch_input_glob: str,
     batch_input_recursive: bool,
+    batch_input_include: str,
+    batch_input_exclude: str,
     batch_output_dir: str,
     batch_output_filename_format: str,
     batch_output_action_on_conflict: str,
     batch_remove_duplicated_tag: bool,
     batch_output_save_json: bool,
+    batch_use_manifest: bool,
+    batch_size: int,
+    batch_decode_workers: int,
+    batch_write_workers: int,
+    batch_queue_depth: int,
+    batch_preprocess_processes: int,
 
     interrogator: str,
     threshold: float,
@@ -46,6 +54,7 @@ def on_interrogate(
     replace_underscore_excludes: str,
     escape_tag: bool,
 
+    use_cache: bool,
     unload_model_after_running: bool
 ):
     if interrogator not in utils.interrogators:
@@ -64,10 +73,16 @@ def on_interrogate(
         escape_tag
     )
 
+    cache = utils.cache if use_cache else None
+
     # single process
     if image is not None:
-        ratings, tags = interrogator.interrogate(image)
-        processed_tags = Interrogator.postprocess_tags(
+        if cache is not None:
+            ratings, tags = cache.interrogate(interrogator, image)
+        else:
+            ratings, tags = interrogator.interrogate(image)
+
+        processed_tags = interrogator.postprocess(
             tags,
             *postprocess_opts
         )
@@ -83,129 +98,39 @@ def on_interrogate(
         ]
 
     # batch process
-    batch_input_glob = batch_input_glob.strip()
-    batch_output_dir = batch_output_dir.strip()
-    batch_output_filename_format = batch_output_filename_format.strip()
-
-    if batch_input_glob != '':
-        # if there is no glob pattern, insert it automatically
-        if not batch_input_glob.endswith('*'):
-            if not batch_input_glob.endswith(os.sep):
-                batch_input_glob += os.sep
-            batch_input_glob += '*'
-
-        # get root directory of input glob pattern
-        base_dir = batch_input_glob.replace('?', '*')
-        base_dir = base_dir.split(os.sep + '*').pop(0)
-
-        # check the input directory path
-        if not os.path.isdir(base_dir):
-            return ['', None, None, 'input path is not a directory']
-
-        # this line is moved here because some reason
-        # PIL.Image.registered_extensions() returns only PNG if you call too early
-        supported_extensions = [
-            e
-            for e, f in Image.registered_extensions().items()
-            if f in Image.OPEN
-        ]
-
-        paths = [
-            Path(p)
-            for p in glob(batch_input_glob, recursive=batch_input_recursive)
-            if '.' + p.split('.').pop().lower() in supported_extensions
-        ]
-
-        print(f'found {len(paths)} image(s)')
-
-        for path in paths:
-            try:
-                image = Image.open(path)
-            except UnidentifiedImageError:
-                # just in case, user has mysterious file...
-                print(f'${path} is not supported image type')
-                continue
-
-            # guess the output path
-            base_dir_last = Path(base_dir).parts[-1]
-            base_dir_last_idx = path.parts.index(base_dir_last)
-            output_dir = Path(
-                batch_output_dir) if batch_output_dir else Path(base_dir)
-            output_dir = output_dir.joinpath(
-                *path.parts[base_dir_last_idx + 1:]).parent
-
-            output_dir.mkdir(0o777, True, True)
-
-            # format output filename
-            format_info = format.Info(path, 'txt')
-
-            try:
-                formatted_output_filename = format.pattern.sub(
-                    lambda m: format.format(m, format_info),
-                    batch_output_filename_format
-                )
-            except (TypeError, ValueError) as error:
-                return ['', None, None, str(error)]
-
-            output_path = output_dir.joinpath(
-                formatted_output_filename
-            )
-
-            output = []
-
-            if output_path.is_file():
-                output.append(output_path.read_text(errors='ignore').strip())
-
-                if batch_output_action_on_conflict == 'ignore':
-                    print(f'skipping {path}')
-                    continue
-
-            ratings, tags = interrogator.interrogate(image)
-            processed_tags = Interrogator.postprocess_tags(
-                tags,
-                *postprocess_opts
-            )
-
-            # TODO: switch for less print
-            print(
-                f'found {len(processed_tags)} tags out of {len(tags)} from {path}'
-            )
-
-            plain_tags = ', '.join(processed_tags)
-
-            if batch_output_action_on_conflict == 'copy':
-                output = [plain_tags]
-            elif batch_output_action_on_conflict == 'prepend':
-                output.insert(0, plain_tags)
-            else:
-                output.append(plain_tags)
-
-            if batch_remove_duplicated_tag:
-                output_path.write_text(
-                    ', '.join(
-                        OrderedDict.fromkeys(
-                            map(str.strip, ','.join(output).split(','))
-                        )
-                    ),
-                    encoding='utf-8'
-                )
-            else:
-                output_path.write_text(
-                    ', '.join(output),
-                    encoding='utf-8'
-                )
-
-            if batch_output_save_json:
-                output_path.with_suffix('.json').write_text(
-                    json.dumps([ratings, tags])
-                )
-
-        print('all done :)')
+    summary = ''
+
+    if batch_input_glob.strip() != '':
+        try:
+            summary = batch.interrogate_directory(
+                interrogator,
+                postprocess_opts,
+
+                batch_input_glob,
+                batch_input_recursive,
+                split_str(batch_input_include),
+                split_str(batch_input_exclude),
+                batch_output_dir,
+                batch_output_filename_format,
+                batch_output_action_on_conflict,
+                batch_remove_duplicated_tag,
+                batch_output_save_json,
+                batch_use_manifest,
+
+                batch_size,
+                batch_decode_workers,
+                batch_write_workers,
+                batch_queue_depth,
+                batch_preprocess_processes,
+                cache=cache
+            ).summary
+        except ValueError as error:
+            return ['', None, None, str(error)]
 
     if unload_model_after_running:
         interrogator.unload()
 
-    return ['', None, None, '']
+    return ['', None, None, summary]
 
 
 def on_ui_tabs():
@@ -234,6 +159,18 @@ def on_ui_tabs():
                             label='Use recursive with glob pattern'
                         )
 
+                        batch_input_include = utils.preset.component(
+                            gr.Textbox,
+                            label='Include patterns',
+                            placeholder='Comma separated, like *.png, characters/*. Leave blank to include all images.'
+                        )
+
+                        batch_input_exclude = utils.preset.component(
+                            gr.Textbox,
+                            label='Exclude patterns',
+                            placeholder='Comma separated, like *_mask.png, backup. Matching directories are not read.'
+                        )
+
                         batch_output_dir = utils.preset.component(
                             gr.Textbox,
                             label='Output directory',
@@ -247,7 +184,6 @@ def on_ui_tabs():
                             value='[name].[output_extension]'
                         )
 
-                        import hashlib
                         with gr.Accordion(
                             label='Output filename formats',
                             open=False
@@ -258,7 +194,7 @@ def on_ui_tabs():
                                 - `[name]`: Original filename without extension
                                 - `[extension]`: Original extension
                                 - `[hash:<algorithms>]`: Original extension
-                                    Available algorithms: `{', '.join(hashlib.algorithms_available)}`
+                                    Available algorithms: `{', '.join(format.available_algorithms())}`
 
                                 ### Related to output file
                                 - `[output_extension]`: Output extension (has no dot)
@@ -289,11 +225,66 @@ def on_ui_tabs():
                             label='Remove duplicated tag'
                         )
 
+                        batch_use_manifest = utils.preset.component(
+                            gr.Checkbox,
+                            label='Skip images tagged by a previous run with the same settings',
+                            value=False
+                        )
+
                         batch_output_save_json = utils.preset.component(
                             gr.Checkbox,
                             label='Save with JSON'
                         )
 
+                        batch_size = utils.preset.component(
+                            gr.Slider,
+                            label='Batch size',
+                            minimum=1,
+                            maximum=64,
+                            step=1,
+                            value=1
+                        )
+
+                        with gr.Accordion(
+                            label='Pipeline',
+                            open=False
+                        ):
+                            batch_decode_workers = utils.preset.component(
+                                gr.Slider,
+                                label='Decode workers',
+                                minimum=1,
+                                maximum=32,
+                                step=1,
+                                value=2
+                            )
+
+                            batch_write_workers = utils.preset.component(
+                                gr.Slider,
+                                label='Write workers',
+                                minimum=1,
+                                maximum=16,
+                                step=1,
+                                value=1
+                            )
+
+                            batch_queue_depth = utils.preset.component(
+                                gr.Slider,
+                                label='Queue depth',
+                                minimum=1,
+                                maximum=256,
+                                step=1,
+                                value=32
+                            )
+
+                            batch_preprocess_processes = utils.preset.component(
+                                gr.Slider,
+                                label='Preprocess processes (0 to use threads)',
+                                minimum=0,
+                                maximum=os.cpu_count() or 1,
+                                step=1,
+                                value=0
+                            )
+
                 submit = gr.Button(
                     value='Interrogate',
                     variant='primary'
@@ -341,7 +332,7 @@ def on_ui_tabs():
                         ui.create_refresh_button(
                             interrogator,
                             lambda: None,
-                            lambda: {'choices': utils.refresh_interrogators()},
+                            lambda: {'choices': utils.refresh_interrogators(True)},
                             'refresh_interrogator'
                         )
 
@@ -349,6 +340,16 @@ def on_ui_tabs():
                         value='Unload all interrogate models'
                     )
 
+                    with gr.Row(variant='compact'):
+                        use_cache = utils.preset.component(
+                            gr.Checkbox,
+                            label='Use result cache'
+                        )
+
+                        clear_cache_button = gr.Button(
+                            value='Clear cache'
+                        )
+
                 threshold = utils.preset.component(
                     gr.Slider,
                     label='Threshold',
@@ -442,6 +443,11 @@ def on_ui_tabs():
             outputs=[info]
         )
 
+        clear_cache_button.click(
+            fn=clear_cache,
+            outputs=[info]
+        )
+
         for func in [image.change, submit.click]:
             func(
                 fn=wrap_gradio_gpu_call(on_interrogate),
@@ -452,11 +458,19 @@ def on_ui_tabs():
                     # batch process
                     batch_input_glob,
                     batch_input_recursive,
+                    batch_input_include,
+                    batch_input_exclude,
                     batch_output_dir,
                     batch_output_filename_format,
                     batch_output_action_on_conflict,
                     batch_remove_duplicated_tag,
                     batch_output_save_json,
+                    batch_use_manifest,
+                    batch_size,
+                    batch_decode_workers,
+                    batch_write_workers,
+                    batch_queue_depth,
+                    batch_preprocess_processes,
 
                     # options
                     interrogator,
@@ -469,6 +483,7 @@ def on_ui_tabs():
                     replace_underscore_excludes,
                     escape_tag,
 
+                    use_cache,
                     unload_model_after_running
                 ],
                 outputs=[
@@ -1,21 +1,47 @@
 import os
+import atexit
 
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 from pathlib import Path
 
 from modules import shared, scripts
 from preload import default_ddp_path
 from tagger.preset import Preset
-from tagger.interrogator import Interrogator, DeepDanbooruInterrogator, WaifuDiffusionInterrogator
+from tagger.cache import ResultCache
+from tagger.quantize import quantizations
+from tagger.registry import Definitions
+from tagger.interrogator import Interrogator, DeepDanbooruInterrogator, WaifuDiffusionInterrogator, manager, registry
 
 preset = Preset(Path(scripts.basedir(), 'presets'))
 
+cache = ResultCache(
+    Path(scripts.basedir(), 'cache', 'results.db'),
+    getattr(shared.cmd_opts, 'tagger_cache_size', 1024) * 1024 * 1024
+)
+
+# results are committed in batches
+atexit.register(cache.commit)
+
 interrogators: Dict[str, Interrogator] = {}
 
+# interrogators are created once and reused on every refresh,
+# so refreshing the list is cheap and does not drop the loaded models
+waifu_diffusion_interrogators: Dict[str, Interrogator] = {}
+deepdanbooru_interrogators: Dict[str, Interrogator] = {}
+registered_interrogators: Dict[str, Interrogator] = {}
 
-def refresh_interrogators() -> List[str]:
-    global interrogators
-    interrogators = {
+# name of each quantized variant -> its base interrogator and the variant
+quantized_interrogators: Dict[str, Tuple[Interrogator, Interrogator]] = {}
+
+# definitions the registered interrogators have been created from
+registered_definitions: Definitions = {}
+
+# projects directory and its mtime when it has been scanned
+deepdanbooru_scanned: Optional[Tuple[str, int]] = None
+
+
+def create_waifu_diffusion_interrogators() -> Dict[str, Interrogator]:
+    return {
         'wd14-convnextv2-v2': WaifuDiffusionInterrogator(
             'wd14-convnextv2-v2',
             repo_id='SmilingWolf/wd-v1-4-convnextv2-tagger-v2',
@@ -61,20 +87,123 @@ def refresh_interrogators() -> List[str]:
         ),
     }
 
+
+def create_registered_interrogators(force=False) -> Dict[str, Interrogator]:
+    global registered_interrogators, registered_definitions
+
+    try:
+        definitions = registry.load(force)
+    except Exception as error:
+        print(f'Failed to read the interrogator registry: {error}')
+        return registered_interrogators
+
+    if definitions is registered_definitions:
+        return registered_interrogators
+
+    created = {}
+
+    for name, definition in definitions.items():
+        # unchanged definitions keep their interrogator and its loaded model
+        if name in registered_interrogators and registered_definitions.get(name) == definition:
+            created[name] = registered_interrogators[name]
+            continue
+
+        options = dict(definition)
+        kind = options.pop('type', 'waifu-diffusion')
+
+        if kind == 'deepdanbooru':
+            created[name] = DeepDanbooruInterrogator(name, options['project_path'])
+        elif kind == 'waifu-diffusion':
+            if 'repo_id' not in options and 'model_path' not in options:
+                print(f'Interrogator {name} needs a repo_id or a model_path')
+                continue
+
+            try:
+                created[name] = WaifuDiffusionInterrogator(name, **options)
+            except ValueError as error:
+                print(f'Interrogator {name}: {error}')
+        else:
+            print(f'Unknown type {kind} of interrogator {name}')
+
+    registered_interrogators = created
+    registered_definitions = definitions
+
+    return registered_interrogators
+
+
+def scan_deepdanbooru_projects(force=False) -> Dict[str, Interrogator]:
+    global deepdanbooru_interrogators, deepdanbooru_scanned
+
     # load deepdanbooru project
-    os.makedirs(
-        getattr(shared.cmd_opts, 'deepdanbooru_projects_path', default_ddp_path),
-        exist_ok=True
+    projects_path = getattr(
+        shared.cmd_opts,
+        'deepdanbooru_projects_path',
+        default_ddp_path
     )
+    os.makedirs(projects_path, exist_ok=True)
+
+    # adding, removing or renaming a project changes the mtime of the directory
+    scanned = (str(projects_path), os.stat(projects_path).st_mtime_ns)
+    if not force and scanned == deepdanbooru_scanned:
+        return deepdanbooru_interrogators
+
+    found = {}
 
-    for path in os.scandir(shared.cmd_opts.deepdanbooru_projects_path):
+    for path in os.scandir(projects_path):
         if not path.is_dir():
             continue
 
         if not Path(path, 'project.json').is_file():
             continue
 
-        interrogators[path.name] = DeepDanbooruInterrogator(path.name, path)
+        found[path.name] = deepdanbooru_interrogators.get(path.name)
+
+        if found[path.name] is None or os.fspath(found[path.name].project_path) != path.path:
+            found[path.name] = DeepDanbooruInterrogator(path.name, path)
+
+    deepdanbooru_interrogators = found
+    deepdanbooru_scanned = scanned
+
+    return deepdanbooru_interrogators
+
+
+def refresh_interrogators(force=False) -> List[str]:
+    global interrogators
+
+    if len(waifu_diffusion_interrogators) < 1:
+        waifu_diffusion_interrogators.update(
+            create_waifu_diffusion_interrogators()
+        )
+
+    interrogators = dict(waifu_diffusion_interrogators)
+
+    # interrogators of the registry replace the built-in ones with the same name
+    interrogators.update(create_registered_interrogators(force))
+
+    # quantized variants of the waifu diffusion models
+    for quantization in split_str(getattr(shared.cmd_opts, 'tagger_quantize', '')):
+        if quantization not in quantizations:
+            print(f'Unknown quantization {quantization}, use one of {quantizations}')
+            continue
+
+        for name, interrogator in list(interrogators.items()):
+            if isinstance(interrogator, WaifuDiffusionInterrogator) and interrogator.quantization is None:
+                variant = f'{name}-{quantization}'
+
+                if variant in interrogators:
+                    continue
+
+                if quantized_interrogators.get(variant, (None,))[0] is not interrogator:
+                    quantized_interrogators[variant] = (
+                        interrogator,
+                        interrogator.quantized(variant, quantization)
+                    )
+
+                interrogators[variant] = quantized_interrogators[variant][1]
+
+    interrogators.update(scan_deepdanbooru_projects(force))
+
+    manager.forget(list(interrogators.values()))
 
     return sorted(interrogators.keys())
 
@@ -0,0 +1,167 @@
+import os
+import json
+
+from typing import Dict, List, Tuple
+from pathlib import Path
+
+import numpy as np
+
+# initializers start on a page boundary, so every one of them can be mapped
+alignment = 4096
+
+# smaller initializers stay in the graph, mapping them saves nothing
+min_size = 1024
+
+
+def mapped_model_paths(model_path: Path) -> Tuple[Path, Path, Path]:
+    # graph, weights and index of the initializers in the weights
+    stem = f'{model_path.stem}.mapped'
+    return (
+        model_path.with_name(f'{stem}.onnx'),
+        model_path.with_name(f'{stem}.weights'),
+        model_path.with_name(f'{stem}.json')
+    )
+
+
+def export(model_path: os.PathLike) -> Path:
+    # moves the initializers of the model into a separate flat file once,
+    # returns the graph which refers to them as external data
+    model_path = Path(model_path)
+    graph_path, weights_path, index_path = mapped_model_paths(model_path)
+
+    # the index is written last, it marks a complete export
+    if index_path.is_file() and index_path.stat().st_mtime >= model_path.stat().st_mtime:
+        return graph_path
+
+    print(f'Exporting the weights of {model_path} to {weights_path}')
+
+    from launch import is_installed, run_pip
+    if not is_installed('onnx'):
+        run_pip('install onnx', 'onnx')
+
+    import onnx
+    from onnx import numpy_helper
+    from onnx.external_data_helper import set_external_data
+
+    model = onnx.load(str(model_path))
+    initializers: Dict[str, Dict[str, object]] = {}
+
+    # write to temporary files so other processes never read a partial model
+    temp_paths = [
+        p.with_name(f'{p.name}.{os.getpid()}.tmp')
+        for p in [graph_path, weights_path, index_path]
+    ]
+
+    try:
+        with open(temp_paths[1], 'wb') as file:
+            for tensor in model.graph.initializer:
+                array = np.ascontiguousarray(numpy_helper.to_array(tensor))
+
+                if array.nbytes < min_size:
+                    continue
+
+                offset = (file.tell() + alignment - 1) // alignment * alignment
+                file.write(bytes(offset - file.tell()))
+                file.write(array.tobytes())
+
+                initializers[tensor.name] = {
+                    'offset': offset,
+                    'dtype': array.dtype.str,
+                    'shape': list(array.shape)
+                }
+
+                # the graph stays a valid model on its own
+                tensor.CopyFrom(numpy_helper.from_array(array, tensor.name))
+                set_external_data(tensor, weights_path.name, offset, array.nbytes)
+                tensor.ClearField('raw_data')
+
+        onnx.save(model, str(temp_paths[0]))
+        temp_paths[2].write_text(json.dumps({
+            'weights': weights_path.name,
+            'initializers': initializers
+        }))
+
+        for temp_path, path in zip(temp_paths, [graph_path, weights_path, index_path]):
+            os.replace(temp_path, path)
+    finally:
+        for temp_path in temp_paths:
+            if temp_path.exists():
+                temp_path.unlink()
+
+    return graph_path
+
+
+def mapped_memory(path: Path) -> Tuple[int, int]:
+    # resident bytes of the mappings of the file in this process, and the
+    # part of them other processes share, from the proportional set size
+    resident = 0
+    proportional = 0
+    mapping = False
+
+    try:
+        with open('/proc/self/smaps', encoding='utf-8') as file:
+            for line in file:
+                fields = line.split(maxsplit=5)
+
+                # mapping header, the address range has a dash in it
+                if '-' in fields[0]:
+                    mapping = len(fields) == 6 and fields[5].rstrip('\n') == str(path)
+                elif mapping and fields[0] == 'Rss:':
+                    resident += int(fields[1]) * 1024
+                elif mapping and fields[0] == 'Pss:':
+                    proportional += int(fields[1]) * 1024
+    except OSError:
+        # only linux reports it
+        pass
+
+    return resident, resident - proportional
+
+
+# initializers of an exported model as read only views of the mapped file,
+# onnxruntime runs the model on these views instead of its own copies, so
+# processes which load the same model share the pages of the file
+class MappedWeights:
+    graph_path: Path
+    path: Path
+    arrays: Dict[str, np.ndarray]
+
+    def __init__(self, model_path: os.PathLike) -> None:
+        self.graph_path = export(model_path)
+        index_path = mapped_model_paths(Path(model_path))[2]
+        index = json.loads(index_path.read_text())
+
+        self.path = self.graph_path.with_name(index['weights']).resolve()
+        # an empty file can not be mapped
+        if self.path.stat().st_size > 0:
+            self.buffer = np.memmap(self.path, dtype=np.uint8, mode='r')
+        else:
+            self.buffer = np.empty(0, np.uint8)
+
+        self.arrays = {
+            name: np.ndarray(
+                info['shape'],
+                np.dtype(info['dtype']),
+                self.buffer,
+                info['offset']
+            )
+            for name, info in index['initializers'].items()
+        }
+
+        # onnxruntime does not own the values, they live as long as the session
+        self.values: List[object] = []
+
+    @property
+    def size(self) -> int:
+        return len(self.buffer)
+
+    def add_to(self, session_options) -> None:
+        from onnxruntime import OrtValue
+
+        for name, array in self.arrays.items():
+            value = OrtValue.ortvalue_from_numpy(array)
+            session_options.add_initializer(name, value)
+            self.values.append(value)
+
+    def memory(self) -> Tuple[int, int, int]:
+        # mapped, resident and shared bytes
+        return (self.size, *mapped_memory(self.path))
@@ -0,0 +1,85 @@
+import sys
+import tempfile
+
+from pathlib import Path
+
+import pytest
+
+root = Path(__file__).parent.parent
+sys.path.insert(0, str(root))
+
+# the benchmark generates the tiny model and images used by the tests
+sys.path.insert(0, str(root.joinpath('benchmarks')))
+
+from tagger import headless  # noqa: E402
+
+# tagger modules import the webui, which is replaced by the stand-ins
+headless.install([
+    '--use-cpu', 'all',
+    '--deepdanbooru-projects-path', tempfile.mkdtemp()
+])
+
+# few enough tags to run fast, low threshold so that every image has tags
+postprocess_opts = (0.01, [], [], False, True, True, [], True)
+
+
+@pytest.fixture(scope='session')
+def interrogator(tmp_path_factory):
+    from benchmark import build_model, build_tags
+    from tagger.interrogator import WaifuDiffusionInterrogator
+
+    directory = tmp_path_factory.mktemp('model')
+    model_path = directory.joinpath('model.onnx')
+    tags_path = directory.joinpath('selected_tags.csv')
+
+    build_model(model_path, 64, 40)
+    build_tags(tags_path, 40)
+
+    class LocalInterrogator(WaifuDiffusionInterrogator):
+        def download(self):
+            return model_path, tags_path
+
+    interrogator = LocalInterrogator('test', repo_id='local')
+    yield interrogator
+    interrogator.unload()
+
+
+@pytest.fixture
+def images(tmp_path):
+    from benchmark import build_images
+
+    directory = tmp_path.joinpath('images')
+    directory.mkdir()
+    build_images(directory, 6, 32, 96)
+
+    return directory
+
+
+@pytest.fixture
+def tag(interrogator):
+    from tagger import batch
+
+    # tags the directory with the test model, options of interrogate_directory
+    def tag(input_dir, output_dir, **kwargs) -> batch.Result:
+        options = dict(
+            output_dir=str(output_dir),
+            action_on_conflict='copy',
+            batch_size=2
+        )
+        options.update(kwargs)
+
+        return batch.interrogate_directory(
+            interrogator,
+            postprocess_opts,
+            str(input_dir),
+            **options
+        )
+
+    return tag
+
+
+def captions(output_dir: Path):
+    return {
+        path.name: path.read_text(encoding='utf-8')
+        for path in sorted(Path(output_dir).glob('*.txt'))
+    }
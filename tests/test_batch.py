@@ -0,0 +1,43 @@
+import pytest
+
+from tests.conftest import captions
+
+
+@pytest.mark.parametrize('options', [
+    dict(mode='pipelined', batch_size=4, decode_workers=3, write_workers=2, queue_depth=2),
+    dict(mode='pipelined', batch_size=3, preprocess_processes=2)
+])
+def test_pipelined_matches_batched(tag, images, tmp_path, options):
+    expected = tag(images, tmp_path.joinpath('batched'), mode='batched')
+    actual = tag(images, tmp_path.joinpath('pipelined'), **options)
+
+    assert expected.processed == actual.processed == 6
+    assert captions(tmp_path.joinpath('batched'))
+    assert captions(tmp_path.joinpath('pipelined')) == captions(tmp_path.joinpath('batched'))
+
+
+def test_cached_results_are_not_evaluated(tag, interrogator, images, tmp_path, monkeypatch):
+    from tagger.cache import ResultCache
+
+    cache = ResultCache(tmp_path.joinpath('cache.db'), 1 << 20)
+    tag(images, tmp_path.joinpath('first'), cache=cache)
+
+    def evaluate(*args, **kwargs):
+        raise AssertionError('cached images must not be evaluated')
+
+    monkeypatch.setattr(interrogator, 'evaluate', evaluate)
+
+    for mode in ('batched', 'pipelined'):
+        result = tag(images, tmp_path.joinpath(mode), cache=cache, mode=mode)
+
+        assert result.processed == 6
+        assert captions(tmp_path.joinpath(mode)) == captions(tmp_path.joinpath('first'))
+
+
+def test_unreadable_images_are_counted(tag, images, tmp_path):
+    images.joinpath('broken.png').write_bytes(b'not an image')
+
+    result = tag(images, tmp_path.joinpath('output'))
+
+    assert result.processed == 6
+    assert result.failed == 1
@@ -0,0 +1,50 @@
+from tagger.cache import ResultCache
+
+
+def results(value):
+    return {'general': value}, {'tag': value, 'other': 1 - value}
+
+
+def test_results_are_read_back(tmp_path):
+    cache = ResultCache(tmp_path.joinpath('cache.db'), 1 << 20)
+    cache.put('a', 'model', *results(0.25))
+    cache.commit()
+
+    assert cache.get('a', 'model') == results(0.25)
+    assert cache.get('a', 'other model') is None
+    assert cache.get('b', 'model') is None
+
+    # committed results are seen by other processes
+    assert ResultCache(tmp_path.joinpath('cache.db'), 1 << 20).get('a', 'model') == results(0.25)
+
+
+def test_changed_labels_remove_the_results(tmp_path):
+    cache = ResultCache(tmp_path.joinpath('cache.db'), 1 << 20)
+    cache.put('a', 'model', *results(0.25))
+    cache.put('b', 'model', {'general': 0.5}, {'renamed': 0.5, 'other': 0.5})
+
+    assert cache.get('a', 'model') is None
+    assert cache.get('b', 'model') == ({'general': 0.5}, {'renamed': 0.5, 'other': 0.5})
+
+
+def test_least_recently_used_results_are_evicted(tmp_path):
+    # three float32 confidents, two results fit
+    cache = ResultCache(tmp_path.joinpath('cache.db'), 24)
+    cache.put('a', 'model', *results(0.25))
+    cache.put('b', 'model', *results(0.5))
+
+    assert cache.get('a', 'model') is not None
+
+    cache.put('c', 'model', *results(0.75))
+
+    assert cache.size == 24
+    assert cache.get('a', 'model') == results(0.25)
+    assert cache.get('b', 'model') is None
+    assert cache.get('c', 'model') == results(0.75)
+
+
+def test_results_larger_than_the_cache_are_not_stored(tmp_path):
+    cache = ResultCache(tmp_path.joinpath('cache.db'), 8)
+    cache.put('a', 'model', *results(0.25))
+
+    assert cache.get('a', 'model') is None
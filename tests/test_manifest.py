@@ -0,0 +1,89 @@
+import os
+
+from tagger.manifest import Manifest, filename
+
+from tests.conftest import captions
+
+
+def entries(output_dir, source_dir):
+    manifest = Manifest(output_dir, source_dir)
+    manifest.close()
+    return manifest.entries
+
+
+def test_unchanged_images_are_skipped(tag, images, tmp_path):
+    output_dir = tmp_path.joinpath('output')
+
+    assert tag(images, output_dir, use_manifest=True).processed == 6
+    expected = captions(output_dir)
+
+    result = tag(images, output_dir, use_manifest=True)
+    assert (result.processed, result.skipped) == (0, 6)
+
+    # other options change the captions
+    result = tag(images, output_dir, use_manifest=True, batch_size=1, save_json=True)
+    assert (result.processed, result.skipped) == (6, 0)
+    assert captions(output_dir) == expected
+
+
+def test_touched_images_are_compared_by_content(tag, images, tmp_path):
+    output_dir = tmp_path.joinpath('output')
+    tag(images, output_dir, use_manifest=True)
+
+    touched = images.joinpath('00000.png')
+    stat = touched.stat()
+    os.utime(touched, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    result = tag(images, output_dir, use_manifest=True)
+    assert (result.processed, result.skipped) == (0, 6)
+
+    # the new time is recorded, so the file is not hashed again
+    assert entries(output_dir, images)['00000.png'].mtime == touched.stat().st_mtime_ns
+
+    changed = images.joinpath('00001.png')
+    changed.write_bytes(images.joinpath('00002.png').read_bytes())
+
+    result = tag(images, output_dir, use_manifest=True)
+    assert (result.processed, result.skipped) == (1, 5)
+
+
+def test_unreadable_images_are_tried_again(tag, images, tmp_path):
+    output_dir = tmp_path.joinpath('output')
+    images.joinpath('broken.png').write_bytes(b'not an image')
+
+    result = tag(images, output_dir, use_manifest=True)
+    assert (result.processed, result.failed) == (6, 1)
+    assert output_dir.joinpath(filename).is_file()
+    assert entries(output_dir, images)['broken.png'].status == 'failed'
+
+    result = tag(images, output_dir, use_manifest=True)
+    assert (result.processed, result.skipped, result.failed) == (0, 6, 1)
+
+
+def test_digest_is_reused_while_the_file_is_unchanged(tmp_path):
+    source = tmp_path.joinpath('image.png')
+    source.write_bytes(b'image')
+    stat = source.stat()
+
+    manifest = Manifest(tmp_path, tmp_path)
+    manifest.record(source, stat, 'recorded', 'model', 'options', tmp_path.joinpath('image.txt'))
+    manifest.close()
+
+    # read by the next run
+    manifest = Manifest(tmp_path, tmp_path)
+    assert manifest.digest(source, stat, lambda: 'hashed') == 'recorded'
+
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert manifest.digest(source, source.stat(), lambda: 'hashed') == 'hashed'
+    manifest.close()
+
+
+def test_failed_images_are_hashed(tmp_path):
+    source = tmp_path.joinpath('image.png')
+    source.write_bytes(b'broken')
+    stat = source.stat()
+
+    manifest = Manifest(tmp_path, tmp_path)
+    manifest.failed(source, stat, 'model', 'options')
+    assert manifest.digest(source, stat, lambda: 'hashed') == 'hashed'
+    manifest.close()
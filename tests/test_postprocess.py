@@ -0,0 +1,42 @@
+import random
+
+import numpy as np
+import pytest
+
+from postprocess_check import random_case
+
+from tagger.interrogator import Interrogator, TagNames
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_vectorized_postprocess_matches_dicts(seed):
+    rng = random.Random(seed)
+
+    for _ in range(50):
+        names, confidents, options = random_case(rng)
+
+        expected = Interrogator.postprocess_tags(
+            dict(zip(names, confidents.tolist())),
+            **options
+        )
+        actual = Interrogator.postprocess_confidents(
+            confidents,
+            TagNames(names),
+            **options
+        )
+
+        # dicts compare equal in any order, the order is part of the output
+        assert list(actual.items()) == list(expected.items()), (names, options)
+
+
+def test_ties_keep_the_order_of_the_model():
+    names = ['b', 'a', 'c']
+    confidents = np.array([0.5, 0.5, 0.9])
+
+    tags = Interrogator.postprocess_confidents(
+        confidents,
+        TagNames(names),
+        0.35, [], [], False, False, False, [], False
+    )
+
+    assert list(tags) == ['c', 'b', 'a']
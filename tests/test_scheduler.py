@@ -0,0 +1,106 @@
+import asyncio
+
+from threading import Event, Lock
+
+import numpy as np
+
+from tagger.api import Scheduler
+
+
+class BlockingInterrogator:
+    # returns the input as the output, the first batch waits for the test
+    name = 'blocking'
+
+    def __init__(self) -> None:
+        self.started = Event()
+        self.release = Event()
+        self.batches = []
+
+    def evaluate(self, tensors, batch_size, raw=False):
+        self.batches.append(len(tensors))
+        self.started.set()
+        self.release.wait(5)
+        return [tensor * 2 for tensor in tensors]
+
+
+def test_coalesces_requests():
+    interrogator = BlockingInterrogator()
+    interrogator.release.set()
+    scheduler = Scheduler(interrogator, Lock(), 4, 0.5)
+
+    futures = [scheduler.submit(np.full(2, i)) for i in range(3)]
+
+    for i, future in enumerate(futures):
+        assert future.result(5).tolist() == [i * 2, i * 2]
+
+    assert interrogator.batches == [3]
+    scheduler.close()
+
+
+def test_request_cancelled_while_queued():
+    interrogator = BlockingInterrogator()
+    scheduler = Scheduler(interrogator, Lock(), 2, 0)
+
+    # keeps the scheduler busy, so the next requests are queued together
+    first = scheduler.submit(np.zeros(1))
+    assert interrogator.started.wait(5)
+
+    cancelled = scheduler.submit(np.ones(1))
+    other = scheduler.submit(np.ones(1))
+    assert cancelled.cancel()
+
+    interrogator.release.set()
+
+    assert first.result(5).tolist() == [0]
+    assert other.result(5).tolist() == [2]
+    assert scheduler.submit(np.ones(1)).result(5).tolist() == [2]
+    scheduler.close()
+
+
+def test_request_cancelled_while_running():
+    interrogator = BlockingInterrogator()
+    scheduler = Scheduler(interrogator, Lock(), 2, 0.5)
+
+    async def run():
+        # two clients coalesced into the same batch, one of them disconnects
+        cancelled = asyncio.ensure_future(asyncio.wrap_future(scheduler.submit(np.ones(1))))
+        other = asyncio.ensure_future(asyncio.wrap_future(scheduler.submit(np.ones(1))))
+
+        await asyncio.get_running_loop().run_in_executor(None, interrogator.started.wait, 5)
+        cancelled.cancel()
+        interrogator.release.set()
+
+        assert (await asyncio.wait_for(other, 5)).tolist() == [2]
+        assert cancelled.cancelled()
+
+        # the scheduler thread is still running
+        later = asyncio.wrap_future(scheduler.submit(np.full(1, 3)))
+        assert (await asyncio.wait_for(later, 5)).tolist() == [6]
+
+    asyncio.run(run())
+    assert interrogator.batches == [2, 1]
+    scheduler.close()
+
+
+def test_failed_batch_does_not_stop_the_scheduler():
+    class FailingInterrogator(BlockingInterrogator):
+        def evaluate(self, tensors, batch_size, raw=False):
+            if len(self.batches) < 1:
+                self.batches.append(len(tensors))
+                raise RuntimeError('broken batch')
+
+            return super().evaluate(tensors, batch_size, raw)
+
+    interrogator = FailingInterrogator()
+    interrogator.release.set()
+    scheduler = Scheduler(interrogator, Lock(), 1, 0)
+
+    failed = scheduler.submit(np.ones(1))
+    try:
+        failed.result(5)
+        assert False, 'the batch should have failed'
+    except RuntimeError:
+        pass
+
+    assert scheduler.submit(np.ones(1)).result(5).tolist() == [2]
+    scheduler.close()
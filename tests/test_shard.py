@@ -0,0 +1,47 @@
+from tagger import batch
+from tagger.shard import shard_of
+
+from tests.conftest import captions
+
+
+def test_shard_of_is_stable():
+    # the same on every host, the merge depends on it
+    assert [shard_of(f'{i:05}.png', 4) for i in range(6)] == [
+        shard_of(f'{i:05}.png', 4) for i in range(6)
+    ]
+    assert all(0 <= shard_of(f'{i}.png', 3) < 3 for i in range(100))
+
+
+def test_shards_are_merged(tag, images, tmp_path):
+    output_dir = tmp_path.joinpath('output')
+    images.joinpath('broken.png').write_bytes(b'not an image')
+
+    processed = 0
+    for index in range(2):
+        processed += tag(images, output_dir, shard=(index, 2)).processed
+
+    assert processed == 6
+
+    result = batch.merge_shards(str(images), 2, output_dir=str(output_dir))
+
+    assert result.complete, result.problems
+    assert (result.images, result.merged, result.processed) == (7, 6, 6)
+    assert result.failed == [str(images.joinpath('broken.png'))]
+
+    # later runs without shards skip what the shards have tagged
+    # and try the unreadable images again
+    expected = captions(output_dir)
+    result = tag(images, output_dir, use_manifest=True)
+    assert (result.processed, result.skipped, result.failed) == (0, 6, 1)
+    assert captions(output_dir) == expected
+
+
+def test_unfinished_shards_are_not_merged(tag, images, tmp_path):
+    output_dir = tmp_path.joinpath('output')
+    tag(images, output_dir, shard=(0, 2))
+
+    result = batch.merge_shards(str(images), 2, output_dir=str(output_dir))
+
+    assert not result.complete
+    assert 'shard 1 of 2 has not finished' in result.problems
+    assert len(result.missing) == 6 - result.merged